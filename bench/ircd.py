@@ -0,0 +1,494 @@
+#!/usr/bin/env python
+"""Small irc server to run chii against on localhost. It knows registration,
+JOIN, PART, NAMES, WHOIS, WHO, USERHOST, MODE, TOPIC, KICK, PRIVMSG and
+NOTICE, and keeps clients to a flood limit like real servers do: lines over
+the limit are held back and a client with too many held back is killed for
+Excess Flood.
+
+    python bench/ircd.py --port 6667 --users 20000 --channels 500 --autojoin chii
+    python bench/ircd.py --users 5000 --chatter 200 --netsplit-every 60 --netsplit-fraction 0.3
+
+--users fills channels with simulated users which don't need a connection.
+They can talk (--chatter lines per second) and split off and rejoin in
+netsplits. --autojoin puts a client in every channel as soon as it registers,
+so chii doesn't need the channels in its config. bench/loadgen.py drives real
+clients at it."""
+import argparse, random, string, sys, time
+from collections import defaultdict
+
+try:
+    # thousands of connections are too many for select
+    from twisted.internet import epollreactor
+    epollreactor.install()
+except Exception:
+    pass
+from twisted.internet import protocol, reactor
+from twisted.internet.task import LoopingCall
+from twisted.protocols import basic
+from twisted.words.protocols.irc import parsemsg
+
+SERVER = 'bench.irc'
+RFC1459 = string.maketrans(string.ascii_uppercase + '[]\\~', string.ascii_lowercase + '{}|^')
+
+def lower(name):
+    return name.translate(RFC1459)
+
+class User:
+    def __init__(self, nick, user, host, realname, conn=None):
+        self.nick = nick
+        self.user = user
+        self.host = host
+        self.realname = realname
+        self.conn = conn
+        self.channels = set()
+        self.signon = self.active = time.time()
+
+    def prefix(self):
+        return '%s!%s@%s' % (self.nick, self.user, self.host)
+
+    def send(self, prefix, command, *params):
+        if self.conn:
+            self.conn.send(prefix, command, *params)
+
+class Channel:
+    def __init__(self, name):
+        self.name = name
+        self.topic = None
+        # lower nick -> modes, 'o' and 'v'
+        self.members = {}
+        # lower nicks of members with a connection, the only ones worth sending to
+        self.local = set()
+
+    def prefixed(self, key, user):
+        modes = self.members[key]
+        return ('@' if 'o' in modes else '+' if 'v' in modes else '') + user.nick
+
+class IRCConnection(basic.LineOnlyReceiver):
+    """A client connection. Lines are handled as the flood limit allows"""
+    delimiter = '\n'
+    MAX_LENGTH = 4096
+
+    def connectionMade(self):
+        self.server = self.factory
+        self.user = None
+        self.nick = None
+        self.username = None
+        self.realname = None
+        self.tokens = float(self.server.flood_burst)
+        self.updated = time.time()
+        self.held = []
+        self.pending = None
+        self.server.stats['connections'] += 1
+
+    def connectionLost(self, reason):
+        if self.pending and self.pending.active():
+            self.pending.cancel()
+        if self.user:
+            self.server.quit(self.user, 'Connection closed')
+        self.server.stats['connections'] -= 1
+
+    def send(self, prefix, command, *params):
+        params = list(params)
+        if params:
+            params[-1] = ':' + params[-1]
+        self.sendLine(' '.join([':' + prefix, command] + params) + '\r')
+        self.server.stats['lines_out'] += 1
+
+    def numeric(self, code, *params):
+        self.send(SERVER, code, self.nick or '*', *params)
+
+    def lineReceived(self, line):
+        line = line.rstrip('\r')
+        if not line:
+            return
+        self.server.stats['lines_in'] += 1
+        self.held.append(line)
+        if len(self.held) > self.server.flood_queue:
+            self.server.stats['flood_kills'] += 1
+            self.send(SERVER, 'ERROR', 'Closing Link: %s (Excess Flood)' % (self.nick or '*'))
+            self.transport.loseConnection()
+            return
+        self._handle()
+
+    def _handle(self):
+        self.pending = None
+        now = time.time()
+        self.tokens = min(self.server.flood_burst, self.tokens + (now - self.updated) * self.server.flood_rate)
+        self.updated = now
+        while self.held and self.tokens >= 1:
+            self.tokens -= 1
+            prefix, command, params = parsemsg(self.held.pop(0))
+            method = getattr(self, 'irc_' + command.upper(), None)
+            if method:
+                method(params)
+            elif self.user:
+                self.numeric('421', command, 'Unknown command')
+        if self.held and self.pending is None:
+            self.pending = reactor.callLater((1 - self.tokens) / self.server.flood_rate, self._handle)
+
+    # registration
+    def irc_NICK(self, params):
+        if not params:
+            return self.numeric('431', 'No nickname given')
+        nick = params[0][:30]
+        if lower(nick) in self.server.users and self.server.users[lower(nick)] is not self.user:
+            return self.numeric('433', nick, 'Nickname is already in use')
+        if self.user:
+            self.server.rename(self.user, nick)
+            self.nick = nick
+        else:
+            self.nick = nick
+            self._register()
+
+    def irc_USER(self, params):
+        if len(params) < 4:
+            return self.numeric('461', 'USER', 'Not enough parameters')
+        self.username, self.realname = params[0], params[3]
+        self._register()
+
+    def _register(self):
+        if self.user or not self.nick or not self.username:
+            return
+        self.user = User(self.nick, self.username, self.transport.getPeer().host, self.realname, self)
+        self.server.users[lower(self.nick)] = self.user
+        self.numeric('001', 'Welcome to the bench network %s' % self.user.prefix())
+        self.numeric('002', 'Your host is %s' % SERVER)
+        self.numeric('003', 'This server was created just now')
+        self.numeric('004', SERVER, 'bench', 'i', 'ov')
+        self.numeric('005', 'CHANTYPES=#&', 'PREFIX=(ov)@+', 'MODES=4', 'NICKLEN=30', 'CASEMAPPING=rfc1459', 'are supported by this server')
+        self.numeric('422', 'MOTD File is missing')
+        if lower(self.nick) in self.server.autojoin:
+            for channel in sorted(self.server.channels.values(), key=lambda x: x.name):
+                self.server.join(self.user, channel.name)
+
+    def irc_PING(self, params):
+        self.send(SERVER, 'PONG', SERVER, params[0] if params else SERVER)
+
+    def irc_PONG(self, params):
+        pass
+
+    def irc_QUIT(self, params):
+        user, self.user = self.user, None
+        if user:
+            self.server.quit(user, 'Quit: ' + (params[0] if params else ''))
+        self.transport.loseConnection()
+
+    # everything else needs registration first
+    def _registered(self):
+        if not self.user:
+            self.numeric('451', 'You have not registered')
+        return self.user
+
+    def irc_JOIN(self, params):
+        if self._registered() and params:
+            if params[0] == '0':
+                for name in list(self.user.channels):
+                    self.server.part(self.user, self.server.channels[name].name, 'Left all channels')
+            for name in params[0].split(','):
+                if name[:1] in '#&':
+                    self.server.join(self.user, name)
+                else:
+                    self.numeric('403', name, 'No such channel')
+
+    def irc_PART(self, params):
+        if self._registered() and params:
+            for name in params[0].split(','):
+                if lower(name) in self.user.channels:
+                    self.server.part(self.user, name, params[1] if len(params) > 1 else '')
+                else:
+                    self.numeric('442', name, "You're not on that channel")
+
+    def irc_PRIVMSG(self, params, command='PRIVMSG'):
+        if not self._registered():
+            return
+        if len(params) < 2:
+            return self.numeric('412', 'No text to send')
+        self.user.active = time.time()
+        for target in params[0].split(','):
+            channel = self.server.channels.get(lower(target))
+            if channel:
+                self.server.broadcast(channel, self.user.prefix(), command, channel.name, params[1], exclude=self.user)
+            elif lower(target) in self.server.users:
+                self.server.users[lower(target)].send(self.user.prefix(), command, target, params[1])
+            elif command == 'PRIVMSG':
+                self.numeric('401', target, 'No such nick/channel')
+
+    def irc_NOTICE(self, params):
+        self.irc_PRIVMSG(params, 'NOTICE')
+
+    def irc_NAMES(self, params):
+        if self._registered():
+            for name in params[0].split(',') if params else ():
+                self.server.names(self.user, name)
+
+    def irc_TOPIC(self, params):
+        if not self._registered() or not params:
+            return
+        channel = self.server.channels.get(lower(params[0]))
+        if channel is None:
+            return self.numeric('403', params[0], 'No such channel')
+        if len(params) > 1:
+            channel.topic = params[1]
+            self.server.broadcast(channel, self.user.prefix(), 'TOPIC', channel.name, channel.topic)
+        elif channel.topic:
+            self.numeric('332', channel.name, channel.topic)
+        else:
+            self.numeric('331', channel.name, 'No topic is set')
+
+    def irc_WHOIS(self, params):
+        if not self._registered() or not params:
+            return
+        nick = params[-1]
+        user = self.server.users.get(lower(nick))
+        if user is None:
+            self.numeric('401', nick, 'No such nick/channel')
+        else:
+            self.numeric('311', user.nick, user.user, user.host, '*', user.realname)
+            if user.channels:
+                self.numeric('319', user.nick, ' '.join(self.server.channels[x].name for x in sorted(user.channels)))
+            self.numeric('312', user.nick, SERVER, 'bench')
+            self.numeric('317', user.nick, str(int(time.time() - user.active)), str(int(user.signon)), 'seconds idle, signon time')
+        self.numeric('318', nick, 'End of /WHOIS list')
+
+    def irc_WHO(self, params):
+        if not self._registered():
+            return
+        mask = params[0] if params else '*'
+        channel = self.server.channels.get(lower(mask))
+        if channel:
+            users = [(self.server.users[x], channel.members[x]) for x in channel.members]
+        elif lower(mask) in self.server.users:
+            users = [(self.server.users[lower(mask)], '')]
+        else:
+            users = []
+        for user, modes in users:
+            flags = 'H' + ('@' if 'o' in modes else '+' if 'v' in modes else '')
+            self.numeric('352', channel.name if channel else '*', user.user, user.host, SERVER, user.nick, flags, '0 ' + user.realname)
+        self.numeric('315', mask, 'End of /WHO list')
+
+    def irc_USERHOST(self, params):
+        if self._registered():
+            users = [self.server.users[lower(x)] for x in params[:5] if lower(x) in self.server.users]
+            self.numeric('302', ' '.join('%s=+%s@%s' % (x.nick, x.user, x.host) for x in users))
+
+    def irc_MODE(self, params):
+        if not self._registered() or not params:
+            return
+        channel = self.server.channels.get(lower(params[0]))
+        if channel is None:
+            if lower(params[0]) == lower(self.user.nick):
+                return self.numeric('221', '+i')
+            return self.numeric('403', params[0], 'No such channel')
+        if len(params) == 1:
+            return self.numeric('324', channel.name, '+nt')
+        if params[1] in ('b', '+b') and len(params) == 2:
+            return self.numeric('368', channel.name, 'End of channel ban list')
+        if 'o' not in channel.members.get(lower(self.user.nick), ''):
+            return self.numeric('482', channel.name, "You're not channel operator")
+        self.server.mode(channel, self.user, params[1], params[2:])
+
+    def irc_KICK(self, params):
+        if not self._registered() or len(params) < 2:
+            return
+        channel = self.server.channels.get(lower(params[0]))
+        if channel is None:
+            return self.numeric('403', params[0], 'No such channel')
+        if 'o' not in channel.members.get(lower(self.user.nick), ''):
+            return self.numeric('482', channel.name, "You're not channel operator")
+        victim = self.server.users.get(lower(params[1]))
+        if victim is None or lower(victim.nick) not in channel.members:
+            return self.numeric('441', params[1], channel.name, "They aren't on that channel")
+        self.server.broadcast(channel, self.user.prefix(), 'KICK', channel.name, victim.nick, params[2] if len(params) > 2 else self.user.nick)
+        self.server.leave(victim, channel)
+
+class IRCServer(protocol.ServerFactory):
+    protocol = IRCConnection
+
+    def __init__(self, flood_rate=1.0, flood_burst=5, flood_queue=20, autojoin=()):
+        self.flood_rate = flood_rate
+        self.flood_burst = flood_burst
+        self.flood_queue = flood_queue
+        self.autojoin = set(lower(x) for x in autojoin)
+        self.users = {}
+        self.channels = {}
+        self.simulated = []
+        self.split = []
+        self.stats = defaultdict(int)
+
+    def broadcast(self, channel, prefix, command, *params, **kwargs):
+        exclude = kwargs.get('exclude')
+        for key in list(channel.local):
+            user = self.users[key]
+            if user is not exclude:
+                user.send(prefix, command, *params)
+
+    def join(self, user, name):
+        key, nick = lower(name), lower(user.nick)
+        channel = self.channels.get(key)
+        if channel is None:
+            channel = self.channels[key] = Channel(name)
+        if nick in channel.members:
+            return
+        # the first one in gets ops
+        channel.members[nick] = '' if channel.members else 'o'
+        if user.conn:
+            channel.local.add(nick)
+        user.channels.add(key)
+        self.broadcast(channel, user.prefix(), 'JOIN', channel.name)
+        if user.conn:
+            if channel.topic:
+                user.conn.numeric('332', channel.name, channel.topic)
+            self.names(user, channel.name)
+
+    def leave(self, user, channel):
+        key, nick = lower(channel.name), lower(user.nick)
+        channel.members.pop(nick, None)
+        channel.local.discard(nick)
+        user.channels.discard(key)
+        if not channel.members:
+            del self.channels[key]
+
+    def part(self, user, name, message):
+        channel = self.channels[lower(name)]
+        self.broadcast(channel, user.prefix(), 'PART', channel.name, message)
+        self.leave(user, channel)
+
+    def quit(self, user, message):
+        if self.users.get(lower(user.nick)) is not user:
+            return
+        told = set()
+        for key in list(user.channels):
+            channel = self.channels[key]
+            told.update(channel.local)
+            self.leave(user, channel)
+        for nick in told:
+            self.users[nick].send(user.prefix(), 'QUIT', message)
+        del self.users[lower(user.nick)]
+
+    def rename(self, user, nick):
+        old, new = lower(user.nick), lower(nick)
+        told = set([old]) if user.conn else set()
+        for key in user.channels:
+            channel = self.channels[key]
+            told.update(channel.local)
+            channel.members[new] = channel.members.pop(old)
+            if old in channel.local:
+                channel.local.discard(old)
+                channel.local.add(new)
+        prefix = user.prefix()
+        del self.users[old]
+        user.nick = nick
+        self.users[new] = user
+        for key in told:
+            self.users[new if key == old else key].send(prefix, 'NICK', nick)
+
+    def names(self, user, name):
+        channel = self.channels.get(lower(name))
+        if channel:
+            nicks = [channel.prefixed(key, self.users[key]) for key in channel.members]
+            # keep replies under the line limit
+            for n in xrange(0, len(nicks), 40):
+                user.conn.numeric('353', '=', channel.name, ' '.join(nicks[n:n + 40]))
+        user.conn.numeric('366', name, 'End of /NAMES list')
+
+    def mode(self, channel, user, modes, args):
+        adding, applied, applied_args = True, [], []
+        args = list(args)
+        for mode in modes:
+            if mode in '+-':
+                adding = mode == '+'
+            elif mode in 'ov':
+                if not args:
+                    break
+                target = args.pop(0)
+                key = lower(target)
+                if key in channel.members:
+                    current = channel.members[key].replace(mode, '')
+                    channel.members[key] = current + mode if adding else current
+                    applied.append(('+' if adding else '-') + mode)
+                    applied_args.append(self.users[key].nick)
+            elif mode in 'bkl' and args:
+                args.pop(0)
+        if applied:
+            self.broadcast(channel, user.prefix(), 'MODE', channel.name, ''.join(applied), *applied_args)
+
+    # simulated users
+    def populate(self, users, channels, per_channel, seed=1):
+        """fills channels with simulated users, each channel gets per_channel of them"""
+        rng = random.Random(seed)
+        names = ['#chan%d' % n for n in xrange(channels)]
+        for n in xrange(users):
+            user = User('sim%d' % n, 's%d' % n, 'sim%d.bench' % (n % 1000), 'simulated user %d' % n)
+            self.users[lower(user.nick)] = user
+            self.simulated.append(user)
+        for name in names:
+            for user in rng.sample(self.simulated, min(per_channel, users)):
+                self.join(user, name)
+
+    def chatter(self, rate, seed=2):
+        """simulated users say rate lines a second in their channels"""
+        rng = random.Random(seed)
+        words = ('ya', 'muse', 'cool', 'lol', 'what', 'is', 'this', 'chii', 'haha', 'no', 'way', '.face', 'trout')
+        def talk():
+            for n in xrange(int(rate / 10.0) or 1):
+                user = rng.choice(self.simulated)
+                if user.channels:
+                    channel = self.channels[rng.choice(list(user.channels))]
+                    self.broadcast(channel, user.prefix(), 'PRIVMSG', channel.name, ' '.join(rng.sample(words, rng.randint(1, 6))))
+                    self.stats['chatter'] += 1
+        LoopingCall(talk).start(0.1)
+
+    def netsplit(self, fraction, downtime, seed=3):
+        """splits fraction of the simulated users off, they rejoin after downtime"""
+        rng = random.Random(seed)
+        split = rng.sample([x for x in self.simulated if lower(x.nick) in self.users], int(len(self.simulated) * fraction))
+        rejoin = [(user, [self.channels[x].name for x in user.channels]) for user in split]
+        for user in split:
+            self.quit(user, '*.net *.split')
+        self.stats['netsplits'] += 1
+        def heal():
+            for user, channels in rejoin:
+                self.users[lower(user.nick)] = user
+                for name in channels:
+                    self.join(user, name)
+        reactor.callLater(downtime, heal)
+
+    def report(self):
+        print '[%s] connections %d, users %d, channels %d, lines in %d, out %d, flood kills %d, netsplits %d' % (
+            time.strftime('%H:%M:%S'), self.stats['connections'], len(self.users), len(self.channels), self.stats['lines_in'],
+            self.stats['lines_out'], self.stats['flood_kills'], self.stats['netsplits'])
+        sys.stdout.flush()
+
+def main():
+    parser = argparse.ArgumentParser(description='small irc server for benchmarks')
+    parser.add_argument('--port', type=int, default=6667)
+    parser.add_argument('--interface', default='127.0.0.1')
+    parser.add_argument('--flood-rate', type=float, default=1.0, help='lines a second a client may send')
+    parser.add_argument('--flood-burst', type=int, default=5, help='lines a client may send at once')
+    parser.add_argument('--flood-queue', type=int, default=20, help='held back lines before a client is killed for excess flood')
+    parser.add_argument('--autojoin', action='append', default=[], help='nick to put in every channel when it registers')
+    parser.add_argument('--users', type=int, default=0, help='simulated users')
+    parser.add_argument('--channels', type=int, default=0, help='channels to put simulated users in')
+    parser.add_argument('--users-per-channel', type=int, default=40)
+    parser.add_argument('--chatter', type=float, default=0, help='lines a second simulated users say')
+    parser.add_argument('--netsplit-every', type=float, default=0, help='seconds between netsplits')
+    parser.add_argument('--netsplit-fraction', type=float, default=0.3, help='share of simulated users a netsplit takes')
+    parser.add_argument('--netsplit-downtime', type=float, default=10)
+    parser.add_argument('--report', type=float, default=10, help='seconds between stats lines')
+    args = parser.parse_args()
+
+    server = IRCServer(args.flood_rate, args.flood_burst, args.flood_queue, args.autojoin)
+    if args.users and args.channels:
+        server.populate(args.users, args.channels, args.users_per_channel)
+        if args.chatter:
+            reactor.callWhenRunning(server.chatter, args.chatter)
+        if args.netsplit_every:
+            LoopingCall(server.netsplit, args.netsplit_fraction, args.netsplit_downtime).start(args.netsplit_every, now=False)
+    reactor.listenTCP(args.port, server, interface=args.interface)
+    LoopingCall(server.report).start(args.report, now=False)
+    reactor.addSystemEventTrigger('before', 'shutdown', server.report)
+    print 'listening on %s:%d' % (args.interface, args.port)
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
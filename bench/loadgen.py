@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""Drives fake irc clients at a server chii is on and measures how chii keeps
+up: command to reply latency, lost replies, disconnects and flood kills.
+
+    python bench/ircd.py --autojoin chii &
+    python chii.py   # with server localhost, port 6667
+    python bench/loadgen.py --clients 200 --rate 0.5 --duration 60
+    python bench/loadgen.py --clients 500 --join-storm --netsplit-every 20
+
+Clients join --channels-per-client of --channels channels, either all at once
+(--join-storm) or spread over --connect-rate connections a second, then say
+--rate lines a second each. --command-ratio of those lines are commands with
+a token only the reply can contain, '.face lg123' comes back as "hahah
+lg123's face", and a command with no reply after --timeout seconds is lost.
+--netsplit-every drops --netsplit-fraction of the clients at once and
+reconnects them after --netsplit-downtime, like a netsplit would."""
+import argparse, random, re, sys, time
+from collections import defaultdict, deque
+
+try:
+    from twisted.internet import epollreactor
+    epollreactor.install()
+except Exception:
+    pass
+from twisted.internet import protocol, reactor
+from twisted.internet.task import LoopingCall
+from twisted.words.protocols import irc
+
+WORDS = ('ya', 'muse', 'the', 'best', 'cool', 'lol', 'what', 'is', 'this', 'chii', 'haha', 'no', 'way', 'trout', 'ok')
+TOKEN = re.compile(r'\blg(\d+)\b')
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+class FakeClient(irc.IRCClient):
+    # the server's flood limits are what's being tested, don't hide from them
+    lineRate = None
+
+    def connectionMade(self):
+        self.nickname = self.factory.nick(self.index)
+        self.talking = self.starting = None
+        self.killed = False
+        irc.IRCClient.connectionMade(self)
+
+    def signedOn(self):
+        self.factory.stats['signed_on'] += 1
+        for channel in self.channels:
+            self.join(channel)
+        if self.factory.rate:
+            # don't all talk in step
+            self.talking = LoopingCall(self.talk)
+            self.starting = reactor.callLater(random.random() / self.factory.rate, self.talking.start, 1.0 / self.factory.rate)
+
+    def talk(self):
+        self.factory.say(self, random.choice(self.channels))
+
+    def privmsg(self, user, channel, message):
+        if user.split('!', 1)[0].lower() == self.factory.bot:
+            self.factory.replied(message)
+
+    def irc_ERROR(self, prefix, params):
+        if params and 'Excess Flood' in params[-1]:
+            self.killed = True
+
+    def irc_ERR_NICKNAMEINUSE(self, prefix, params):
+        self.factory.stats['nick_collisions'] += 1
+        irc.IRCClient.irc_ERR_NICKNAMEINUSE(self, prefix, params)
+
+    def connectionLost(self, reason):
+        irc.IRCClient.connectionLost(self, reason)
+        if self.starting and self.starting.active():
+            self.starting.cancel()
+        if self.talking and self.talking.running:
+            self.talking.stop()
+        self.factory.lost(self)
+
+class LoadGenerator(protocol.ClientFactory):
+    protocol = FakeClient
+
+    def __init__(self, args):
+        self.args = args
+        self.bot = args.bot.lower()
+        self.rate = args.rate
+        self.channels = ['#chan%d' % n for n in xrange(args.channels)]
+        self.clients = {}
+        self.splitting = set()
+        # indexes of clients still connecting, whichever connects first takes the first
+        self.connecting = deque()
+        self.stats = defaultdict(int)
+        # token -> time the command was sent
+        self.waiting = {}
+        self.latencies = []
+        self.tokens = 0
+        self.rng = random.Random(args.seed)
+
+    def nick(self, index):
+        return '%s%d' % (self.args.prefix, index)
+
+    def connect(self, index):
+        reactor.connectTCP(self.args.host, self.args.port, self)
+        self.stats['connects'] += 1
+        self.connecting.append(index)
+
+    def buildProtocol(self, addr):
+        client = protocol.ClientFactory.buildProtocol(self, addr)
+        client.index = self.connecting.popleft()
+        client.channels = self.rng.sample(self.channels, min(self.args.channels_per_client, len(self.channels)))
+        self.clients[client.index] = client
+        return client
+
+    def say(self, client, channel):
+        if self.rng.random() < self.args.command_ratio:
+            self.tokens += 1
+            self.waiting[self.tokens] = time.time()
+            client.msg(channel, '.face lg%d' % self.tokens)
+            self.stats['commands'] += 1
+        else:
+            client.msg(channel, ' '.join(self.rng.sample(WORDS, self.rng.randint(1, 8))))
+        self.stats['sent'] += 1
+
+    def replied(self, message):
+        match = TOKEN.search(message)
+        sent = match and self.waiting.pop(int(match.group(1)), None)
+        if sent:
+            self.latencies.append(time.time() - sent)
+            self.stats['replies'] += 1
+
+    def expire(self):
+        cutoff = time.time() - self.args.timeout
+        for token in [x for x, sent in self.waiting.iteritems() if sent < cutoff]:
+            del self.waiting[token]
+            self.stats['lost'] += 1
+
+    def lost(self, client):
+        self.clients.pop(client.index, None)
+        if client.killed:
+            self.stats['flood_kills'] += 1
+        elif client.index in self.splitting:
+            self.splitting.discard(client.index)
+        else:
+            self.stats['disconnects'] += 1
+
+    def clientConnectionFailed(self, connector, reason):
+        self.connecting.popleft()
+        self.stats['connect_failures'] += 1
+
+    def netsplit(self):
+        split = self.rng.sample(self.clients.values(), int(len(self.clients) * self.args.netsplit_fraction))
+        for client in split:
+            self.splitting.add(client.index)
+            client.quit('*.net *.split')
+        self.stats['netsplits'] += 1
+        reactor.callLater(self.args.netsplit_downtime, self.reconnect, [x.index for x in split])
+
+    def reconnect(self, indexes):
+        if self.args.join_storm:
+            for index in indexes:
+                self.connect(index)
+        else:
+            self.ramp(indexes)
+
+    def ramp(self, indexes):
+        delay = 1.0 / self.args.connect_rate
+        for n, index in enumerate(indexes):
+            reactor.callLater(n * delay, self.connect, index)
+
+    def report(self, final=False):
+        self.expire()
+        stats = self.stats
+        print '[%s] clients %d, sent %d, commands %d, replies %d, lost %d, p50 %.0fms, p90 %.0fms, p99 %.0fms, max %.0fms, disconnects %d, flood kills %d' % (
+            time.strftime('%H:%M:%S'), len(self.clients), stats['sent'], stats['commands'], stats['replies'], stats['lost'],
+            percentile(self.latencies, 0.5) * 1000, percentile(self.latencies, 0.9) * 1000, percentile(self.latencies, 0.99) * 1000,
+            max(self.latencies or [0]) * 1000, stats['disconnects'], stats['flood_kills'])
+        if final:
+            print 'connects %d, connect failures %d, nick collisions %d, netsplits %d, still waiting %d' % (
+                stats['connects'], stats['connect_failures'], stats['nick_collisions'], stats['netsplits'], len(self.waiting))
+        sys.stdout.flush()
+
+def main():
+    parser = argparse.ArgumentParser(description='drives fake irc clients at chii')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6667)
+    parser.add_argument('--bot', default='chii', help="chii's nick")
+    parser.add_argument('--prefix', default='lg', help='nick prefix for clients')
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--connect-rate', type=float, default=20, help='connections a second while ramping up')
+    parser.add_argument('--join-storm', action='store_true', help='connect every client at once')
+    parser.add_argument('--channels', type=int, default=5)
+    parser.add_argument('--channels-per-client', type=int, default=1)
+    parser.add_argument('--rate', type=float, default=0.2, help='lines a second each client says')
+    parser.add_argument('--command-ratio', type=float, default=0.3, help='share of lines which are commands')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds before a command without a reply is lost')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to run for')
+    parser.add_argument('--netsplit-every', type=float, default=0, help='seconds between netsplits')
+    parser.add_argument('--netsplit-fraction', type=float, default=0.3)
+    parser.add_argument('--netsplit-downtime', type=float, default=5)
+    parser.add_argument('--report', type=float, default=10, help='seconds between stats lines')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    generator = LoadGenerator(args)
+    generator.reconnect(range(args.clients))
+    if args.netsplit_every:
+        LoopingCall(generator.netsplit).start(args.netsplit_every, now=False)
+    LoopingCall(generator.report).start(args.report, now=False)
+    reactor.addSystemEventTrigger('before', 'shutdown', generator.report, True)
+    reactor.callLater(args.duration, reactor.stop)
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+"""Times chii's hot functions on fixed inputs and reports how they scale:
+permission checks against the number of role rules, markov brains against
+the number of lines they've learned, and so on.
+
+    python bench/micro.py
+    python bench/micro.py --bench check_permission --bench markov_generate
+    python bench/micro.py --brain-max 10000000 --samples 3
+    python bench/micro.py --save            # writes bench/micro.json
+    python bench/micro.py --compare         # against bench/micro.json
+
+Every benchmark runs once per parameter, each in a fresh process. Loops are
+calibrated until a sample takes --min-time, which doubles as the warmup, then
+--samples samples give the mean and stdev per operation. Points where a single
+loop takes over SINGLE_SHOT seconds, like learning the biggest brains, are only
+timed once. Memory is the growth in max rss and gc tracked objects over
+setting up and running the benchmark, for markov_generate that's what the brain
+costs. Inputs come from seeded rngs, so numbers from different runs and
+machines are comparable with --compare."""
+import argparse, gc, imp, json, math, new, os, random, resource, subprocess, sys, tempfile, time
+from collections import OrderedDict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(ROOT, 'bench', 'micro.json')
+
+BRAIN_SIZES = (10000, 100000, 1000000, 10000000)
+RULE_COUNTS = (1, 10, 100, 1000)
+# seconds a single loop can take before its point is only timed once
+SINGLE_SHOT = 10.0
+
+BENCHES = OrderedDict()
+
+def bench(params=(None,)):
+    """registers a benchmark. It's called with a parameter and returns
+       (run, ops), run(loops) does loops * ops operations and returns the
+       seconds they took"""
+    def decorator(func):
+        BENCHES[func.__name__] = (func, params)
+        return func
+    return decorator
+
+def looped(func, inputs):
+    """returns run calling func with every input, once per loop"""
+    def run(loops):
+        timer = time.time
+        start = timer()
+        for x in xrange(loops):
+            for args in inputs:
+                func(*args)
+        return timer() - start
+    return run, len(inputs)
+
+def chii_bot(rules=1):
+    """returns a ChiiBot with admins rules to check, the last one matches
+       every userN!uN@hostN.example"""
+    import chii
+    config = chii.ChiiConfig(os.path.join(tempfile.mkdtemp(), 'bot.config'))
+    admins = ['*!*@admin%d.example' % n for n in xrange(rules - 1)] + ['user*!*@host*.example']
+    config.update({'user_roles': {'admins': admins, 'owners': ['zk!is@whatit.is']}, 'threaded': False})
+    config._refresh()
+
+    class Bot(chii.ChiiBot):
+        def _dispatch(self, job_class, func, *args):
+            pass
+
+    Bot.config = config
+    Bot.nickname = 'chii'
+    return Bot()
+
+def users(count, seed=1):
+    """returns (nick, host) of count users, half of them admins"""
+    rng = random.Random(seed)
+    result = []
+    for n in xrange(count):
+        if rng.random() < 0.5:
+            result.append(('user%d' % n, 'u%d@host%d.example' % (n, n % 97)))
+        else:
+            result.append(('guest%d' % n, 'g%d@somewhere%d.net' % (n, n % 97)))
+    return result
+
+def brain_lines(count, seed=1, vocabulary=50000):
+    """returns count made up lines with zipf-ish word frequencies, so brains
+       have a realistic mix of common and rare successors"""
+    rng = random.Random(seed)
+    words = ['w%d' % n for n in xrange(vocabulary)]
+    pick = lambda: words[min(int(rng.paretovariate(1.1)) - 1, vocabulary - 1)]
+    return [' '.join(pick() for x in xrange(rng.randint(3, 15))) for n in xrange(count)]
+
+def retard(path):
+    """imports a fresh copy of commands/retard.py learning into path"""
+    import chii
+    chii.config['retard_brain'] = path
+    return imp.load_source('retard_%d' % random.getrandbits(32), os.path.join(ROOT, 'commands', 'retard.py'))
+
+def quoth():
+    quoth_dir = os.path.join(ROOT, 'quoth')
+    if quoth_dir not in sys.path:
+        sys.path.insert(0, quoth_dir)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+
+QUOTES = [
+    '<zk> ya muse',
+    '[@xaimus] the best <anders> cool lol [chii] what is this',
+    ' '.join('<nick%d> line number %d of a long quote & some <b>markup</b>' % (n % 7, n) for n in xrange(40)),
+]
+
+### benchmarks ###
+@bench(RULE_COUNTS)
+def check_permission(rules):
+    """cold: the per nick cache is cleared every loop, so every check matches
+       the compiled hostmasks"""
+    bot = chii_bot(rules)
+    inputs = [('admins', nick, host) for nick, host in users(1000)]
+    bot._check_permission(*inputs[0])
+    def run(loops):
+        timer = time.time
+        check, cache = bot._check_permission, bot.roles.cache
+        start = timer()
+        for x in xrange(loops):
+            cache.clear()
+            for args in inputs:
+                check(*args)
+        return timer() - start
+    return run, len(inputs)
+
+@bench(RULE_COUNTS)
+def check_permission_cached(rules):
+    bot = chii_bot(rules)
+    return looped(bot._check_permission, [('admins', nick, host) for nick, host in users(1000)])
+
+@bench()
+def handle_command(param):
+    """parses and looks up commands, checks permissions and gates on module
+       readiness. Dispatch itself is left out"""
+    import chii
+    bot = chii_bot(10)
+    def respond(self, channel, nick, host, *args):
+        pass
+    commands = {}
+    for n in xrange(100):
+        restrict = 'admins' if n % 10 == 0 else None
+        method = chii.command('cmd%d' % n, restrict=restrict)(respond)
+        commands['cmd%d' % n] = new.instancemethod(method, bot, chii.ChiiBot)
+    bot.__class__.commands = commands
+    rng = random.Random(1)
+    inputs = []
+    for nick, host in users(1000):
+        msg = '.cmd%d %s' % (rng.randrange(120), ' '.join('arg%d' % x for x in xrange(rng.randrange(8))))
+        inputs.append(('#chan', nick, host, msg))
+    return looped(bot._handle_command, inputs)
+
+@bench(BRAIN_SIZES)
+def markov_add(size):
+    """learns size lines into an empty brain, every sample starts over"""
+    directory = tempfile.mkdtemp()
+    lines = brain_lines(size)
+    def run(loops):
+        elapsed = 0
+        for x in xrange(loops):
+            module = retard(os.path.join(directory, 'brain'))
+            add = module.markov_chain.add_to_brain
+            start = time.time()
+            for line in lines:
+                add(line)
+            elapsed += time.time() - start
+            del module, add
+            gc.collect()
+        return elapsed
+    return run, size
+
+@bench(BRAIN_SIZES)
+def markov_generate(size):
+    module = retard(os.path.join(tempfile.mkdtemp(), 'brain'))
+    for line in brain_lines(size):
+        module.markov_chain.add_to_brain(line)
+    rng = random.Random(2)
+    prompts = [('w%d w%d w%d' % (rng.randrange(50), rng.randrange(50), rng.randrange(500)),) for x in xrange(100)]
+    run, ops = looped(module.markov_chain.generate_sentence, prompts)
+    def seeded(loops):
+        random.seed(3)
+        return run(loops)
+    return seeded, ops
+
+@bench()
+def format_quote(param):
+    quoth()
+    from quotes.templatetags.filters import format_quote
+    return looped(format_quote, [(x,) for x in QUOTES])
+
+@bench()
+def reformat_quote(param):
+    quoth()
+    from filters import reformat_quote
+    return looped(reformat_quote, [(x,) for x in QUOTES])
+
+@bench((1, 5))
+def logger_log(lines):
+    """time the reactor spends handing lines of a message to the writer
+       thread, which gets to catch up between samples"""
+    import chii
+    config = chii.ChiiConfig(os.path.join(tempfile.mkdtemp(), 'bot.config'))
+    config.update({'logs_dir': tempfile.mkdtemp(), 'log_channels': True, 'log_chii': False})
+    logger = chii.ChiiLogger(config)
+    message = '\n'.join('<zk> ya muse, line %d' % n for n in xrange(lines))
+    inputs = [(message, '#chan%d' % (n % 20)) for n in xrange(1000)]
+    run, ops = looped(logger.log, inputs)
+    def flushed(loops):
+        elapsed = run(loops)
+        logger.flush()
+        return elapsed
+    return flushed, ops
+
+@bench(('set', 'default', 'missing', 'snapshot'))
+def config_getitem(kind):
+    """'set' is in the config file, 'default' falls back to defaults and
+       'missing' is neither. 'snapshot' is the same lookup on config.snapshot"""
+    import chii
+    config = chii.ChiiConfig(os.path.join(tempfile.mkdtemp(), 'bot.config'))
+    config.update({'nickname': 'chii', 'threaded': True, 'cmd_prefix': '.'})
+    config._refresh()
+    keys = {'set': ('nickname', 'threaded', 'cmd_prefix'),
+            'default': ('flood_rate', 'logs_dir', 'max_queue'),
+            'missing': ('nope', 'nada', 'zilch'),
+            'snapshot': ('nickname', 'flood_rate', 'nope')}[kind]
+    if kind == 'snapshot':
+        return looped(config.snapshot.__getitem__, [(x,) for x in keys] * 100)
+    return looped(config.__getitem__, [(x,) for x in keys] * 100)
+
+### running ###
+def measure(name, param, samples, min_time):
+    """one benchmark point in this process, returns its results"""
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    func, params = BENCHES[name]
+    gc.collect()
+    objects, rss = len(gc.get_objects()), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    run, ops = func(param)
+    loops = 1
+    while True:
+        # calibrating doubles as the warmup
+        elapsed = run(loops)
+        if elapsed >= min_time or loops >= 1 << 24:
+            break
+        loops *= 2 if elapsed * 10 > min_time else 10
+    if loops == 1 and elapsed >= SINGLE_SHOT:
+        # too slow to sample, the calibration run is the only one
+        times = [elapsed / ops]
+    else:
+        times = [run(loops) / (loops * ops) for x in xrange(samples)]
+    mean = sum(times) / len(times)
+    gc.collect()
+    return {
+        'loops': loops,
+        'samples': len(times),
+        'ops': ops,
+        'mean': mean,
+        'stdev': math.sqrt(sum((x - mean) ** 2 for x in times) / max(len(times) - 1, 1)),
+        'objects': len(gc.get_objects()) - objects,
+        'rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss,
+    }
+
+def spawn(name, param, samples, min_time):
+    """runs a benchmark point in a fresh process, returns its results"""
+    spec = json.dumps({'name': name, 'param': param, 'samples': samples, 'min_time': min_time})
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--run', spec], stdout=subprocess.PIPE, cwd=ROOT)
+    out = child.communicate()[0].strip().splitlines()
+    if child.returncode or not out:
+        raise RuntimeError('benchmark %s failed' % spec)
+    return json.loads(out[-1])
+
+def key(result):
+    if result['param'] is None:
+        return result['name']
+    return '%s[%s]' % (result['name'], result['param'])
+
+def fmt_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e3), ('us', 1e6)):
+        if seconds >= 1 / scale:
+            return '%.2f %s' % (seconds * scale, unit)
+    return '%.0f ns' % (seconds * 1e9)
+
+def show(results, baseline=None):
+    print '%-36s %12s %8s %10s %10s %8s' % ('benchmark', 'per op', 'stdev', 'objects', 'rss kb', 'scaling')
+    previous = None
+    for result in results:
+        # growth exponent of the time per op since the last point of the same
+        # benchmark, 0.0 is flat and 1.0 is linear
+        scaling = ''
+        if previous and previous['name'] == result['name'] and isinstance(result['param'], (int, long)) and previous['mean']:
+            scaling = 'n^%.2f' % (math.log(result['mean'] / previous['mean']) / math.log(float(result['param']) / previous['param']))
+        print '%-36s %12s %7.1f%% %10d %10d %8s' % (key(result), fmt_time(result['mean']), result['stdev'] * 100 / (result['mean'] or 1),
+                                                    result['objects'], result['rss_kb'], scaling)
+        before = (baseline or {}).get(key(result))
+        if before:
+            change = lambda name: (result[name] - before[name]) * 100.0 / (before[name] or 1)
+            print '%-36s %+11.1f%% %8s %+9.1f%% %+9.1f%%' % ('  vs baseline', change('mean'), '', change('objects'), change('rss_kb'))
+        previous = result
+
+def main():
+    parser = argparse.ArgumentParser(description="times chii's hot functions")
+    parser.add_argument('--bench', action='append', choices=BENCHES.keys(), help='benchmark to run, can be given more than once, defaults to all')
+    parser.add_argument('--samples', type=int, default=5, help='timed samples per benchmark point')
+    parser.add_argument('--min-time', type=float, default=0.1, help='seconds a sample should take at least')
+    parser.add_argument('--brain-max', type=int, default=1000000, help='largest brain to benchmark markov chains with')
+    parser.add_argument('--save', nargs='?', const=BASELINE, help='save results as a baseline, bench/micro.json by default')
+    parser.add_argument('--compare', nargs='?', const=BASELINE, help='compare results with a saved baseline, bench/micro.json by default')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        spec = json.loads(args.run)
+        print json.dumps(measure(spec['name'], spec['param'], spec['samples'], spec['min_time']))
+        return
+
+    results = []
+    for name in args.bench or BENCHES:
+        for param in BENCHES[name][1]:
+            if name.startswith('markov') and param > args.brain_max:
+                continue
+            result = spawn(name, param, args.samples, args.min_time)
+            result.update({'name': name, 'param': param})
+            results.append(result)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    show(results, baseline)
+    if args.save:
+        saved = {}
+        if os.path.exists(args.save):
+            # running a few benchmarks only updates their points
+            with open(args.save) as f:
+                saved = json.load(f)
+        saved.update((key(x), x) for x in results)
+        with open(args.save, 'w') as f:
+            json.dump(saved, f, indent=1, sort_keys=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+"""Replays irc traffic through ChiiProto.dataReceived and reports how much of
+it chii can take: lines per second, p50/p99 latency per line, outbound lines
+and how many objects and how much memory it costs.
+
+    python bench/replay.py --log logs/chiisadventure.log
+    python bench/replay.py --lines 50000 --threaded both --plugins none --plugins commands,events
+    python bench/replay.py --save bench/replay.json
+    python bench/replay.py --compare bench/replay.json
+
+Lines come from channel logs, or are made up when no logs are given. Every
+run is a fresh process with its own reactor, an in-memory transport and a
+task.Clock for flood control. The clock moves on by the time between logged
+lines, or 1/rate for made up ones. A line's latency lasts until every job it
+dispatched is done, so threaded runs include time spent queued."""
+import argparse, gc, json, os, random, re, resource, subprocess, sys, tempfile, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LOG_LINE = re.compile(r'^\[(\d\d):(\d\d):(\d\d)\] (?:<([^>]+)> (.*)|\* (\S+) (.*))$')
+
+WORDS = ('ya', 'muse', 'the', 'best', 'cool', 'lol', 'what', 'is', 'this', 'chii', 'anders', 'xaimus',
+         'haha', 'no', 'way', 'did', 'you', 'see', 'that', 'trout', 'ok', 'sure', 'why', 'not')
+COMMANDS = ('.face bob', '.face bob + cheese', '.help', '.help face', '.say hi', '.last', '.directions here -> there',
+            '.whois bob', '.stats', '.lambchops')
+
+def log_lines(paths):
+    """returns (delay, line) of every message in channel logs, the channel is
+       the log's name"""
+    lines, last = [], None
+    for path in paths:
+        channel = '#' + os.path.basename(path).split('.', 1)[0]
+        with open(path) as f:
+            for entry in f:
+                match = LOG_LINE.match(entry.rstrip('\n'))
+                if not match:
+                    continue
+                h, m, s, nick, msg, actor, action = match.groups()
+                seconds = int(h) * 3600 + int(m) * 60 + int(s)
+                delay = max(seconds - last, 0) if last is not None else 0
+                last = seconds
+                if nick:
+                    line = ':%s!%s@replay PRIVMSG %s :%s' % (nick, nick, channel, msg)
+                else:
+                    line = ':%s!%s@replay PRIVMSG %s :\x01ACTION %s\x01' % (actor, actor, channel, action)
+                lines.append((delay, line))
+    return lines
+
+def synthetic_lines(count, channels, users, rate, seed):
+    """returns (delay, line) of count made up lines: chat, commands, actions,
+       joins and parts spread over channels"""
+    rng = random.Random(seed)
+    lines = []
+    for n in xrange(count):
+        user = rng.randrange(users)
+        prefix = ':user%d!u%d@host%d.example' % (user, user, user % 97)
+        channel = '#chan%d' % rng.randrange(channels)
+        kind = rng.random()
+        if kind < 0.7:
+            line = '%s PRIVMSG %s :%s' % (prefix, channel, ' '.join(rng.choice(WORDS) for x in xrange(rng.randint(1, 12))))
+        elif kind < 0.85:
+            line = '%s PRIVMSG %s :%s' % (prefix, channel, rng.choice(COMMANDS))
+        elif kind < 0.9:
+            line = '%s PRIVMSG %s :\x01ACTION slaps chii around a bit with a large trout\x01' % (prefix, channel)
+        elif kind < 0.95:
+            line = '%s JOIN %s' % (prefix, channel)
+        else:
+            line = '%s PART %s :bye' % (prefix, channel)
+        lines.append((1.0 / rate, line))
+    return lines
+
+def plugin_config(plugins):
+    """returns modules and disabled_modules loading just plugins, which are
+       packages or package.module"""
+    if plugins == 'none':
+        return [], []
+    packages, wanted = [], set()
+    for plugin in plugins.split(','):
+        package, _, module = plugin.partition('.')
+        if package not in packages:
+            packages.append(package)
+        if module:
+            wanted.add((package, module))
+    disabled = []
+    for package in packages:
+        picked = set(x[1] for x in wanted if x[0] == package)
+        if picked:
+            disabled.extend(f[:-3] for f in os.listdir(os.path.join(ROOT, package))
+                            if f.endswith('.py') and f != '__init__.py' and f[:-3] not in picked)
+    return packages, disabled
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+def run(spec):
+    """one run in this process, prints its results as json on the last line"""
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    import chii
+    from chii import ChiiProto, ChiiLogger, ChiiDispatcher
+    from twisted.internet import reactor, defer, task
+    from twisted.test import proto_helpers
+
+    with open(spec['lines']) as f:
+        lines = json.load(f)
+    config = chii.config
+    modules, disabled = plugin_config(spec['plugins'])
+    config.update({'modules': modules, 'disabled_modules': disabled, 'threaded': spec['threaded'], 'watch_modules': False,
+                   'lazy_modules': False, 'manifest_file': None, 'logs_dir': spec['logs_dir'] or '',
+                   'log_channels': bool(spec['logs_dir']), 'log_stdout': False, 'metrics_port': None})
+    config._refresh()
+
+    class ReplayProto(ChiiProto):
+        clock = task.Clock()
+        jobs = None
+
+        def _dispatch(self, job_class, func, *args):
+            d = ChiiProto._dispatch(self, job_class, func, *args)
+            if self.jobs is not None:
+                self.jobs.append(d)
+            return d
+
+    ReplayProto.config = config
+    ReplayProto.nickname = 'chii'
+    ReplayProto.logger = ChiiLogger(config)
+    if spec['threaded']:
+        ReplayProto.dispatcher = ChiiDispatcher(config)
+        ReplayProto.dispatcher.start()
+    proto = ReplayProto()
+    proto.factory = None
+    transport = proto_helpers.StringTransport()
+    proto.makeConnection(transport)
+
+    latencies, waiting = [], []
+    def finished(result, start):
+        latencies.append(time.time() - start)
+
+    def feed():
+        for delay, line in lines:
+            ReplayProto.clock.advance(delay)
+            proto.jobs = []
+            start = time.time()
+            proto.dataReceived(line + '\r\n')
+            if proto.jobs:
+                waiting.append(defer.DeferredList(proto.jobs, consumeErrors=True).addCallback(finished, start))
+            else:
+                latencies.append(time.time() - start)
+            proto.jobs = None
+            yield None
+
+    def report(result):
+        seconds = time.time() - state['started']
+        # let flood control send everything it's holding back
+        while proto.outbound.pending and proto.outbound.pending.active():
+            ReplayProto.clock.advance(max(proto.outbound.pending.getTime() - ReplayProto.clock.seconds(), 0) + 0.001)
+        gc.collect()
+        results.update({
+            'lines': len(lines),
+            'seconds': seconds,
+            'lines_per_second': len(lines) / seconds,
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'outbound_lines': transport.value().count('\r\n'),
+            'outbound_dropped': proto.outbound.counters['dropped'],
+            'objects': len(gc.get_objects()) - state['objects'],
+            'rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - state['rss'],
+        })
+        reactor.stop()
+
+    def start():
+        for channel in sorted(set(x[1].split(' ')[2] for x in lines if ' PRIVMSG #' in x[1] or ' JOIN #' in x[1])):
+            proto.dataReceived(':chii!chii@replay JOIN %s\r\n' % channel)
+        transport.clear()
+        gc.collect()
+        state.update(objects=len(gc.get_objects()), rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, started=time.time())
+        done = task.cooperate(feed()).whenDone()
+        done.addCallback(lambda x: defer.DeferredList(waiting))
+        done.addCallback(report)
+        done.addErrback(lambda f: (f.printTraceback(), reactor.stop()))
+
+    results, state = {}, {}
+    # give load events and inits a moment
+    reactor.callLater(0.5, start)
+    reactor.run()
+    print json.dumps(results)
+
+def spawn(spec):
+    """runs spec in a fresh process, returns its results"""
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--run', json.dumps(spec)],
+                             stdout=subprocess.PIPE, cwd=ROOT)
+    out = child.communicate()[0].strip().splitlines()
+    if child.returncode or not out:
+        raise RuntimeError('run %s failed' % json.dumps(spec))
+    return json.loads(out[-1])
+
+def key(result):
+    return '%s threaded=%s' % (result['plugins'], result['threaded'])
+
+def show(results, baseline=None):
+    print '%-36s %10s %8s %8s %8s %8s %9s %8s' % ('run', 'lines/s', 'p50 ms', 'p99 ms', 'out', 'dropped', 'objects', 'rss kb')
+    for result in results:
+        print '%-36s %10.0f %8.3f %8.3f %8d %8d %9d %8d' % (key(result), result['lines_per_second'], result['p50_ms'], result['p99_ms'],
+                                                            result['outbound_lines'], result['outbound_dropped'], result['objects'], result['rss_kb'])
+        before = (baseline or {}).get(key(result))
+        if before:
+            change = lambda name: (result[name] - before[name]) * 100.0 / (before[name] or 1)
+            print '%-36s %+9.1f%% %+7.1f%% %+7.1f%%' % ('  vs baseline', change('lines_per_second'), change('p50_ms'), change('p99_ms'))
+
+def main():
+    parser = argparse.ArgumentParser(description='replays irc traffic through chii')
+    parser.add_argument('--log', action='append', default=[], help='channel log to replay, can be given more than once')
+    parser.add_argument('--lines', type=int, default=20000, help='made up lines to replay without logs')
+    parser.add_argument('--channels', type=int, default=20, help='channels made up lines go to')
+    parser.add_argument('--users', type=int, default=500, help='users made up lines come from')
+    parser.add_argument('--rate', type=float, default=20.0, help='made up lines per second of clock time')
+    parser.add_argument('--seed', type=int, default=1, help='seed for made up lines')
+    parser.add_argument('--threaded', choices=('on', 'off', 'both'), default='both')
+    parser.add_argument('--plugins', action='append', help="comma separated packages or package.modules to load, 'none' for none. Can be given more than once, defaults to none and commands,events,tasks")
+    parser.add_argument('--logs-dir', help='log channels to this directory while replaying')
+    parser.add_argument('--save', help='save results as a baseline')
+    parser.add_argument('--compare', help='compare results with a saved baseline')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        return run(json.loads(args.run))
+
+    lines = log_lines(args.log) if args.log else synthetic_lines(args.lines, args.channels, args.users, args.rate, args.seed)
+    if not lines:
+        print 'nothing to replay'
+        return 1
+    fd, path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(lines, f)
+
+    results = []
+    try:
+        for plugins in args.plugins or ['none', 'commands,events,tasks']:
+            for threaded in {'on': [True], 'off': [False], 'both': [False, True]}[args.threaded]:
+                result = spawn({'lines': path, 'plugins': plugins, 'threaded': threaded, 'logs_dir': args.logs_dir})
+                result.update({'plugins': plugins, 'threaded': threaded})
+                results.append(result)
+    finally:
+        os.remove(path)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    show(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(dict((key(x), x) for x in results), f, indent=1, sort_keys=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
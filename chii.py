@@ -1,14 +1,26 @@
 #!/usr/bin/env python
-import argparse, datetime, new, os, sys, time, traceback, zlib
-from fnmatch import fnmatch
-from collections import defaultdict
+import argparse, array, bisect, copy, datetime, hashlib, json, marshal, math, mmap, multiprocessing, new, os, random, re, resource, signal, string, struct, sys, threading, time, traceback, types, zlib
+import cProfile, pstats, Queue, urllib2, urlparse
+from cStringIO import StringIO
+from fnmatch import translate
+from collections import defaultdict, deque, OrderedDict
 
 from twisted.words.protocols import irc
 from twisted.internet import reactor, protocol, defer, threads
 from twisted.internet.task import LoopingCall
-from twisted.python import log
+from twisted.protocols import basic
+from twisted.web.client import Agent, ContentDecoderAgent, FileBodyProducer, GzipDecoder, HTTPConnectionPool, PotentialDataLoss, RedirectAgent, ResponseDone
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+from twisted.web.http_headers import Headers
+from twisted.python import log, failure, threadable, threadpool
 
 import yaml
+try:
+    # libyaml is a lot faster when it's around
+    from yaml import CLoader as YAMLLoader, CDumper as YAMLDumper
+except ImportError:
+    from yaml import Loader as YAMLLoader, Dumper as YAMLDumper
 
 ### config ###
 CONFIG_FILE = 'bot.config'
@@ -25,33 +37,89 @@ class ChiiConfig(dict):
         'server': 'irc.esper.net',
         'port': 6667,
         'channels': ['chiisadventure'],
+        'networks': None,
+        'shards': None,
+        'request_timeout': 30,
+        'request_cache_ttl': 300,
+        'request_cache_size': 1024,
+        'http_timeout': 30,
+        'http_max_size': 1048576,
+        'http_max_per_host': 4,
+        'http_quota': None,
+        'command_cache_size': 512,
+        'command_cache_negative_ttl': 30,
         'cmd_prefix': '.',
         'modules': ['commands', 'events', 'tasks'],
         'owner': 'zk!is@whatit.is',
         'user_roles': {'admins': ['zk!is@whatit.is']},
+        'role_cache_size': 4096,
         'logs_dir': '',
         'log_channels': False,
         'log_privmsg': False,
         'log_chii': False,
         'log_stdout': True,
+        'log_rotate': None,
+        'log_max_files': 64,
+        'log_flush_interval': 1.0,
+        'log_search': False,
         'disabled_modules': [],
         'disabled_commands': [],
         'disabled_events': [],
         'disabled_tasks': [],
+        'watch_modules': True,
+        'lazy_modules': False,
+        'manifest_file': '.chii_manifest',
         'threaded': False,
+        'threads': 4,
+        'max_threads': 16,
+        'max_queue': 256,
+        'queue_latency': 0.5,
+        'processes': None,
+        'process_timeout': 30,
+        'process_max_tasks': 100,
+        'flood_burst': 5,
+        'flood_rate': 1.0,
+        'flood_bytes': None,
+        'flood_max_queue': 100,
+        'config_save_delay': 1.0,
+        'metrics_port': None,
+        'metrics_interface': '127.0.0.1',
+        'profile_interval': 0.01,
+        'task_tick': 1.0,
     }
 
     def __init__(self, file):
         self.file = file
+        self._save_lock = threading.Lock()
+        self._save_timer = None
+        self._pending = None
+        # in shards, saves are handed to sync as changes instead of written
+        self.sync = None
         if os.path.isfile(file):
             with open(file) as f:
-                config = yaml.load(f.read())
-                if config:
-                    try:
-                        for k in config:
-                            self.__setitem__(k, config[k])
-                    except:
-                        pass
+                config = yaml.load(f.read(), Loader=YAMLLoader)
+                if isinstance(config, dict):
+                    super(ChiiConfig, self).update(config)
+        self._synced = copy.deepcopy(dict(self))
+        self._refresh()
+
+    # bumped on every change, so anything derived from config knows when to
+    # rebuild. Values changed in place, like a role's list of hostmasks, only
+    # count once save() is called
+    version = 0
+
+    def _refresh(self):
+        """bumps version and swaps in a new snapshot"""
+        self.version += 1
+        self.snapshot = ConfigSnapshot(self)
+
+    def __setitem__(self, key, value):
+        super(ChiiConfig, self).__setitem__(key, value)
+        self._refresh()
+
+    def __delitem__(self, key):
+        super(ChiiConfig, self).__delitem__(key)
+        self._refresh()
 
     def __getitem__(self, key):
         if self.__contains__(key):
@@ -59,19 +127,126 @@ class ChiiConfig(dict):
         elif key in self.defaults:
             return self.defaults[key]
 
+    network_settings = ('server', 'port', 'ssl', 'nickname', 'realname', 'ident_pass', 'channels')
+
+    def networks(self):
+        """Returns settings of every network to connect to, by name. Networks
+           are listed under networks, anything they don't set comes from the
+           top level. Without networks it's just the top level server."""
+        networks = OrderedDict()
+        for name, settings in sorted((self['networks'] or {}).iteritems()):
+            networks[name] = dict((key, (settings or {}).get(key, self[key])) for key in self.network_settings)
+        if not networks:
+            networks[self['server']] = dict((key, self[key]) for key in self.network_settings)
+        return networks
+
     def save(self):
-        f = open(self.file, 'w')
-        f.write(yaml.dump(dict((key, self.__getitem__(key)) for key in sorted(self.keys())), default_flow_style=False))
-        f.close()
+        """schedules a write of the config. Values nested in lists and dicts
+           may have been changed in place, so the snapshot is rebuilt too.
+           With sync set only what changed since the last save is passed on"""
+        self._refresh()
+        data = copy.deepcopy(dict(self))
+        if self.sync:
+            with self._save_lock:
+                changes = self.changes(self._synced, data)
+                self._synced = data
+            if changes:
+                self.sync(changes)
+            return
+        with self._save_lock:
+            self._pending = data
+            if self._save_timer:
+                self._save_timer.cancel()
+            # not a daemon, so a pending save still happens on exit
+            self._save_timer = threading.Timer(self['config_save_delay'], self.flush)
+            self._save_timer.start()
+
+    def flush(self):
+        """writes pending changes now"""
+        with self._save_lock:
+            data, self._pending = self._pending, None
+            if self._save_timer:
+                self._save_timer.cancel()
+                self._save_timer = None
+            if data is not None:
+                self._write(data)
+
+    @staticmethod
+    def changes(old, new):
+        """returns ('set' or 'del', key path, value) changes from old to new.
+           Dicts are compared a level deeper, so edits to different entries
+           of one, like two lambdas, don't overwrite each other"""
+        changes = []
+        for key in sorted(set(old) | set(new)):
+            if key not in new:
+                changes.append(('del', (key,), None))
+            elif key in old and isinstance(old[key], dict) and isinstance(new[key], dict):
+                for entry in sorted(set(old[key]) | set(new[key])):
+                    if entry not in new[key]:
+                        changes.append(('del', (key, entry), None))
+                    elif entry not in old[key] or old[key][entry] != new[key][entry]:
+                        changes.append(('set', (key, entry), new[key][entry]))
+            elif key not in old or old[key] != new[key]:
+                changes.append(('set', (key,), new[key]))
+        return changes
+
+    def apply(self, changes):
+        """applies changes made elsewhere, see changes"""
+        with self._save_lock:
+            for values in (self, self._synced):
+                for action, path, value in changes:
+                    target = values
+                    if len(path) == 2:
+                        if not isinstance(dict.get(values, path[0]), dict):
+                            dict.__setitem__(values, path[0], {})
+                        target = dict.__getitem__(values, path[0])
+                    if action == 'set':
+                        dict.__setitem__(target, path[-1], copy.deepcopy(value))
+                    else:
+                        dict.pop(target, path[-1], None)
+        self._refresh()
 
     def save_defaults(self):
-        f = open(self.file, 'w')
-        f.write(yaml.dump(dict((key, self.defaults[key]) for key in sorted(self.defaults)), default_flow_style=False))
-        f.close()
+        with self._save_lock:
+            self._write(self.defaults)
+
+    def _write(self, data):
+        """writes data to a temp file and renames it over the config"""
+        tmp = '%s.%d.tmp' % (self.file, os.getpid())
+        with open(tmp, 'w') as f:
+            yaml.dump(dict((key, data[key]) for key in sorted(data)), f, Dumper=YAMLDumper, default_flow_style=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.file)
+
+class ConfigSnapshot(object):
+    """Read-only copy of config with defaults filled in, for lookups on the
+       hot path. Missing keys are None, same as ChiiConfig. Never changes,
+       config swaps in a new one instead."""
+    def __init__(self, config):
+        values = dict(config.defaults)
+        values.update(copy.deepcopy(dict(config)))
+        self.__dict__.update(values)
+        self.__dict__['version'] = config.version
+
+    def __getattr__(self, key):
+        if key.startswith('__'):
+            raise AttributeError(key)
+        return None
+
+    def __setattr__(self, key, value):
+        raise AttributeError('config snapshot is read-only')
+
+    __delattr__ = __setattr__
+
+    def __getitem__(self, key):
+        return self.__dict__.get(key)
 
 ### decorators ###
 def command(*args, **kwargs):
-    """Decorator which adds callable to command registry"""
+    """Decorator which adds callable to command registry. executor 'process'
+       runs it in the process pool, 'reactor' on the reactor even when
+       threaded, for commands adding callbacks to deferreds of the reactor"""
     if args and not hasattr(args[0], '__call__') or kwargs:
         # decorator used with args for aliases or keyward arg
         def decorator(func):
@@ -89,6 +264,10 @@ def command(*args, **kwargs):
                 wrapper._restrict = kwargs['restrict']
             else:
                 wrapper._restrict = None
+            wrapper._executor = kwargs.get('executor')
+            wrapper._timeout = kwargs.get('timeout')
+            # seconds to remember responses for
+            wrapper._cache = kwargs.get('cache')
             return wrapper
         return decorator
     else:
@@ -104,23 +283,37 @@ def command(*args, **kwargs):
             wrapper._restrict = kwargs['restrict']
         else:
             wrapper._restrict = None
+        wrapper._executor = None
+        wrapper._timeout = None
+        wrapper._cache = None
         return wrapper
 
-def event(*event_types):
-    """Decorator which adds callable to the event registry"""
+def event(*event_types, **triggers):
+    """Decorator which adds callable to the event registry.
+       Optional triggers (contains, startswith, equals, matches, nocase) are
+       matched against the message text before the handler is scheduled"""
+    executor = triggers.pop('executor', None)
+    timeout = triggers.pop('timeout', None)
     def decorator(func):
         def wrapper(*func_args, **func_kwargs):
             return func(*func_args, **func_kwargs)
         wrapper._registry = 'events'
         wrapper._event_types = event_types
+        wrapper._event_triggers = triggers or None
+        wrapper._executor = executor
+        wrapper._timeout = timeout
         wrapper.__name__ = func.__name__
         wrapper.__doc__ = func.__doc__
         wrapper.__hash__ = lambda *args: zlib.crc32(func.__name__)
         return wrapper
     return decorator
 
-def task(repeat, scale=None):
-    """Decorator which adds callable to task registry"""
+def task(repeat=None, scale=None, cron=None, jitter=0, coalesce=True, executor=None, timeout=None):
+    """Decorator which adds callable to task registry. repeat is seconds, or
+       minutes, hours, days or weeks given as scale, or a cron expression like
+       '*/5 * * * *' which can also be passed as cron. Runs are delayed by up
+       to jitter seconds, missed runs are coalesced into one unless coalesce
+       is False, and executor 'thread' or 'process' runs it off the reactor"""
     def decorator(func):
         def wrapper(*func_args, **func_kwargs):
             return func(*func_args, **func_kwargs)
@@ -129,90 +322,2512 @@ def task(repeat, scale=None):
         wrapper.__doc__ = func.__doc__
         wrapper._task_repeat = repeat
         wrapper._task_scale = scale
+        wrapper._task_cron = cron
+        wrapper._task_jitter = jitter
+        wrapper._task_coalesce = coalesce
+        wrapper._executor = executor
+        wrapper._timeout = timeout
         return wrapper
     return decorator
 
+def init(*args, **kwargs):
+    """Decorator which adds callable to the init registry. Inits run when their
+       module is loaded, in a thread unless threaded=False in which case they
+       may return a deferred. The module's commands and events only run once
+       all of its inits are done, and the process pool is re-forked then so
+       workers have what the inits loaded."""
+    def decorator(func):
+        def wrapper(*func_args, **func_kwargs):
+            return func(*func_args, **func_kwargs)
+        wrapper._registry = 'inits'
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper._init_threaded = kwargs.get('threaded', True)
+        return wrapper
+    if args and hasattr(args[0], '__call__'):
+        return decorator(args[0])
+    return decorator
+
+### event triggers ###
+class AhoCorasick:
+    """Multi-pattern substring matcher, scans text once for every pattern"""
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [set()]
+
+    def __len__(self):
+        return len(self.goto) - 1
+
+    def add(self, word, value):
+        """adds word to automaton, value is returned when word is found"""
+        state = 0
+        for char in word:
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(set())
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+        self.out[state].add(value)
+
+    def build(self):
+        """computes failure links, call after all words have been added"""
+        queue = list(self.goto[0].values())
+        while queue:
+            state = queue.pop(0)
+            for char, next_state in self.goto[state].iteritems():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                if self.fail[next_state] == next_state:
+                    self.fail[next_state] = 0
+                self.out[next_state] |= self.out[self.fail[next_state]]
+
+    def search(self, text):
+        """returns set of values for every word found in text"""
+        found = set()
+        goto, fail, out = self.goto, self.fail, self.out
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found |= out[state]
+        return found
+
+class TriggerMatcher:
+    """Compiles event triggers for a set of handlers into a single matcher.
+       Handlers without triggers always match."""
+    def __init__(self, handlers):
+        self.always = set()
+        self.substrings = AhoCorasick()
+        self.substrings_nocase = AhoCorasick()
+        self.prefixes = defaultdict(lambda: defaultdict(set))
+        self.prefixes_nocase = defaultdict(lambda: defaultdict(set))
+        self.exact = defaultdict(set)
+        self.exact_nocase = defaultdict(set)
+        self.patterns = []
+
+        for handler in handlers:
+            triggers = getattr(handler, '_event_triggers', None)
+            if not triggers:
+                self.always.add(handler)
+                continue
+            nocase = triggers.get('nocase', False)
+            for word in self._as_tuple(triggers.get('contains')):
+                if nocase:
+                    self.substrings_nocase.add(word.lower(), handler)
+                else:
+                    self.substrings.add(word, handler)
+            for prefix in self._as_tuple(triggers.get('startswith')):
+                if nocase:
+                    self.prefixes_nocase[len(prefix)][prefix.lower()].add(handler)
+                else:
+                    self.prefixes[len(prefix)][prefix].add(handler)
+            for word in self._as_tuple(triggers.get('equals')):
+                if nocase:
+                    self.exact_nocase[word.strip().lower()].add(handler)
+                else:
+                    self.exact[word.strip()].add(handler)
+            for pattern in self._as_tuple(triggers.get('matches')):
+                flags = re.I if nocase else 0
+                self.patterns.append((re.compile(pattern, flags), pattern, flags, handler))
+
+        self.substrings.build()
+        self.substrings_nocase.build()
+        # one combined regex so lines that match nothing are rejected in a single pass
+        if self.patterns:
+            # case-insensitive if any pattern is, matches are verified per handler anyway
+            flags = reduce(lambda x, y: x | y, (flags for _, _, flags, _ in self.patterns))
+            self.combined = re.compile('|'.join('(?:%s)' % pattern for _, pattern, _, _ in self.patterns), flags)
+        else:
+            self.combined = None
+
+    def _as_tuple(self, value):
+        if value is None:
+            return ()
+        if isinstance(value, basestring):
+            return (value,)
+        return tuple(value)
+
+    def match(self, text):
+        """returns set of handlers which should run for text"""
+        matched = set(self.always)
+        if not isinstance(text, basestring):
+            return matched
+        lowered = text.lower()
+        if len(self.substrings):
+            matched |= self.substrings.search(text)
+        if len(self.substrings_nocase):
+            matched |= self.substrings_nocase.search(lowered)
+        for length, prefixes in self.prefixes.iteritems():
+            matched |= prefixes.get(text[:length], set())
+        for length, prefixes in self.prefixes_nocase.iteritems():
+            matched |= prefixes.get(lowered[:length], set())
+        if self.exact:
+            matched |= self.exact.get(text.strip(), set())
+        if self.exact_nocase:
+            matched |= self.exact_nocase.get(lowered.strip(), set())
+        if self.combined and self.combined.search(text):
+            for regex, _, _, handler in self.patterns:
+                if handler not in matched and regex.search(text):
+                    matched.add(handler)
+        return matched
+
+### permissions ###
+class RoleMatcher:
+    """Hostmask globs for every role compiled into a single regex per role.
+       Results are memoized per nick, forget a nick when it changes or quits.
+       Memos are kept in two generations of size / 2 nicks: a nick checked
+       again moves to the young one, and once that's full the old one is
+       dropped. So roughly the size least recently checked nicks are kept,
+       without reordering anything on a hit."""
+    def __init__(self, user_roles, size=4096):
+        self.roles = {}
+        for role, rules in (user_roles or {}).iteritems():
+            if rules:
+                self.roles[role] = re.compile('|'.join('(?:%s)' % translate(x) for x in rules))
+        self.size = size
+        self.cache = {}
+        self.old = {}
+
+    def check(self, role, nick, host):
+        """checks whether nick!host matches any rule of role"""
+        seen = self.cache.get(nick)
+        if seen is None:
+            seen = self.old.pop(nick, None)
+            if seen is None:
+                seen = {}
+            if len(self.cache) >= self.size // 2:
+                self.old, self.cache = self.cache, {}
+            self.cache[nick] = seen
+        key = (role, host)
+        if key not in seen:
+            regex = self.roles.get(role)
+            seen[key] = bool(regex and regex.match('!'.join((nick, host))))
+        return seen[key]
+
+    def forget(self, nick):
+        self.cache.pop(nick, None)
+        self.old.pop(nick, None)
+
+### membership ###
+class ChannelUser(object):
+    """A user sharing a channel with us, channels maps channel key to the
+       user's prefix modes there"""
+    __slots__ = ('nick', 'host', 'channels')
+
+    def __init__(self, nick, host=None):
+        self.nick = nick
+        self.host = host
+        self.channels = {}
+
+class ChannelMembers:
+    """Who is in which of our channels and with which prefix modes, kept up to
+       date from JOIN, PART, QUIT, KICK, NICK, MODE and NAMES. Nicks and
+       channels are compared with the server's casemapping."""
+    casemappings = {
+        'ascii': string.maketrans(string.ascii_uppercase, string.ascii_lowercase),
+        'strict-rfc1459': string.maketrans(string.ascii_uppercase + '[]\\', string.ascii_lowercase + '{}|'),
+        'rfc1459': string.maketrans(string.ascii_uppercase + '[]\\~', string.ascii_lowercase + '{}|^'),
+    }
+
+    def __init__(self, casemapping='rfc1459'):
+        self.table = self.casemappings['rfc1459']
+        self.set_casemapping(casemapping)
+        self.users = {}
+        self.channels = {}
+        self.names = {}
+        self.pending = {}
+
+    def set_casemapping(self, casemapping):
+        self.table = self.casemappings.get(casemapping, self.table)
+
+    def key(self, name):
+        return name.translate(self.table)
+
+    # queries
+    def members(self, channel):
+        """returns nicks in channel"""
+        return [x.nick for x in self.channels.get(self.key(channel), {}).itervalues()]
+
+    def channels_of(self, nick):
+        """returns channels nick shares with us"""
+        user = self.users.get(self.key(nick))
+        return [self.names[x] for x in user.channels] if user else []
+
+    def user(self, nick):
+        return self.users.get(self.key(nick))
+
+    def is_member(self, channel, nick):
+        return self.key(nick) in self.channels.get(self.key(channel), ())
+
+    def modes(self, channel, nick):
+        """returns nick's prefix modes in channel, like 'ov'"""
+        user = self.users.get(self.key(nick))
+        return user and user.channels.get(self.key(channel)) or ''
+
+    def is_op(self, channel, nick):
+        return 'o' in self.modes(channel, nick)
+
+    def is_voiced(self, channel, nick):
+        return 'v' in self.modes(channel, nick)
+
+    # updates
+    def join(self, channel, nick, host=None, modes=''):
+        key, nick_key = self.key(channel), self.key(nick)
+        self.names.setdefault(key, channel)
+        user = self.users.get(nick_key)
+        if user is None:
+            user = self.users[nick_key] = ChannelUser(nick, host)
+        elif host:
+            user.host = host
+        user.channels[key] = modes
+        self.channels.setdefault(key, {})[nick_key] = user
+
+    def part(self, channel, nick):
+        key, nick_key = self.key(channel), self.key(nick)
+        members = self.channels.get(key, {})
+        user = members.pop(nick_key, None)
+        if user:
+            user.channels.pop(key, None)
+            if not user.channels:
+                del self.users[nick_key]
+
+    def quit(self, nick):
+        user = self.users.pop(self.key(nick), None)
+        if user:
+            for key in user.channels:
+                self.channels[key].pop(self.key(nick), None)
+
+    def nick(self, old, new):
+        old_key, new_key = self.key(old), self.key(new)
+        user = self.users.pop(old_key, None)
+        if user:
+            user.nick = new
+            self.users[new_key] = user
+            for key in user.channels:
+                members = self.channels[key]
+                members[new_key] = members.pop(old_key)
+
+    def mode(self, channel, nick, mode, added):
+        user = self.users.get(self.key(nick))
+        key = self.key(channel)
+        if user and key in user.channels:
+            modes = user.channels[key].replace(mode, '')
+            user.channels[key] = modes + mode if added else modes
+
+    def leave(self, channel):
+        """we left channel, forget everyone in it"""
+        key = self.key(channel)
+        for nick_key, user in self.channels.pop(key, {}).items():
+            user.channels.pop(key, None)
+            if not user.channels:
+                del self.users[nick_key]
+        self.names.pop(key, None)
+
+    def names_reply(self, channel, nicks):
+        """collects a chunk of a NAMES reply, nicks are (nick, modes). Replies
+           about channels we aren't in are someone's query, they're not kept"""
+        key = self.key(channel)
+        if key in self.names:
+            self.pending.setdefault(key, []).extend(nicks)
+
+    def names_end(self, channel):
+        """NAMES reply is complete, it replaces what we knew about channel"""
+        nicks = self.pending.pop(self.key(channel), None)
+        if nicks is None:
+            return
+        hosts = dict((x.nick, x.host) for x in self.channels.get(self.key(channel), {}).itervalues())
+        self.leave(channel)
+        for nick, modes in nicks:
+            self.join(channel, nick, hosts.get(nick), modes)
+
+### requests ###
+class RequestError(Exception):
+    pass
+
+class RequestTimeout(RequestError):
+    pass
+
+class ChiiRequests:
+    """Outstanding WHOIS, WHO, NAMES and USERHOST queries of a connection.
+       Any number can be sent at once. Replies are matched back by target,
+       the nick or mask they're about, and dropped if nobody asked. The same
+       query asked twice before it's answered is only sent once, and WHOIS
+       and USERHOST answers are cached for a while. Callers each get a copy
+       of the answer they can change."""
+    cached = ('whois', 'userhost')
+
+    def __init__(self, send, key, config):
+        self.send = send
+        self.key = key
+        self.timeout = config['request_timeout'] or 30
+        self.ttl = config['request_cache_ttl'] or 0
+        self.size = config['request_cache_size'] or 0
+        self.pending = {}
+        self.cache = OrderedDict()
+
+    def request(self, kind, target, line, result=None):
+        """sends line unless the answer is cached or already asked for, returns
+           deferred answer. result is what replies are collected into"""
+        if not threadable.isInIOThread():
+            d = defer.Deferred()
+            reactor.callFromThread(lambda: self.request(kind, target, line, result).chainDeferred(d))
+            return d
+        key = (kind, self.key(target))
+        if key in self.cache:
+            when, value = self.cache.pop(key)
+            if time.time() - when < self.ttl:
+                self.cache[key] = (when, value)
+                return defer.succeed(copy.deepcopy(value))
+        d = defer.Deferred()
+        if key in self.pending:
+            self.pending[key][0].append(d)
+            return d
+        timer = reactor.callLater(self.timeout, self.fail, kind, target,
+                                  RequestTimeout('no reply to %s after %s seconds' % (line, self.timeout)))
+        self.pending[key] = [[d], result, timer]
+        self.send(line)
+        return d
+
+    def result(self, kind, target):
+        """returns what replies for target are collected into, None if nobody asked"""
+        entry = self.pending.get((kind, self.key(target)))
+        return entry and entry[1]
+
+    def done(self, kind, target, value=None, cache=True):
+        """answers request for target, if there is one"""
+        entry = self._pop(kind, target)
+        if entry:
+            result = entry[1] if value is None else value
+            if cache and kind in self.cached and self.ttl and self.size:
+                self.cache[(kind, self.key(target))] = (time.time(), result)
+                while len(self.cache) > self.size:
+                    self.cache.popitem(last=False)
+            # every caller gets their own copy, the cached one is never handed out
+            for d in entry[0]:
+                d.callback(copy.deepcopy(result))
+
+    def fail(self, kind, target, error):
+        entry = self._pop(kind, target)
+        if entry:
+            for d in entry[0]:
+                d.errback(error)
+
+    def clear(self, error):
+        """fails every outstanding request"""
+        for kind, target in self.pending.keys():
+            self.fail(kind, target, error)
+
+    def outstanding(self, kind):
+        """returns targets of kind being asked about"""
+        return [x[1] for x in self.pending if x[0] == kind]
+
+    def _pop(self, kind, target):
+        entry = self.pending.pop((kind, self.key(target)), None)
+        if entry:
+            if entry[2].active():
+                entry[2].cancel()
+            return entry
+
+### http ###
+class HTTPError(Exception):
+    pass
+
+class HTTPQuotaExceeded(HTTPError):
+    pass
+
+class HTTPResponse:
+    def __init__(self, code, headers, body):
+        self.code = code
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body)
+
+class HTTPBody(protocol.Protocol):
+    """Collects a response body, giving up once it's bigger than max_size"""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.chunks = []
+        self.finished = defer.Deferred(lambda d: self.transport.stopProducing())
+
+    def dataReceived(self, data):
+        self.size += len(data)
+        if self.max_size and self.size > self.max_size:
+            finished, self.finished = self.finished, None
+            self.transport.stopProducing()
+            finished.errback(HTTPError('response is bigger than %d bytes' % self.max_size))
+        elif self.finished:
+            self.chunks.append(data)
+
+    def connectionLost(self, reason):
+        if self.finished is None:
+            return
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(''.join(self.chunks))
+        else:
+            self.finished.errback(reason)
+
+class ChiiHTTP:
+    """Non-blocking HTTP client for plugins, returns deferred HTTPResponses.
+       Connections are kept alive and reused per host, at most
+       http_max_per_host requests to a host run at once, and http_quota can
+       limit how many requests a host gets a day."""
+    def __init__(self, config):
+        self.timeout = config['http_timeout'] or 30
+        self.max_size = config['http_max_size']
+        self.quotas = config['http_quota'] or {}
+        per_host = config['http_max_per_host'] or 4
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = per_host
+        self.agent = RedirectAgent(ContentDecoderAgent(Agent(reactor, connectTimeout=self.timeout, pool=self.pool), [('gzip', GzipDecoder)]))
+        self.limits = defaultdict(lambda: defer.DeferredSemaphore(per_host))
+        # host -> requests, bytes, errors
+        self.stats = defaultdict(lambda: [0, 0, 0])
+        self.usage = {}
+
+    def request(self, method, url, headers=None, body=None, max_size=None, timeout=None):
+        if not threadable.isInIOThread():
+            d = defer.Deferred()
+            reactor.callFromThread(lambda: self.request(method, url, headers, body, max_size, timeout).chainDeferred(d))
+            return d
+        host = urlparse.urlparse(url).hostname
+        if host in self.quotas:
+            day, used = self.usage.get(host, (None, 0))
+            if day != datetime.date.today():
+                day, used = datetime.date.today(), 0
+            if used >= self.quotas[host]:
+                return defer.fail(HTTPQuotaExceeded('used up today\'s %d requests to %s' % (self.quotas[host], host)))
+            self.usage[host] = (day, used + 1)
+        return self.limits[host].run(self._request, method, url, host, headers, body,
+                                     self.max_size if max_size is None else max_size, timeout or self.timeout)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def get_json(self, url, **kwargs):
+        def decode(response):
+            if response.code >= 400:
+                raise HTTPError('%s answered %d' % (urlparse.urlparse(url).hostname, response.code))
+            return response.json()
+        return self.get(url, **kwargs).addCallback(decode)
+
+    def _request(self, method, url, host, headers, body, max_size, timeout):
+        def read(response):
+            reader = HTTPBody(max_size)
+            response.deliverBody(reader)
+            return reader.finished.addCallback(lambda data: HTTPResponse(response.code, response.headers, data))
+
+        def expire():
+            expired.append(True)
+            d.cancel()
+
+        def done(result):
+            if timer.active():
+                timer.cancel()
+            stats = self.stats[host]
+            stats[0] += 1
+            if isinstance(result, failure.Failure):
+                stats[2] += 1
+                if expired:
+                    return failure.Failure(HTTPError('no response from %s after %s seconds' % (host, timeout)))
+            else:
+                stats[1] += len(result.body)
+            return result
+
+        headers = dict(headers or {})
+        headers.setdefault('User-Agent', 'chii')
+        producer = FileBodyProducer(StringIO(body)) if body is not None else None
+        d = self.agent.request(method, url, Headers(dict((k, [v]) for k, v in headers.iteritems())), producer)
+        expired = []
+        timer = reactor.callLater(timeout, expire)
+        return d.addCallback(read).addBoth(done)
+
+_http = None
+
+def http_client():
+    """returns the shared http client, the bot's once it has one"""
+    global _http
+    if _http is None:
+        _http = ChiiHTTP(config)
+    return _http
+
+def share_http(client):
+    """makes client the one http_client returns, in the chii module plugins
+       import as well, so the bot and fetch share quotas, connections and stats"""
+    global _http
+    _http = client
+    if 'chii' in sys.modules:
+        sys.modules['chii']._http = client
+
+def fetch(url, headers=None, max_size=None, timeout=None):
+    """Blocking GET which returns the body, for code which can't use
+       deferreds like lambdas. Goes through the shared client from threads,
+       uses urllib2 in process pool workers and never blocks the reactor."""
+    if ChiiProcessPool.worker:
+        max_size = config['http_max_size'] if max_size is None else max_size
+        response = urllib2.urlopen(urllib2.Request(url, None, headers or {}), timeout=timeout or config['http_timeout'])
+        body = response.read(max_size + 1 if max_size else -1)
+        if max_size and len(body) > max_size:
+            raise HTTPError('response is bigger than %d bytes' % max_size)
+        return body
+    if threadable.isInIOThread():
+        raise HTTPError("can't block the reactor, use self.http instead")
+    return threads.blockingCallFromThread(reactor, http_client().get, url, headers=headers, max_size=max_size, timeout=timeout).body
+
+### command cache ###
+class ChiiCache:
+    """Responses of commands declared with @command(cache=ttl), keyed on the
+       command and its arguments regardless of case and spacing. Only deferred
+       responses are remembered, ones returned right away didn't fetch
+       anything. Failures are remembered for command_cache_negative_ttl, the
+       least recently used responses go once there are more than
+       command_cache_size, and the same call made while it's already running
+       waits for that one instead."""
+    def __init__(self, config):
+        self.size = config['command_cache_size'] or 0
+        self.negative_ttl = config['command_cache_negative_ttl'] or 0
+        self.entries = OrderedDict()
+        self.inflight = {}
+        # command -> hits, misses, shared, errors
+        self.stats = defaultdict(lambda: [0, 0, 0, 0])
+        self.lock = threading.Lock()
+
+    def key(self, command, args):
+        return (command._command_names[0], tuple(' '.join(args).lower().split()))
+
+    def call(self, command, args, func):
+        """returns the remembered response of command to args, otherwise the
+           deferred response of func, which only runs once for concurrent calls"""
+        key = self.key(command, args)
+        with self.lock:
+            stats = self.stats[key[0]]
+            if key in self.entries:
+                expires, failed, response = self.entries.pop(key)
+                if time.time() < expires:
+                    self.entries[key] = (expires, failed, response)
+                    stats[0] += 1
+                    return defer.fail(response) if failed else response
+            if key in self.inflight:
+                stats[2] += 1
+                d = defer.Deferred()
+                self.inflight[key].append(d)
+                return d
+            stats[1] += 1
+            self.inflight[key] = []
+        try:
+            response = func()
+        except Exception:
+            response = failure.Failure()
+        if isinstance(response, defer.Deferred):
+            if threadable.isInIOThread():
+                return response.addBoth(self._store, key, command._cache)
+            # the reactor may be firing it already, callbacks can only be added there
+            d = defer.Deferred()
+            reactor.callFromThread(self._chain, response, d, key, command._cache)
+            return d
+        # answered right away without fetching anything, like usage errors,
+        # which isn't worth remembering. Failures still are for a bit
+        response = self._store(response, key, 0)
+        return defer.fail(response) if isinstance(response, failure.Failure) else response
+
+    def clear(self, names=None):
+        """forgets responses, of just the given commands if names are given"""
+        with self.lock:
+            for key in list(self.entries):
+                if names is None or key[0] in names:
+                    del self.entries[key]
+
+    def _chain(self, response, d, key, ttl):
+        response.addBoth(self._store, key, ttl).chainDeferred(d)
+
+    def _store(self, response, key, ttl):
+        failed = isinstance(response, failure.Failure)
+        with self.lock:
+            waiting = self.inflight.pop(key, [])
+            if failed:
+                self.stats[key[0]][3] += 1
+                ttl = self.negative_ttl
+            if ttl and self.size and response is not None:
+                self.entries[key] = (time.time() + ttl, failed, response)
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        for d in waiting:
+            if threadable.isInIOThread():
+                d.callback(response)
+            else:
+                reactor.callFromThread(d.callback, response)
+        return response
+
+### metrics ###
+class Histogram:
+    """Counts observations into fixed buckets, enough for prometheus and rough percentiles"""
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """upper bound of the bucket the q quantile is in"""
+        rank, seen = q * self.count, 0
+        for bound, n in zip(self.buckets + (float('inf'),), self.counts):
+            seen += n
+            if n and seen >= rank:
+                return bound
+        return 0.0
+
+class ChiiMetrics:
+    """How long commands, events and tasks waited to run, how long they ran
+       and how often they failed, plus line and channel traffic per network.
+       Shared by every network, served in prometheus text format on
+       metrics_port."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # (kind, name) -> wait histogram, run histogram, errors
+        self.handlers = {}
+        # network -> lines in, lines out
+        self.lines = defaultdict(lambda: [0, 0])
+        # (network, direction) -> lines per second over about a minute, when
+        self.rates = defaultdict(lambda: [0.0, time.time()])
+        # (network, channel) -> messages in, messages out
+        self.channels = defaultdict(lambda: [0, 0])
+
+    def timed(self, kind, name, queued, func, *args):
+        """calls func, timing it as handler name. Deferred results are timed
+           until they fire. queued is when it was dispatched, if it was"""
+        start = time.time()
+        if queued is not None:
+            self.observe(kind, name, 0, start - queued)
+        try:
+            result = func(*args)
+        except Exception:
+            self.observe(kind, name, 1, time.time() - start, True)
+            raise
+        if isinstance(result, defer.Deferred):
+            def done(result):
+                self.observe(kind, name, 1, time.time() - start, isinstance(result, failure.Failure))
+                return result
+            if threadable.isInIOThread():
+                result.addBoth(done)
+            else:
+                # before anything else waits on it, callFromThread keeps order
+                reactor.callFromThread(result.addBoth, done)
+        else:
+            self.observe(kind, name, 1, time.time() - start)
+        return result
+
+    def observe(self, kind, name, stage, seconds, failed=False):
+        """stage is 0 for queue wait, 1 for run time"""
+        with self.lock:
+            handler = self.handlers.get((kind, name))
+            if handler is None:
+                handler = self.handlers[(kind, name)] = [Histogram(), Histogram(), 0]
+            handler[stage].observe(seconds)
+            if failed:
+                handler[2] += 1
+
+    def line(self, network, direction):
+        """counts a line, direction is 0 for in, 1 for out"""
+        now = time.time()
+        with self.lock:
+            self.lines[network][direction] += 1
+            rate = self.rates[(network, direction)]
+            rate[0] = rate[0] * math.exp((rate[1] - now) / 60.0) + 1 / 60.0
+            rate[1] = now
+
+    def message(self, network, channel, direction):
+        """counts a message from or to channel"""
+        with self.lock:
+            self.channels[(network, channel)][direction] += 1
+
+    def rate(self, network, direction):
+        """lines per second over about the last minute"""
+        with self.lock:
+            value, updated = self.rates.get((network, direction), (0.0, 0))
+            return value * math.exp((updated - time.time()) / 60.0)
+
+    def handler(self, kind, name):
+        """returns runs, errors, wait p50, wait p95, run p50, run p95 of a handler"""
+        with self.lock:
+            wait, run, errors = self.handlers[(kind, name)]
+            return (run.count, errors, wait.quantile(0.5), wait.quantile(0.95), run.quantile(0.5), run.quantile(0.95))
+
+    def prometheus(self, extra=()):
+        """returns everything in prometheus text format, extra is more
+           (name, type, help, [(labels, value)]) to add"""
+        def labels(values):
+            return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                            for k, v in values)
+
+        def metric(name, kind, help, samples):
+            out.append('# HELP %s %s' % (name, help))
+            out.append('# TYPE %s %s' % (name, kind))
+            for values, value in samples:
+                out.append('%s{%s} %s' % (name, labels(values), repr(float(value))) if values else '%s %s' % (name, repr(float(value))))
+
+        out = []
+        with self.lock:
+            samples = []
+            for (kind, name), handler in sorted(self.handlers.iteritems()):
+                for stage, histogram in zip(('wait', 'run'), handler):
+                    values = [('kind', kind), ('name', name), ('stage', stage)]
+                    seen = 0
+                    for bound, n in zip(histogram.buckets, histogram.counts):
+                        seen += n
+                        samples.append((('_bucket', values + [('le', bound)]), seen))
+                    samples.append((('_bucket', values + [('le', '+Inf')]), histogram.count))
+                    samples.append((('_sum', values), histogram.sum))
+                    samples.append((('_count', values), histogram.count))
+            out.append('# HELP chii_handler_seconds time handlers waited to run and ran for')
+            out.append('# TYPE chii_handler_seconds histogram')
+            for (suffix, values), value in samples:
+                out.append('chii_handler_seconds%s{%s} %s' % (suffix, labels(values), repr(float(value))))
+            metric('chii_handler_errors_total', 'counter', 'handlers which raised or failed',
+                   [([('kind', kind), ('name', name)], handler[2]) for (kind, name), handler in sorted(self.handlers.iteritems())])
+            metric('chii_lines_total', 'counter', 'irc lines received and sent',
+                   [([('network', network), ('direction', direction)], counts[n]) for network, counts in sorted(self.lines.iteritems())
+                    for n, direction in enumerate(('in', 'out'))])
+            metric('chii_channel_messages_total', 'counter', 'messages received from and sent to channels',
+                   [([('network', network), ('channel', channel), ('direction', direction)], counts[n])
+                    for (network, channel), counts in sorted(self.channels.iteritems()) for n, direction in enumerate(('in', 'out'))])
+            # other threads add rates, copy them here, rate() takes the lock itself
+            rates = sorted(self.rates)
+        metric('chii_line_rate', 'gauge', 'lines per second over about a minute',
+               [([('network', network), ('direction', ('in', 'out')[n])], self.rate(network, n)) for network, n in rates])
+        metric('chii_uptime_seconds', 'gauge', 'seconds since start', [([], time.time() - self.started)])
+        for name, kind, help, samples in extra:
+            metric(name, kind, help, samples)
+        return '\n'.join(out) + '\n'
+
+class MetricsResource(Resource):
+    """Serves metrics_text to prometheus"""
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return metrics_text()
+
+def metrics_text():
+    """returns the shared metrics along with command cache, dispatch and outbound queue stats"""
+    extra = []
+    cache = ChiiBot.command_cache
+    if cache:
+        with cache.lock:
+            extra.append(('chii_command_cache_total', 'counter', 'command cache lookups by result',
+                          [([('command', name), ('result', result)], stats[n]) for name, stats in sorted(cache.stats.iteritems())
+                           for n, result in enumerate(('hit', 'miss', 'shared', 'error'))]))
+    if ChiiBot.dispatcher:
+        stats = ChiiBot.dispatcher.stats()
+        extra.append(('chii_dispatch_queue_depth', 'gauge', 'jobs waiting for a worker',
+                      [([('class', x)], stats[x]['depth']) for x in ChiiDispatcher.job_classes]))
+        extra.append(('chii_dispatch_workers', 'gauge', 'worker threads', [([], stats['workers'])]))
+    outbound = [(name, getattr(bot, 'outbound', None)) for name, bot in sorted(ChiiBot.networks.iteritems())]
+    extra.append(('chii_outbound_queue_depth', 'gauge', 'lines held back by flood control',
+                  [([('network', name)], sum(len(x) for queues in queue.queues.itervalues() for x in queues.itervalues()))
+                   for name, queue in outbound if queue]))
+    return ChiiBot.metrics.prometheus(extra)
+
+def listen_metrics(port, interface):
+    """serves metrics_text on http://interface:port/metrics"""
+    root = Resource()
+    root.putChild('metrics', MetricsResource())
+    site = Site(root)
+    # don't log every scrape
+    site.log = lambda request: None
+    return reactor.listenTCP(port, site, interface=interface)
+
+### profiling ###
+class ChiiSampler:
+    """Samples the stack of every busy thread each interval seconds of cpu
+       time, using SIGPROF, and counts them as collapsed stacks for
+       flamegraph.pl. Stacks start with the plugin module they ran in, or
+       core. Threads waiting on a condition aren't busy and are skipped."""
+    def __init__(self, modules, interval=0.01):
+        self.modules = frozenset(modules)
+        self.interval = interval
+        self.stacks = defaultdict(int)
+        self.samples = 0
+        self.started = None
+        self.previous = None
+
+    def start(self):
+        """has to be called from the main thread"""
+        self.previous = signal.signal(signal.SIGPROF, self._sample)
+        # restart interrupted syscalls, otherwise reads, waits and polls in
+        # every thread fail with EINTR while sampling
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.started = time.time()
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self.previous or signal.SIG_DFL)
+
+    def owners(self):
+        """returns samples per plugin, most first"""
+        owners = defaultdict(int)
+        for stack, count in self.stacks.items():
+            owners[stack.split(';', 1)[0][1:-1]] += count
+        return sorted(owners.iteritems(), key=lambda x: -x[1])
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('%s %d\n' % (stack, count))
+
+    def _sample(self, signum, frame):
+        # signal handlers run in the main thread, its stack is frame rather than this handler
+        main = threading.current_thread().ident
+        for ident, top in sys._current_frames().items():
+            if ident == main:
+                top = frame
+            if top is None or top.f_code.co_name == 'wait' and top.f_globals.get('__name__') == 'threading':
+                continue
+            self.stacks[self._collapse(top)] += 1
+        self.samples += 1
+
+    def _collapse(self, frame):
+        names = []
+        owner = None
+        while frame is not None:
+            module = frame.f_globals.get('__name__', '?')
+            if owner is None and module in self.modules:
+                owner = module
+            names.append('%s:%s' % (module, frame.f_code.co_name))
+            frame = frame.f_back
+        names.append('[%s]' % (owner or 'core'))
+        return ';'.join(reversed(names))
+
+### plugin reloading ###
+class ModuleWatcher:
+    """Calls back with the filename of any python file changing in the given
+       module directories or files. Uses inotify where available, polling
+       otherwise. Changes are debounced so editors saving in several steps
+       only cause one reload."""
+    def __init__(self, paths, callback, interval=2, delay=0.5):
+        self.paths = [x if os.path.isdir(x) else x + '.py' for x in paths]
+        self.callback = callback
+        self.interval = interval
+        self.delay = delay
+        self.pending = {}
+        self.notifier = None
+        self.poller = None
+        self.mtimes = {}
+
+    def start(self):
+        try:
+            from twisted.internet import inotify
+            from twisted.python import filepath
+            self.notifier = inotify.INotify()
+            self.notifier.startReading()
+            mask = inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_CREATE | inotify.IN_DELETE
+            for path in self.paths:
+                if os.path.exists(path):
+                    self.notifier.watch(filepath.FilePath(path), mask=mask,
+                                        callbacks=[lambda ignored, fp, mask: self._changed(fp.path)])
+        except Exception:
+            # no inotify here, fall back to polling mtimes
+            self.notifier = None
+            self.mtimes = self._scan()
+            self.poller = LoopingCall(self._poll)
+            self.poller.start(self.interval, now=False)
+
+    def stop(self):
+        if self.notifier:
+            self.notifier.loseConnection()
+        if self.poller and self.poller.running:
+            self.poller.stop()
+        for call in self.pending.values():
+            if call.active():
+                call.cancel()
+        self.pending = {}
+
+    def _scan(self):
+        mtimes = {}
+        for path in self.paths:
+            files = [os.path.join(path, x) for x in os.listdir(path)] if os.path.isdir(path) else [path]
+            for filename in files:
+                if filename.endswith('.py') and os.path.exists(filename):
+                    mtimes[filename] = os.path.getmtime(filename)
+        return mtimes
+
+    def _poll(self):
+        mtimes = self._scan()
+        for filename in set(mtimes) | set(self.mtimes):
+            if mtimes.get(filename) != self.mtimes.get(filename):
+                self._changed(filename)
+        self.mtimes = mtimes
+
+    def _changed(self, filename):
+        if not filename.endswith('.py'):
+            return
+        if filename in self.pending and self.pending[filename].active():
+            self.pending[filename].reset(self.delay)
+        else:
+            self.pending[filename] = reactor.callLater(self.delay, self._fire, filename)
+
+    def _fire(self, filename):
+        del self.pending[filename]
+        try:
+            self.callback(filename)
+        except Exception:
+            traceback.print_exc()
+
+### lazy loading ###
+class ModuleManifest:
+    """Cache of what every module registers, so modules can be registered
+       as stubs and only imported the first time one of them is used. Entries
+       are only valid for the module source and the config keys it reads."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.changed = False
+        if filename and os.path.exists(filename):
+            try:
+                with open(filename) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                pass
+
+    def save(self):
+        if self.changed and self.filename:
+            # shard processes may be saving it at the same time
+            tmp = '%s.%d.tmp' % (self.filename, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.rename(tmp, self.filename)
+            self.changed = False
+
+    def get(self, path, digest, config_digest):
+        """returns entry for module if it's still valid and the module can be loaded lazily"""
+        entry = self.entries.get(path)
+        if entry and entry['hash'] == digest and entry['config'] == config_digest and entry['lazy']:
+            return entry
+
+    def update(self, path, mod, digest, config_digest):
+        """records what mod registers"""
+        handlers = []
+        for method in (getattr(mod, x) for x in dir(mod) if not x.startswith('_')):
+            registry = getattr(method, '_registry', None)
+            if registry == 'commands':
+                handlers.append({'registry': registry, 'name': method.__name__, 'doc': method.__doc__,
+                                 'names': list(method._command_names), 'restrict': method._restrict,
+                                 'executor': method._executor, 'timeout': method._timeout, 'cache': method._cache})
+            elif registry == 'events':
+                handlers.append({'registry': registry, 'name': method.__name__, 'doc': method.__doc__,
+                                 'types': list(method._event_types), 'triggers': method._event_triggers,
+                                 'executor': method._executor, 'timeout': method._timeout})
+            elif registry in ('tasks', 'inits'):
+                handlers.append({'registry': registry, 'name': method.__name__})
+        # modules with tasks, inits or load events have to run at startup
+        lazy = not any(x['registry'] in ('tasks', 'inits') or x['registry'] == 'events' and 'load' in x['types'] for x in handlers)
+        entry = {'hash': digest, 'config': config_digest, 'lazy': lazy, 'handlers': handlers}
+        if self.entries.get(path) != entry:
+            self.entries[path] = entry
+            self.changed = True
+
+    def stubs(self, path, load):
+        """returns module-like object of stubs, load(path) imports the real module.
+           Stubs of process handlers run in a thread, the module is loaded
+           there and the real handler is handed to the process pool"""
+        stubs = types.ModuleType(str(path))
+        for n, handler in enumerate(self.entries[path]['handlers']):
+            if handler['registry'] == 'commands':
+                stub = command(*handler['names'], restrict=handler['restrict'], cache=handler.get('cache'),
+                               timeout=handler.get('timeout'), executor=self._stub_executor(handler))(self._command_stub(path, handler, load))
+            else:
+                triggers = dict((str(k), v) for k, v in (handler['triggers'] or {}).iteritems())
+                stub = event(*handler['types'], timeout=handler.get('timeout'), executor=self._stub_executor(handler),
+                             **triggers)(self._event_stub(path, handler, load))
+            setattr(stubs, 'stub%d' % n, stub)
+        return stubs
+
+    def _stub_executor(self, handler):
+        # stubs of reactor handlers have to run there too, process ones load in a thread
+        return 'reactor' if handler.get('executor') == 'reactor' else None
+
+    def _command_stub(self, path, handler, load):
+        def stub(self, channel, nick, host, *args):
+            load(path)
+            command = self._bind(self.commands[handler['names'][0]])
+            reason = self._not_ready(command)
+            if reason:
+                return reason
+            if command._executor == 'process':
+                return self._process_handler(command, (channel, nick, host) + args)
+            return command(channel, nick, host, *args)
+        stub.__name__ = str(handler['name'])
+        stub.__doc__ = handler['doc']
+        return stub
+
+    def _event_stub(self, path, handler, load):
+        def stub(self, *args):
+            load(path)
+            for methods in self.module_registry[path]['events'].itervalues():
+                for method in methods:
+                    if method.__name__ == handler['name'] and not self._not_ready(method):
+                        if method._executor == 'process':
+                            return self._process_handler(self._bind(method), args)
+                        return self._bind(method)(*args)
+        stub.__name__ = str(handler['name'])
+        stub.__doc__ = handler['doc']
+        return stub
+
+### threaded dispatch ###
+class DispatchShed(Exception):
+    """Raised when a job is dropped because the dispatch queues are full"""
+
+class ChiiDispatcher:
+    """Bounded worker pool with one queue per job class. Workers always take
+       the highest priority job available, when the queues are full the lowest
+       priority jobs are shed first. Pool size is tuned from observed queue wait."""
+
+    # highest priority first
+    job_classes = ('admin', 'command', 'task', 'event')
+
+    def __init__(self, config):
+        self.min_workers = config['threads'] or 4
+        self.max_workers = max(config['max_threads'] or 16, self.min_workers)
+        self.max_queue = config['max_queue'] or 256
+        self.latency = config['queue_latency'] or 0.5
+
+        self.lock = threading.Condition()
+        self.queues = dict((x, deque()) for x in self.job_classes)
+        self.counters = dict((x, defaultdict(int)) for x in self.job_classes)
+        self.waits = dict((x, 0.0) for x in self.job_classes)
+        self.workers = 0
+        self.busy = 0
+        self.retiring = 0
+        self.window = [0, 0.0]  # jobs started, seconds waited since last tune
+        self.tuner = LoopingCall(self._tune)
+
+        for i in xrange(self.min_workers):
+            self._spawn()
+
+    def _spawn(self):
+        self.workers += 1
+        worker = threading.Thread(target=self._work, name='chii-worker-%d' % self.workers)
+        worker.daemon = True
+        worker.start()
+
+    def start(self, interval=5):
+        """start tuning pool size"""
+        if not self.tuner.running:
+            self.tuner.start(interval, now=False)
+
+    def stop(self):
+        """stop all workers, queued jobs are shed"""
+        if self.tuner.running:
+            self.tuner.stop()
+        with self.lock:
+            for job_class in self.job_classes:
+                while self.queues[job_class]:
+                    self._shed(job_class)
+            self.retiring = self.workers
+            self.lock.notifyAll()
+
+    def submit(self, job_class, func, *args):
+        """queue func(*args) for a worker, returns deferred result"""
+        d = defer.Deferred()
+        with self.lock:
+            if self._depth() >= self.max_queue:
+                # shed from the lowest priority queue that isn't above this job
+                for victim in reversed(self.job_classes):
+                    if self.queues[victim] and self._priority(victim) >= self._priority(job_class):
+                        self._shed(victim)
+                        break
+                else:
+                    self.counters[job_class]['shed'] += 1
+                    d.errback(failure.Failure(DispatchShed(job_class)))
+                    return d
+            self.queues[job_class].append((time.time(), d, func, args))
+            self.counters[job_class]['submitted'] += 1
+            self.lock.notify()
+        return d
+
+    def stats(self):
+        """returns queue depth and wait gauges per job class"""
+        with self.lock:
+            stats = {'workers': self.workers, 'busy': self.busy}
+            for job_class in self.job_classes:
+                stats[job_class] = dict(self.counters[job_class],
+                                        depth=len(self.queues[job_class]),
+                                        wait=round(self.waits[job_class], 4))
+            return stats
+
+    def _priority(self, job_class):
+        return self.job_classes.index(job_class)
+
+    def _depth(self):
+        return sum(len(x) for x in self.queues.itervalues())
+
+    def _shed(self, job_class):
+        """drops oldest job from queue, must hold lock"""
+        queued, d, func, args = self.queues[job_class].popleft()
+        self.counters[job_class]['shed'] += 1
+        reactor.callFromThread(d.errback, failure.Failure(DispatchShed(job_class)))
+
+    def _next(self):
+        """returns next job by priority, must hold lock"""
+        for job_class in self.job_classes:
+            if self.queues[job_class]:
+                return (job_class,) + self.queues[job_class].popleft()
+
+    def _work(self):
+        while True:
+            with self.lock:
+                while not self.retiring and not self._depth():
+                    self.lock.wait()
+                if self.retiring:
+                    self.retiring -= 1
+                    self.workers -= 1
+                    return
+                job_class, queued, d, func, args = self._next()
+                waited = time.time() - queued
+                # exponentially weighted average wait per class
+                self.waits[job_class] = self.waits[job_class] * 0.8 + waited * 0.2
+                self.window[0] += 1
+                self.window[1] += waited
+                self.busy += 1
+            try:
+                result = func(*args)
+            except:
+                result = failure.Failure()
+            with self.lock:
+                self.busy -= 1
+                self.counters[job_class]['completed'] += 1
+                if isinstance(result, failure.Failure):
+                    self.counters[job_class]['errors'] += 1
+            if isinstance(result, failure.Failure):
+                reactor.callFromThread(d.errback, result)
+            else:
+                reactor.callFromThread(d.callback, result)
+
+    def _tune(self):
+        """grow pool when jobs wait too long, shrink it when idle"""
+        with self.lock:
+            started, waited = self.window
+            self.window = [0, 0.0]
+            average = waited / started if started else 0.0
+            if average > self.latency and self.workers < self.max_workers:
+                self._spawn()
+            elif average < self.latency / 4 and not self._depth() and self.workers - self.retiring > self.min_workers:
+                if self.busy < self.workers - self.retiring:
+                    self.retiring += 1
+                    self.lock.notify()
+
+### process dispatch ###
+class ProcessTimeout(Exception):
+    """Raised when a job in the process pool takes longer than its timeout"""
+
+class ProcessError(Exception):
+    """Raised when a job in the process pool raised an exception"""
+
+class ProcessProxy:
+    """Stands in for the bot inside a worker process. Irc output is recorded
+       and replayed by the real bot once the handler returns. config is a
+       read-only ConfigSnapshot, workers can't change or save config."""
+    outputs = ('msg', 'me', 'notice', 'topic', 'kick', 'mode', 'describe', 'sendLine')
+
+    def __init__(self, config, nickname):
+        self.config = config
+        self.nickname = nickname
+        self.calls = []
+
+    def __getattr__(self, name):
+        if name in self.outputs:
+            return lambda *args: self.calls.append((name, args))
+        raise AttributeError("%s is not available in a worker process" % name)
+
+def _process_worker(conn):
+    """main loop of a worker process"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # the reactor's SIGTERM handler is inherited when forked after it started,
+    # which would leave terminate() unable to kill a worker
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # forked workers would otherwise all share the parent's random state
+    random.seed()
+    ChiiProcessPool.worker = True
+    if 'chii' in sys.modules:
+        # plugins see the chii module, which isn't this one when chii.py is run
+        sys.modules['chii'].ChiiProcessPool.worker = True
+    lambdas = {}
+    while True:
+        try:
+            kind, ref, args, proxy = conn.recv()
+        except (EOFError, IOError):
+            return
+        try:
+            if kind == 'handler':
+                result = ChiiProcessPool.functions[ref](proxy, *args)
+            elif kind == 'lambda':
+                # lambdas are added at runtime, so rebuild them from source
+                if ref not in lambdas:
+                    module, func_s, name, nick = ref
+                    mod = sys.modules[module]
+                    lambdas[ref] = mod.wrap_lambda(eval(func_s, mod.__dict__), func_s, name, nick)
+                result = lambdas[ref](*args)
+            else:
+                result = ref(*args)
+            conn.send((True, result, proxy.calls if proxy else []))
+        except Exception as e:
+            conn.send((False, '%s: %s' % (type(e).__name__, e), traceback.format_exc()))
+
+class ChiiProcessPool:
+    """Pool of forked worker processes for cpu bound handlers. Workers are
+       forked when jobs need them, killed and replaced when a job times out,
+       and recycled after process_max_tasks jobs. Jobs wait in the reactor
+       for a free worker, so only jobs that have a worker hold a thread of
+       the pool's own threadpool, one per worker."""
+
+    # registered handlers by id, inherited by workers when they are forked.
+    # Jobs refer to handlers by id(func) too
+    functions = {}
+    # true in the worker processes
+    worker = False
+
+    def __init__(self, config):
+        self.size = config['processes'] or multiprocessing.cpu_count()
+        self.timeout = config['process_timeout'] or 30
+        self.max_tasks = config['process_max_tasks'] or 100
+        self.threadpool = threadpool.ThreadPool(0, self.size, 'process-pool')
+        self.pending = deque()
+        self.idle = []
+        self.workers = []
+        # workers forked before the latest update are retired once they're free
+        self.generation = 0
+
+    def update(self, functions=()):
+        """registers handlers, workers forked from now on see them and the
+           current state of the bot. Idle workers are retired straight away,
+           busy ones when their job is done, so nothing in flight is lost"""
+        ChiiProcessPool.functions = dict((id(x), x) for x in functions)
+        self.generation += 1
+        idle, self.idle = self.idle, []
+        for worker in idle:
+            self._kill(worker)
+        self._dispatch()
+
+    def stop(self):
+        """kills all workers, jobs in flight fail"""
+        workers, self.workers, self.idle = self.workers, [], []
+        pending, self.pending = self.pending, deque()
+        for worker in workers:
+            self._kill(worker)
+        for job, timeout, d in pending:
+            d.errback(ProcessError('process pool stopped'))
+        if self.threadpool.started:
+            self.threadpool.stop()
+
+    def submit(self, kind, ref, args=(), proxy=None, timeout=None):
+        """runs job in a worker, returns deferred (result, irc calls)"""
+        d = defer.Deferred()
+        self.pending.append(((kind, ref, args, proxy), timeout or self.timeout, d))
+        self._dispatch()
+        return d
+
+    def _dispatch(self):
+        """hands waiting jobs to free workers, forking workers up to size"""
+        while self.pending:
+            if self.idle:
+                worker = self.idle.pop()
+            elif len(self.workers) < self.size:
+                worker = self._fork()
+            else:
+                return
+            job, timeout, d = self.pending.popleft()
+            if not self.threadpool.started:
+                self.threadpool.start()
+            call = threads.deferToThreadPool(reactor, self.threadpool, self._call, worker, job, timeout)
+            call.addBoth(self._done, worker).chainDeferred(d)
+
+    def _done(self, result, worker):
+        """puts worker back unless it died, is worn out or forked before an update"""
+        if worker in self.workers:
+            if worker[1].closed or worker[2] >= self.max_tasks or worker[3] != self.generation:
+                self._kill(worker)
+            else:
+                self.idle.append(worker)
+        self._dispatch()
+        return result
+
+    def _fork(self):
+        conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_process_worker, args=(child_conn,))
+        process.daemon = True
+        process.start()
+        child_conn.close()
+        worker = [process, conn, 0, self.generation]
+        self.workers.append(worker)
+        return worker
+
+    def _kill(self, worker):
+        if worker in self.workers:
+            self.workers.remove(worker)
+        if not worker[1].closed:
+            worker[1].close()
+        worker[0].terminate()
+
+    def _call(self, worker, job, timeout):
+        """sends job to worker and waits for the result, in the pool's own
+           threadpool. Workers which fail are closed here and killed by _done"""
+        conn = worker[1]
+        try:
+            conn.send(job)
+        except (EOFError, IOError) as e:
+            conn.close()
+            raise ProcessError('worker died: %s' % e)
+        try:
+            if not conn.poll(timeout):
+                conn.close()
+                raise ProcessTimeout('no result after %s seconds' % timeout)
+            ok, result, extra = conn.recv()
+        except (EOFError, IOError) as e:
+            conn.close()
+            raise ProcessError('worker died: %s' % e)
+        except ProcessTimeout:
+            raise
+        except Exception:
+            # half read or unpicklable results leave the pipe in a mess
+            conn.close()
+            raise
+        worker[2] += 1
+        if not ok:
+            log.msg('process job %s failed:\n%s' % (job[0], extra))
+            raise ProcessError(result)
+        return result, extra
+
+### task scheduling ###
+class IntervalSpec:
+    """Runs every so many seconds"""
+    def __init__(self, seconds):
+        if seconds <= 0:
+            raise ValueError('tasks have to repeat after more than 0 seconds')
+        self.seconds = seconds
+
+    def next(self, after):
+        return after + self.seconds
+
+    def __str__(self):
+        return 'every %ss' % self.seconds
+
+class CronSpec:
+    """Five field cron expression, minute hour day month weekday in local
+       time. Fields take *, numbers, ranges, lists and /steps, weekday 0 and 7
+       are sunday. If both day and weekday are restricted either one matching
+       is enough, like vixie cron."""
+    aliases = {'@hourly': '0 * * * *', '@daily': '0 0 * * *', '@midnight': '0 0 * * *', '@weekly': '0 0 * * 0',
+               '@monthly': '0 0 1 * *', '@yearly': '0 0 1 1 *', '@annually': '0 0 1 1 *'}
+    ranges = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = self.aliases.get(expression.strip(), expression).split()
+        if len(fields) != 5:
+            raise ValueError('cron expressions have 5 fields: %s' % expression)
+        self.minutes, self.hours, self.days, self.months, weekdays = [self._parse(field, low, high)
+                                                                      for field, (low, high) in zip(fields, self.ranges)]
+        self.weekdays = set(x % 7 for x in weekdays)
+        self.any_day, self.any_weekday = fields[2] == '*', fields[4] == '*'
+
+    def _parse(self, field, low, high):
+        values = set()
+        for part in field.split(','):
+            part, _, step = part.partition('/')
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = map(int, part.split('-', 1))
+            else:
+                # 5/15 is every 15 from 5 on
+                start = int(part)
+                end = high if step else start
+            if start < low or end > high or start > end:
+                raise ValueError('%s is out of range %d-%d' % (part, low, high))
+            values.update(xrange(start, end + 1, int(step or 1)))
+        return values
+
+    def _day_matches(self, day):
+        in_month = day.day in self.days
+        in_week = (day.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return in_month and in_week
+        return in_month or in_week
+
+    def next(self, after):
+        """returns the first matching minute after timestamp after"""
+        when = datetime.datetime.fromtimestamp(after).replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        # skips whole months, days and hours at a time, gives up on things like feb 30
+        limit = when.year + 5
+        while when.year <= limit:
+            if when.month not in self.months:
+                when = (when.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(when):
+                when = when.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif when.hour not in self.hours:
+                when = when.replace(minute=0) + datetime.timedelta(hours=1)
+            elif when.minute not in self.minutes:
+                when += datetime.timedelta(minutes=1)
+            else:
+                return time.mktime(when.timetuple())
+        raise ValueError('%s never matches' % self.expression)
+
+    def __str__(self):
+        return 'cron %s' % self.expression
+
+class TimerWheel:
+    """Hierarchical timing wheel. Level n has slots buckets of slots ** n ticks
+       each, timers cascade down a level as their time comes closer, so adding
+       and expiring are O(1) however many timers there are. Anything further
+       off than the top level covers waits there for another turn."""
+    def __init__(self, tick, now, slots=64, levels=4):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.wheels = [[[] for x in xrange(slots)] for y in xrange(levels)]
+        self.current = int(now / tick)
+
+    def add(self, when, item):
+        """adds item to expire at timestamp when, at the earliest next tick"""
+        self._place(max(int(math.ceil(when / self.tick)), self.current + 1), item)
+
+    def _place(self, ticks, item):
+        delta, span = ticks - self.current, self.slots
+        for level in xrange(self.levels):
+            if delta < span or level == self.levels - 1:
+                self.wheels[level][(ticks // (span / self.slots)) % self.slots].append((ticks, item))
+                return
+            span *= self.slots
+
+    def advance(self, now):
+        """moves to timestamp now, returns items that expired on the way in order"""
+        expired = []
+        target = int(now / self.tick)
+        while self.current < target:
+            self.current += 1
+            span = self.slots
+            for level in xrange(1, self.levels):
+                if self.current % span:
+                    break
+                slot = (self.current // span) % self.slots
+                timers, self.wheels[level][slot] = self.wheels[level][slot], []
+                for ticks, item in timers:
+                    self._place(ticks, item)
+                span *= self.slots
+            slot = self.current % self.slots
+            timers, self.wheels[0][slot] = self.wheels[0][slot], []
+            for ticks, item in timers:
+                if ticks <= self.current:
+                    expired.append(item)
+                else:
+                    self._place(ticks, item)
+        return expired
+
+class ScheduledTask:
+    """A task, when it runs next and how its runs went"""
+    def __init__(self, name, run, spec, jitter=0, coalesce=True):
+        self.name = name
+        self.run = run
+        self.spec = spec
+        self.jitter = jitter
+        self.coalesce = coalesce
+        # nominal time of the next run, None while running or paused
+        self.due = None
+        self.generation = 0
+        self.running = False
+        self.paused = False
+        self.runs = 0
+        self.failures = 0
+        self.missed = 0
+        self.last_run = None
+        self.last_duration = None
+        self.last_error = None
+
+class ChiiScheduler:
+    """Runs every task off one timer wheel ticking on the reactor. A task's
+       next run is only scheduled once its last one is done, so runs never
+       overlap. Runs missed meanwhile are coalesced into one, or all made up
+       back to back for tasks which don't coalesce. run is called on the
+       reactor and may return a deferred, it decides where the task runs."""
+    def __init__(self, tick=1.0, clock=reactor):
+        self.tick = tick
+        self.clock = clock
+        self.wheel = TimerWheel(tick, clock.seconds())
+        self.tasks = OrderedDict()
+        self.loop = LoopingCall(self._tick)
+        self.loop.clock = clock
+
+    def add(self, name, run, spec, jitter=0, coalesce=True, now=False):
+        """schedules run, replacing any task called name. With now it first
+           runs on the next tick instead of when spec is next due"""
+        self.remove(name)
+        task = self.tasks[name] = ScheduledTask(name, run, spec, jitter, coalesce)
+        started = self.clock.seconds()
+        self._schedule(task, started if now else spec.next(started))
+        if not self.loop.running:
+            self.loop.start(self.tick, now=False)
+        return task
+
+    def remove(self, name):
+        """unschedules a task, a run in progress finishes"""
+        task = self.tasks.pop(name, None)
+        if task:
+            task.generation += 1
+        if not self.tasks and self.loop.running:
+            self.loop.stop()
+
+    def pause(self, name):
+        task = self.tasks.get(name)
+        if task:
+            task.paused = True
+            task.due = None
+            task.generation += 1
+        return task
+
+    def resume(self, name):
+        task = self.tasks.get(name)
+        if task and task.paused:
+            task.paused = False
+            if not task.running:
+                self._schedule(task, task.spec.next(self.clock.seconds()))
+        return task
+
+    def run_now(self, name):
+        """runs a task right away, its schedule carries on from now. Returns
+           False if it's running already"""
+        task = self.tasks.get(name)
+        if task and task.running:
+            return False
+        if task:
+            task.generation += 1
+            self._run(task, self.clock.seconds())
+        return task
+
+    def _schedule(self, task, due):
+        task.due = due
+        task.generation += 1
+        self.wheel.add(due + random.uniform(0, task.jitter) if task.jitter else due, (task, task.generation))
+
+    def _tick(self):
+        for task, generation in self.wheel.advance(self.clock.seconds()):
+            # paused, removed and rescheduled tasks leave stale timers behind
+            if task.generation == generation and self.tasks.get(task.name) is task:
+                self._run(task, task.due)
+
+    def _run(self, task, due):
+        task.running = True
+        task.due = None
+        d = defer.maybeDeferred(task.run)
+        d.addBoth(self._finished, task, due, self.clock.seconds())
+
+    def _finished(self, result, task, due, started):
+        now = self.clock.seconds()
+        task.running = False
+        task.runs += 1
+        task.last_run, task.last_duration = started, now - started
+        if isinstance(result, failure.Failure):
+            task.failures += 1
+            task.last_error = result.getErrorMessage()
+            print 'task %s failed' % task.name
+            result.printTraceback()
+        if task.paused or self.tasks.get(task.name) is not task:
+            return
+        following = task.spec.next(due)
+        if task.coalesce:
+            # only the last missed run is made up
+            later = task.spec.next(following)
+            while later <= now:
+                following, later = later, task.spec.next(later)
+                task.missed += 1
+        self._schedule(task, following)
+
+### outbound ###
+def split_message(message, limit):
+    """splits message into lines of at most limit bytes, preferring to break at
+       spaces and never splitting a utf-8 character"""
+    if isinstance(message, unicode):
+        message = message.encode('utf-8')
+    lines = []
+    for line in message.split('\n'):
+        line = line.rstrip('\r')
+        while len(line) > limit:
+            cut = line.rfind(' ', 0, limit + 1)
+            if cut < limit / 2:
+                cut = limit
+                # back up to the start of a multibyte character
+                while cut > 0 and 0x80 <= ord(line[cut]) < 0xc0:
+                    cut -= 1
+            lines.append(line[:cut])
+            line = line[cut:].lstrip(' ')
+        if line:
+            lines.append(line)
+    return lines
+
+class ChiiOutbound:
+    """Schedules every outgoing line. A token bucket keeps us under the server's
+       flood limits, higher priority lines go first and targets of the same
+       priority are served round-robin so one channel can't starve the rest."""
+
+    priorities = ('high', 'normal', 'low')
+
+    def __init__(self, send, config, clock=reactor):
+        self.send_now = send
+        self.clock = clock
+        self.burst = config['flood_burst'] or 5
+        self.rate = float(config['flood_rate'] or 1.0)
+        self.bytes_per_token = config['flood_bytes']
+        self.max_queue = config['flood_max_queue'] or 100
+        self.tokens = float(self.burst)
+        self.updated = clock.seconds()
+        self.queues = dict((x, {}) for x in self.priorities)
+        self.order = dict((x, deque()) for x in self.priorities)
+        self.pending = None
+        self.counters = defaultdict(int)
+        self.max_wait = 0.0
+
+    def message(self, command, target, message, nickname, priority='normal'):
+        """splits message to fit the 512 byte line limit and queues it"""
+        # servers relay our line with our full hostmask prefixed, assume the longest one
+        prefix = len(':%s!%s@%s ' % (nickname, 'x' * 10, 'x' * 63))
+        limit = 510 - prefix - len('%s %s :' % (command, target))
+        for line in split_message(message, limit):
+            self.line('%s %s :%s' % (command, target, line), priority, target)
+
+    def line(self, line, priority=None, target=None):
+        """queues a raw line, privmsgs and notices are queued per target"""
+        if not threadable.isInIOThread():
+            reactor.callFromThread(self.line, line, priority, target)
+            return
+        if isinstance(line, unicode):
+            line = line.encode('utf-8')
+        parts = line.split(' ', 2)
+        if parts[0].upper() in ('PRIVMSG', 'NOTICE') and len(parts) > 1:
+            target = target or parts[1]
+            priority = priority or 'normal'
+        else:
+            # protocol lines (pong, mode, kick, ...) go ahead of chatter
+            priority = priority or 'high'
+        target = target and target.lower()
+
+        queues = self.queues[priority]
+        if target not in queues:
+            queues[target] = deque()
+            self.order[priority].append(target)
+        queue = queues[target]
+        if len(queue) >= self.max_queue:
+            queue.popleft()
+            self.counters['dropped'] += 1
+        queue.append((self.clock.seconds(), line))
+        self.counters['queued'] += 1
+        # while throttled the drain that's already scheduled picks it up
+        if self.pending is None:
+            self._drain()
+
+    def stop(self):
+        """cancels pending sends and forgets queued lines"""
+        if self.pending and self.pending.active():
+            self.pending.cancel()
+        self.pending = None
+        for priority in self.priorities:
+            self.queues[priority].clear()
+            self.order[priority].clear()
+
+    def stats(self):
+        """returns counters and current queue depths"""
+        stats = dict(self.counters)
+        stats['tokens'] = round(self.tokens, 2)
+        stats['max_wait'] = round(self.max_wait, 3)
+        for priority in self.priorities:
+            stats[priority] = sum(len(x) for x in self.queues[priority].itervalues())
+        stats['targets'] = dict((target or 'server', len(queue)) for priority in self.priorities
+                                for target, queue in self.queues[priority].iteritems())
+        return stats
+
+    def _cost(self, line):
+        if self.bytes_per_token:
+            return 1 + len(line) / float(self.bytes_per_token)
+        return 1
+
+    def _peek(self):
+        """returns (priority, target) of the next line to send"""
+        for priority in self.priorities:
+            if self.order[priority]:
+                return priority, self.order[priority][0]
+
+    def _drain(self):
+        self.pending = None
+        now = self.clock.seconds()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        while True:
+            next = self._peek()
+            if next is None:
+                return
+            priority, target = next
+            queue = self.queues[priority][target]
+            queued, line = queue[0]
+            cost = self._cost(line)
+            if self.tokens < cost:
+                if self.pending is None:
+                    self.pending = self.clock.callLater((cost - self.tokens) / self.rate, self._drain)
+                return
+            self.tokens -= cost
+            queue.popleft()
+            # round-robin: move target to the back of its priority
+            self.order[priority].popleft()
+            if queue:
+                self.order[priority].append(target)
+            else:
+                del self.queues[priority][target]
+            self.max_wait = max(self.max_wait, now - queued)
+            self.counters['sent'] += 1
+            self.send_now(line)
+
 ### application logic ###
+class LogIndex:
+    """Sidecar index of the offset and time of every line in a log file. Gets
+       the nth line from the end or the lines between two times without
+       scanning the log."""
+    record = struct.Struct('<Qd')
+    stamp = re.compile(r'^\[(\d\d):(\d\d):(\d\d)\]')
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + '.idx'
+
+    def __len__(self):
+        try:
+            return os.path.getsize(self.index_path) // self.record.size
+        except OSError:
+            return 0
+
+    def line(self, n):
+        """returns nth line from the end, 1 being the last line"""
+        lines = self.lines(len(self) - n, len(self) - n + 1)
+        if lines:
+            return lines[0]
+
+    def tail(self, n):
+        """returns last n lines, oldest first"""
+        count = len(self)
+        return self.lines(max(count - n, 0), count)
+
+    def records(self, first, last):
+        """returns (offset, time) of lines first up to last, by line number"""
+        if first < 0 or first >= last:
+            return []
+        size = self.record.size
+        with open(self.index_path, 'rb') as idx:
+            idx.seek(first * size)
+            data = idx.read((last - first) * size)
+        return [self.record.unpack_from(data, i) for i in xrange(0, len(data) - size + 1, size)]
+
+    def lines(self, first, last):
+        """returns lines first up to last, by line number"""
+        lines = []
+        with open(self.path, 'rb') as log:
+            for offset, when in self.records(first, last):
+                log.seek(offset)
+                lines.append(log.readline().rstrip('\n'))
+        return lines
+
+    def between(self, start, end):
+        """returns lines logged at or after start and before end (unix times)"""
+        with open(self.index_path, 'rb') as idx:
+            count = len(self)
+            first, last = self._bisect(idx, count, start), self._bisect(idx, count, end)
+        return self.lines(first, last)
+
+    def _bisect(self, idx, count, when):
+        """returns number of the first line logged at or after when"""
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            idx.seek(mid * self.record.size)
+            if self.record.unpack(idx.read(self.record.size))[1] < when:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def sync(self):
+        """indexes lines missing from the index, rebuilding it if it doesn't match the log.
+           Log lines only carry the time of day, so dates are worked out from where
+           the clock wraps around midnight."""
+        if not os.path.exists(self.path):
+            open(self.index_path, 'wb').close()
+            return
+        size = os.path.getsize(self.path)
+        count = len(self)
+        start, when = 0, None
+        if count:
+            with open(self.index_path, 'rb') as idx:
+                idx.seek((count - 1) * self.record.size)
+                start, when = self.record.unpack(idx.read(self.record.size))
+            if start >= size:
+                count, start, when = 0, 0, None
+        if count:
+            # truncate partial records, skip the last indexed line
+            with open(self.index_path, 'ab') as idx:
+                idx.truncate(count * self.record.size)
+            with open(self.path, 'rb') as log:
+                log.seek(start)
+                start += len(log.readline())
+            day = datetime.date.fromtimestamp(when)
+            clock = self._clock(when)
+        else:
+            open(self.index_path, 'wb').close()
+            # count midnights between the first line and the last modification
+            wraps, clock = 0, None
+            with open(self.path, 'rb') as log:
+                for line in log:
+                    seconds = self._parse(line)
+                    if seconds is not None:
+                        if clock is not None and seconds < clock:
+                            wraps += 1
+                        clock = seconds
+            day = datetime.date.fromtimestamp(os.path.getmtime(self.path)) - datetime.timedelta(days=wraps)
+            clock = None
+        with open(self.path, 'rb') as log:
+            with open(self.index_path, 'ab') as idx:
+                log.seek(start)
+                offset = start
+                for line in log:
+                    if not line.endswith('\n'):
+                        break
+                    seconds = self._parse(line)
+                    if seconds is not None:
+                        if clock is not None and seconds < clock:
+                            day += datetime.timedelta(days=1)
+                        clock = seconds
+                    if clock is not None:
+                        when = time.mktime(day.timetuple()) + clock
+                    idx.write(self.record.pack(offset, when or 0))
+                    offset += len(line)
+
+    def _parse(self, line):
+        match = self.stamp.match(line)
+        if match:
+            h, m, s = match.groups()
+            return int(h) * 3600 + int(m) * 60 + int(s)
+
+    def _clock(self, when):
+        t = time.localtime(when)
+        return t.tm_hour * 3600 + t.tm_min * 60 + t.tm_sec
+
+class LogFile:
+    """An open log file and its index, only used by the logger's writer thread"""
+    def __init__(self, path, day):
+        index = LogIndex(path)
+        if os.path.exists(path):
+            index.sync()
+            self.opened = time.strftime('%Y-%m-%d', time.localtime(os.path.getmtime(path)))
+        else:
+            self.opened = day
+        self.log = open(path, 'ab')
+        self.log.seek(0, 2)
+        self.size = self.log.tell()
+        self.idx = open(index.index_path, 'ab')
+
+    def write(self, line, when):
+        self.idx.write(LogIndex.record.pack(self.size, when))
+        self.log.write(line)
+        self.size += len(line)
+
+    def flush(self):
+        # log first, so the index never points past the end of the log
+        self.log.flush()
+        self.idx.flush()
+
+    def close(self):
+        self.log.close()
+        self.idx.close()
+
+class SearchIndex:
+    """Inverted index over the channel logs, term -> posting list of lines.
+       New lines are collected in memory and written out as segments, which
+       are merged once there are too many of them. Every line is a document
+       with the log file, offset and time it was logged at."""
+    doc = struct.Struct('<Iqd')
+    word = re.compile(r'\w+', re.U)
+    speaker = re.compile(r'^(?:<[@+%&~]?([^>\s]+)>|\* (\S+))')
+    rotated = re.compile(r'\.\d{4}-\d\d-\d\d[\d.-]*$')
+
+    def __init__(self, directory, sync=None, interval=5, segment_size=50000, max_segments=8):
+        self.directory = directory
+        self.sync = sync or (lambda path: LogIndex(path).sync())
+        self.interval = interval
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.lock = threading.RLock()
+        self.touched = set()
+        self.wakeup = threading.Event()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.meta_path = os.path.join(directory, 'meta.json')
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {'files': [], 'segments': [], 'next_segment': 0}
+        self.paths = dict((entry[0], n) for n, entry in enumerate(self.meta['files']))
+        self.segments = [self._load_segment(x) for x in self.meta['segments']]
+        self.docs_file = open(os.path.join(directory, 'docs'), 'a+b')
+        self.docs_file.seek(0, 2)
+        self.doc_count = self.docs_file.tell() // self.doc.size
+        if 'doc_count' in self.meta and self.meta['doc_count'] < self.doc_count:
+            # docs of lines which never made it into a segment, they're indexed again
+            self.doc_count = self.meta['doc_count']
+            self.docs_file.truncate(self.doc_count * self.doc.size)
+            self.docs_file.seek(0, 2)
+        self.docs_map = None
+        self.memory = defaultdict(lambda: array.array('I'))
+        self.memory_docs = 0
+        self.flushed = time.time()
+
+    # api
+    def search(self, query, nick=None, channel=None, since=None, until=None, page=1, per_page=5):
+        """returns (total hits, hits) for query, ranked by matched terms then
+           recency. Hits are dicts with channel, time and line."""
+        terms = set(self._tokens(query))
+        required = []
+        if nick:
+            required.append('nick:' + nick.lower())
+        if channel:
+            required.append('chan:' + channel.lstrip('#').lower())
+        if not terms and not required:
+            return 0, []
+        with self.lock:
+            total_docs = float(self.doc_count + self.memory_docs) or 1.0
+            scores = defaultdict(float)
+            for term in terms:
+                postings = self._postings(term)
+                if postings:
+                    idf = math.log(total_docs / len(postings)) + 1
+                    for doc_id in postings:
+                        scores[doc_id] += idf
+            if required:
+                allowed = set(self._postings(required[0]))
+                for term in required[1:]:
+                    allowed.intersection_update(self._postings(term))
+                if terms:
+                    scores = dict((x, y) for x, y in scores.iteritems() if x in allowed)
+                else:
+                    scores = dict.fromkeys(allowed, 0.0)
+            docs = self._docs()
+            ranked = []
+            for doc_id, score in scores.iteritems():
+                file_id, offset, when = docs(doc_id)
+                if since and when < since or until and when >= until:
+                    continue
+                ranked.append((-score, -when, doc_id, file_id, offset, when))
+            ranked.sort()
+            start = (max(page, 1) - 1) * per_page
+            hits = []
+            for _, _, doc_id, file_id, offset, when in ranked[start:start + per_page]:
+                path, channel = self.meta['files'][file_id][:2]
+                hits.append({'channel': channel, 'time': when, 'line': self._read_line(path, offset)})
+            return len(ranked), hits
+
+    def touch(self, path):
+        """marks log file as having new lines to index"""
+        with self.lock:
+            self.touched.add(path)
+
+    def renamed(self, old, new):
+        """log file was rotated, lines already indexed keep pointing at it"""
+        with self.lock:
+            if old in self.paths:
+                file_id = self.paths.pop(old)
+                self.meta['files'][file_id][0] = new
+                self.paths[new] = file_id
+                self.touch(new)
+
+    def start(self, logs_dir=None, skip=()):
+        """starts indexing thread, indexing every log in logs_dir but the
+           paths in skip first"""
+        if logs_dir:
+            for name in os.listdir(logs_dir):
+                path = os.path.join(logs_dir, name)
+                if name.endswith('.log') and path not in skip:
+                    self.touch(path)
+        thread = threading.Thread(target=self._run, name='chii-search')
+        thread.daemon = True
+        thread.start()
+
+    def update(self):
+        """indexes new lines in touched files, writing and merging segments as needed"""
+        with self.lock:
+            touched, self.touched = self.touched, set()
+        for path in touched:
+            self._index_file(path)
+        with self.lock:
+            if self.memory_docs >= self.segment_size or self.memory_docs and time.time() - self.flushed > 60:
+                self._write_segment()
+            if len(self.segments) > self.max_segments:
+                self._merge()
+
+    # internals
+    def _run(self):
+        while True:
+            try:
+                self.update()
+            except Exception:
+                traceback.print_exc()
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+    def _tokens(self, text):
+        if isinstance(text, str):
+            text = text.decode('utf-8', 'replace')
+        return [x.encode('utf-8') for x in self.word.findall(text.lower())]
+
+    def _index_file(self, path):
+        if not os.path.exists(path):
+            return
+        if not os.path.exists(path + '.idx'):
+            self.sync(path)
+        with self.lock:
+            if path not in self.paths:
+                name = os.path.basename(path)[:-len('.log')]
+                channel = self.rotated.sub('', name)
+                self.paths[path] = len(self.meta['files'])
+                self.meta['files'].append([path, channel, 0])
+            file_id = self.paths[path]
+            path, channel, indexed = self.meta['files'][file_id]
+        index = LogIndex(path)
+        count = len(index)
+        # index in chunks so searches aren't blocked for long
+        while indexed < count:
+            last = min(indexed + 10000, count)
+            records = index.records(indexed, last)
+            with open(path, 'rb') as log:
+                if records:
+                    log.seek(records[0][0])
+                lines = [log.readline() for x in records]
+            with self.lock:
+                for (offset, when), line in zip(records, lines):
+                    self._add(file_id, channel, offset, when, line)
+                indexed = last
+                self.meta['files'][file_id][2] = indexed
+                if self.memory_docs >= self.segment_size:
+                    self._write_segment()
+
+    def _add(self, file_id, channel, offset, when, line):
+        doc_id = self.doc_count + self.memory_docs
+        self.docs_file.write(self.doc.pack(file_id, offset, when))
+        self.memory_docs += 1
+        text = line.split(']', 1)[-1].strip()
+        terms = set(self._tokens(text))
+        terms.add('chan:' + channel.lower())
+        speaker = self.speaker.match(text)
+        if speaker:
+            terms.add('nick:' + (speaker.group(1) or speaker.group(2)).lower())
+        for term in terms:
+            self.memory[term].append(doc_id)
+
+    def _postings(self, term):
+        postings = array.array('I')
+        for terms, data in self.segments:
+            if term in terms:
+                start, count = terms[term]
+                postings.fromstring(data[start * 4:(start + count) * 4])
+        if term in self.memory:
+            postings.extend(self.memory[term])
+        return postings
+
+    def _docs(self):
+        """returns function looking up (file id, offset, time) by doc id"""
+        self.docs_file.flush()
+        size = self.docs_file.tell()
+        if self.docs_map is None or len(self.docs_map) < size:
+            if self.docs_map is not None:
+                self.docs_map.close()
+            self.docs_map = mmap.mmap(self.docs_file.fileno(), size, access=mmap.ACCESS_READ) if size else ''
+        docs_map = self.docs_map
+        return lambda doc_id: self.doc.unpack_from(docs_map, doc_id * self.doc.size)
+
+    def _read_line(self, path, offset):
+        try:
+            with open(path, 'rb') as log:
+                log.seek(offset)
+                return log.readline().rstrip('\n')
+        except IOError:
+            return ''
+
+    def _segment_path(self, name, ext):
+        return os.path.join(self.directory, '%s.%s' % (name, ext))
+
+    def _load_segment(self, name):
+        with open(self._segment_path(name, 'terms'), 'rb') as f:
+            terms = marshal.load(f)
+        with open(self._segment_path(name, 'post'), 'rb') as f:
+            data = f.read()
+        return terms, data
+
+    def _save(self, postings):
+        """writes term -> postings to a new segment, returns its name"""
+        name = 'seg-%d' % self.meta['next_segment']
+        self.meta['next_segment'] += 1
+        terms, offset = {}, 0
+        with open(self._segment_path(name, 'post'), 'wb') as f:
+            for term in sorted(postings):
+                doc_ids = postings[term]
+                doc_ids.tofile(f)
+                terms[term] = (offset, len(doc_ids))
+                offset += len(doc_ids)
+        with open(self._segment_path(name, 'terms'), 'wb') as f:
+            marshal.dump(terms, f)
+        return name
+
+    def _save_meta(self):
+        """saves meta along with how many docs are in segments. Lines only in
+           memory aren't counted as indexed, so it's only saved without any"""
+        self.docs_file.flush()
+        self.meta['doc_count'] = self.doc_count
+        with open(self.meta_path + '.tmp', 'w') as f:
+            json.dump(self.meta, f)
+        os.rename(self.meta_path + '.tmp', self.meta_path)
+
+    def _write_segment(self):
+        """writes in-memory postings out as a segment, must hold lock"""
+        if self.memory_docs:
+            name = self._save(self.memory)
+            self.meta['segments'].append(name)
+            self.segments.append(self._load_segment(name))
+            self.doc_count += self.memory_docs
+        self.memory.clear()
+        self.memory_docs = 0
+        self.flushed = time.time()
+        self._save_meta()
+
+    def _merge(self):
+        """merges all segments into one, must hold lock"""
+        if self.memory_docs:
+            self._write_segment()
+        merged = defaultdict(lambda: array.array('I'))
+        for terms, data in self.segments:
+            for term, (start, count) in terms.iteritems():
+                merged[term].fromstring(data[start * 4:(start + count) * 4])
+        old = self.meta['segments']
+        name = self._save(merged)
+        self.meta['segments'] = [name]
+        self.segments = [self._load_segment(name)]
+        self._save_meta()
+        for segment in old:
+            for ext in ('terms', 'post'):
+                os.remove(self._segment_path(segment, ext))
+
 class ChiiLogger:
-    """Logs both irc events and chii events into different log files"""
-    def __init__(self, config):
+    """Logs both irc events and chii events into different log files. Lines are
+       handed to a writer thread which batches writes, keeps a bounded pool of
+       open files and rotates them, so logging never blocks the reactor."""
+    def __init__(self, config, network=None, log_chii=True):
         self.logs_dir = config['logs_dir']
-        self.channel_logs = {}
+        if self.logs_dir and network:
+            # every network logs to its own directory, channel names clash otherwise
+            self.logs_dir = os.path.join(self.logs_dir, network)
+        self.log_channels = config['log_channels']
+        self.log_privmsg = config['log_privmsg']
+        self.rotate = config['log_rotate']
+        self.max_files = config['log_max_files'] or 64
+        self.flush_interval = config['log_flush_interval'] or 1.0
         self.chii_log = None
-        self.log_privmsg = False
+        self.files = OrderedDict()
+        self.queue = Queue.Queue()
+        self._second = None
+        self._stamp = None
+        self.search = None
 
         if self.logs_dir:
             if not os.path.isdir(self.logs_dir):
-                os.mkdir(self.logs_dir)
-            if config['log_channels']:
-                self.channel_logs = dict(((channel, open(os.path.join(self.logs_dir, channel +'.log'), 'a')) for channel in config['channels']))
-            if config['log_chii']:
-                self.chii_log = open(os.path.join(self.logs_dir, config['nickname'] + '.log'), 'a')
+                os.makedirs(self.logs_dir)
+            if config['log_chii'] and log_chii:
+                self.chii_log = open(os.path.join(config['logs_dir'], config['nickname'] + '.log'), 'a')
                 self.observer = log.FileLogObserver(self.chii_log)
                 self.observer.start()
-            if config['log_privmsg']:
-                self.log_privmsg = True
+            self.writer = threading.Thread(target=self._write, name='chii-logger')
+            self.writer.daemon = True
+            self.writer.start()
+            # the writer is a daemon thread, have it catch up before we exit
+            reactor.addSystemEventTrigger('before', 'shutdown', self.flush)
+            if config['log_search']:
+                self.search = SearchIndex(os.path.join(self.logs_dir, '.search'), sync=self.sync_index)
+                # chii's own log isn't a channel
+                self.search.start(self.logs_dir, skip=[os.path.join(config['logs_dir'], config['nickname'] + '.log')])
         else:
-            self.log = self.close = lambda *args: None
+            self.log = self.close = self.flush = lambda *args: None
 
     def log(self, message, channel=None):
-        """Write a message to the file."""
+        """Queue a message to be written to the file."""
         if channel:
             if channel.startswith('#'):
                 channel = channel[1:]
-            if channel in self.channel_logs:
-                file = self.channel_logs[channel]
-                timestamp = time.strftime("[%H:%M:%S]", time.localtime(time.time()))
-                file.write('%s %s\n' % (timestamp, message))
-                file.flush()
-            elif self.log_privmsg:
-                file = open(os.path.join(self.logs_dir, channel + '.log'), 'a')
-                timestamp = time.strftime("[%H:%M:%S]", time.localtime(time.time()))
-                file.write('%s %s\n' % (timestamp, message))
-                file.close()
+                if not self.log_channels:
+                    return
+            elif not self.log_privmsg:
+                return
+            now = time.time()
+            if int(now) != self._second:
+                # strftime is only worth calling once a second
+                self._second = int(now)
+                self._stamp = time.strftime("[%H:%M:%S]", time.localtime(now))
+            # one log line per line of a multi-line message, each with the
+            # speaker of the first so searching by nick finds all of them
+            lines = message.split('\n')
+            speaker = SearchIndex.speaker.match(lines[0]) if len(lines) > 1 else None
+            for n, line in enumerate(lines):
+                if n and speaker:
+                    line = '%s %s' % (speaker.group(0), line)
+                self.queue.put((channel, '%s %s\n' % (self._stamp, line), now))
 
-    def close(self):
+    def flush(self, func=None):
+        """Blocks until queued messages are written, optionally running func
+           in the writer thread afterwards. The reactor can't wait on the
+           writer, so there it returns a deferred which fires then instead."""
+        if threadable.isInIOThread():
+            d = defer.Deferred()
+            self.queue.put((None, func, lambda: reactor.callFromThread(d.callback, None)))
+            return d
+        done = threading.Event()
+        self.queue.put((None, func, done.set))
+        done.wait(5)
+
+    def sync_index(self, path):
+        """brings LogIndex of a log up to date without racing the writer"""
+        def sync():
+            if not any(x.log.name == path for x in self.files.itervalues()):
+                LogIndex(path).sync()
+        self.flush(sync)
+
+    def close(self, *args):
+        def close_files():
+            while self.files:
+                self.files.popitem()[1].close()
+        d = self.flush(close_files)
         if self.chii_log:
             self.observer.stop()
             self.chii_log.close()
-        for channel in self.channel_logs.values():
-            channel.close()
+            self.chii_log = None
+        return d
+
+    # everything below runs in the writer thread
+    def _write(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.flush_interval
+            while batch[-1][0] is not None and len(batch) < 1000:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except Queue.Empty:
+                    break
+            try:
+                self._write_batch(batch)
+            except Exception:
+                traceback.print_exc()
+
+    def _write_batch(self, batch):
+        written = set()
+        for channel, line, when in batch:
+            if channel is None:
+                # flush request, line is a function to run afterwards
+                self._flush(written)
+                written.clear()
+                try:
+                    if line:
+                        line()
+                finally:
+                    when()
+                continue
+            if isinstance(line, unicode):
+                line = line.encode('utf-8')
+            self._open(channel, when).write(line, when)
+            written.add(channel)
+        self._flush(written)
+
+    def _flush(self, written):
+        for name in written:
+            if name in self.files:
+                self.files[name].flush()
+                if self.search:
+                    self.search.touch(self.files[name].log.name)
+
+    def _path(self, channel, suffix=None):
+        if suffix:
+            return os.path.join(self.logs_dir, '%s.%s.log' % (channel, suffix))
+        return os.path.join(self.logs_dir, channel + '.log')
+
+    def _open(self, channel, when):
+        """returns open file for channel, rotating it if needed"""
+        day = time.strftime('%Y-%m-%d', time.localtime(when))
+        if channel in self.files:
+            log_file = self.files.pop(channel)
+        else:
+            log_file = LogFile(self._path(channel), day)
+            while len(self.files) >= self.max_files:
+                # close least recently used file
+                self.files.popitem(last=False)[1].close()
+        if self.rotate == 'daily' and log_file.opened != day:
+            log_file = self._rotate(channel, log_file, log_file.opened, day)
+        elif isinstance(self.rotate, int) and log_file.size >= self.rotate:
+            log_file = self._rotate(channel, log_file, time.strftime('%Y-%m-%d-%H%M%S', time.localtime(when)), day)
+        self.files[channel] = log_file
+        return log_file
+
+    def _rotate(self, channel, log_file, suffix, day):
+        log_file.close()
+        path = self._path(channel)
+        if log_file.size:
+            rotated, n = self._path(channel, suffix), 0
+            while os.path.exists(rotated):
+                n += 1
+                rotated = self._path(channel, '%s.%d' % (suffix, n))
+            os.rename(path, rotated)
+            os.rename(path + '.idx', rotated + '.idx')
+            if self.search:
+                self.search.renamed(path, rotated)
+        return LogFile(path, day)
+
+    def index(self, channel):
+        """returns LogIndex for channel's log, after writing queued messages.
+           On the reactor thread that's a deferred LogIndex"""
+        if channel.startswith('#'):
+            channel = channel[1:]
+        d = self.flush()
+        if d is not None:
+            return d.addCallback(lambda _: LogIndex(self._path(channel)))
+        return LogIndex(self._path(channel))
 
 class ChiiBot:
-    """what makes chii, chii"""
-    def _add_command(self, method):
-        """add new instance method to self.commands"""
+    """what makes chii, chii. Registry and plugin state live on the class, so
+       every network's protocol shares them"""
+    commands = {}
+    events = defaultdict(set)
+    tasks = {}
+    scheduler = None
+    event_triggers = {}
+    dispatcher = None
+    process_pool = None
+    metrics = ChiiMetrics()
+    roles = None
+    roles_version = None
+    help_index = {}
+    module_hashes = {}
+    module_registry = OrderedDict()
+    lazy_modules = set()
+    module_states = {}
+    handler_owners = {}
+    _init_tokens = {}
+    _init_errors = {}
+    _init_waiters = defaultdict(list)
+    import_stats = OrderedDict()
+    profile_startup = False
+    sampler = None
+    watcher = None
+    # connected protocols by network name, plugins can use these to talk to other networks
+    networks = {}
+    task_owner = None
+    http = None
+    command_cache = None
+
+    def _add_command(self, method, registry):
+        """add new instance method to commands"""
         if method.__name__ not in self.config['disabled_commands']:
             for name in method._command_names:
-                if name in self.commands:
+                if name in registry['commands']:
                     print 'Warning! commands registry already contains %s' % name
-                self.commands[name] = new.instancemethod(method, self, ChiiBot)
+                registry['commands'][name] = new.instancemethod(method, self, ChiiBot)
 
-    def _add_event(self, method):
-        """add new instance method to self.events"""
+    def _add_event(self, method, registry):
+        """add new instance method to events"""
         if method.__name__ not in self.config['disabled_events']:
             for event in method._event_types:
-                self.events[event].add(new.instancemethod(method, self, ChiiBot))
+                registry['events'][event].add(new.instancemethod(method, self, ChiiBot))
 
-    def _add_task(self, method):
-        """add new instance method to self.tasks"""
+    def _add_task(self, method, registry):
+        """add new instance method to tasks"""
         if method.__name__ not in self.config['disabled_tasks']:
-            self.tasks[method.__name__] = (new.instancemethod(method, self, ChiiBot), method._task_repeat, method._task_scale)
+            registry['tasks'][method.__name__] = (new.instancemethod(method, self, ChiiBot), method._task_repeat, method._task_scale)
+
+    def _add_init(self, method, registry):
+        """add new instance method to inits"""
+        registry['inits'].append(new.instancemethod(method, self, ChiiBot))
 
     def _add_to_registry(self, mod):
-        """Adds registred methods to registry"""
-        dispatch = {'commands': self._add_command, 'events': self._add_event, 'tasks': self._add_task}
+        """Returns registry of methods registered in mod"""
+        registry = {'commands': {}, 'events': defaultdict(set), 'tasks': {}, 'inits': []}
+        dispatch = {'commands': self._add_command, 'events': self._add_event, 'tasks': self._add_task, 'inits': self._add_init}
 
         registered = filter(lambda x: hasattr(x, '_registry'), (getattr(mod, x) for x in dir(mod) if not x.startswith('_')))
         for method in registered:
-            dispatch.get(method._registry)(method)
+            dispatch.get(method._registry)(method, registry)
+        return registry
+
+    def _find_modules(self):
+        """returns (path, package, module, file) of every module to load"""
+        found = []
+        for path in self.config['modules'] or ():
+            if os.path.isdir(path):
+                package = os.path.basename(path)
+                modules = sorted(f.replace('.py', '') for f in os.listdir(path) if f.endswith('.py') and f != '__init__.py')
+                files = [os.path.join(path, x + '.py') for x in modules]
+            else:
+                package = None
+                modules = [path]
+                files = [path + '.py']
+            for module, filename in zip(modules, files):
+                if module not in self.config['disabled_modules']:
+                    found.append(('%s.%s' % (package, module) if package else module, package, module, filename))
+        return found
+
+    def _module_hash(self, filename):
+        try:
+            with open(filename, 'rb') as f:
+                return hashlib.md5(f.read()).hexdigest()
+        except IOError:
+            return None
+
+    config_key = re.compile(r"""config\[['"](\w+)['"]\]""")
+
+    def _config_digest(self, filename):
+        """digest of the config keys a module reads, so its manifest entry
+           only goes stale when one of those changes"""
+        try:
+            with open(filename, 'rb') as f:
+                keys = sorted(set(self.config_key.findall(f.read())))
+        except IOError:
+            return None
+        return hashlib.md5(repr([(x, self.config[x]) for x in keys])).hexdigest()
 
-    def _import_module(self, package, module):
-        """imports, reloading if neccessary given package.module"""
+    def _import_module(self, package, module, filename=None, force=False):
+        """imports, reloading if neccessary given package.module. Modules
+           whose source hasn't changed since they were loaded are reused."""
         if package:
             path = '%s.%s' % (package, module)
         else:
             path = module
+        digest = filename and self._module_hash(filename)
+        if path in sys.modules and not force and digest and self.module_hashes.get(path) == digest:
+            return sys.modules[path]
         # cleanup if we're reloading
         if path in sys.modules:
             print 'Reloading', path
@@ -225,7 +2840,12 @@ class ChiiBot:
 
         # try to import module
         try:
+            started, memory = time.time(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
             mod = __import__(path, globals(), locals(), [module], -1)
+            # freshly imported, its inits have to run again
+            self.module_states.pop(path, None)
+            self.import_stats[path] = (time.time() - started, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - memory)
+            self.module_hashes[path] = digest
             return mod
         except Exception as e:
             print 'Error importing %s: %s' % (path, e)
@@ -233,81 +2853,338 @@ class ChiiBot:
 
     def _update_registry(self):
         """Updates command, event task registries"""
-        paths = self.config['modules']
-        if paths:
-            self.commands = {}
-            self.events = defaultdict(set)
-            self.tasks = {}
-            self.running_tasks = {}
-            for path in paths:
-                if os.path.isdir(path):
-                    package = os.path.basename(path)
-                    modules = [f.replace('.py', '') for f in os.listdir(path) if f.endswith('.py') and f != '__init__.py']
-                else:
-                    package = None
-                    modules = [path]
-                for module in modules:
-                    if module not in config['disabled_modules']:
-                        mod = self._import_module(package, module)
-                        if mod:
-                            self._add_to_registry(mod)
+        if ChiiBot.http is None:
+            # plugins share one http client
+            ChiiBot.http = ChiiHTTP(self.config)
+            share_http(ChiiBot.http)
+            ChiiBot.command_cache = ChiiCache(self.config)
+        if self.config['modules']:
+            ChiiBot.module_registry = OrderedDict()
+            ChiiBot.lazy_modules = set()
+            manifest = ModuleManifest(self.config['manifest_file'])
+            for path, package, module, filename in self._find_modules():
+                digest = self._module_hash(filename)
+                config_digest = self._config_digest(filename)
+                entry = manifest.get(path, digest, config_digest)
+                if self.config['lazy_modules'] and entry and path not in sys.modules and not self.profile_startup:
+                    # register stubs, the module is imported when one is used
+                    self.module_registry[path] = self._add_to_registry(manifest.stubs(path, self._load_lazy))
+                    self.module_registry[path]['lazy'] = True
+                    self.module_hashes[path] = digest
+                    self.lazy_modules.add(path)
+                    continue
+                mod = self._import_module(package, module, filename)
+                if mod:
+                    self.module_registry[path] = self._add_to_registry(mod)
+                    manifest.update(path, mod, digest, config_digest)
+            manifest.save()
+            self._rebuild_registry()
+            self._update_process_pool()
+            for path in self.module_registry:
+                self._start_inits(path)
+            if self.profile_startup:
+                self._print_import_stats()
+            if self.lazy_modules:
+                print '[lazy]', ', '.join(sorted(self.lazy_modules))
             print '[commands]', ', '.join(sorted(x for x in self.commands))
             print '[events]', ' '.join(sorted(x + ': ' + ', '.join(sorted(y.__name__ for y in self.events[x])) for x in self.events))
             print '[tasks]', ', '.join(sorted(x for x in self.tasks))
 
+    def _rebuild_registry(self):
+        """merges registries of all modules, swapping them in at once"""
+        commands, events, tasks = {}, defaultdict(set), {}
+        # lambdas aren't owned by a module, keep them
+        for name, method in getattr(self, 'commands', {}).iteritems():
+            if not hasattr(method, '_registry'):
+                commands[name] = method
+        for registry in self.module_registry.itervalues():
+            for name, method in registry['commands'].iteritems():
+                if name in commands and hasattr(commands[name], '_registry'):
+                    print 'Warning! commands registry already contains %s' % name
+                commands[name] = method
+            for event, methods in registry['events'].iteritems():
+                events[event].update(methods)
+            tasks.update(registry['tasks'])
+        event_triggers = dict((x, TriggerMatcher(events[x])) for x in events)
+        owners = {}
+        for path, registry in self.module_registry.iteritems():
+            for method in self._module_handlers(registry):
+                owners[method.im_func] = path
+        ChiiBot.commands, ChiiBot.events, ChiiBot.tasks, ChiiBot.event_triggers = commands, events, tasks, event_triggers
+        ChiiBot.handler_owners = owners
+        self._update_help_index()
+
+    def _reload_module(self, path, force=True):
+        """reloads a single module, only its registry entries and tasks are replaced.
+           Returns False if there is no such module."""
+        modules = dict((x[0], x) for x in self._find_modules())
+        if path not in modules and path not in self.module_registry:
+            return False
+        old = self.module_registry.get(path)
+        if old and not old.get('lazy'):
+            for event in old['events'].get('unload', ()):
+                self._event(event)
+            self._stop_tasks(old['tasks'])
+        if path in modules:
+            path, package, module, filename = modules[path]
+            mod = self._import_module(package, module, filename, force)
+        else:
+            mod = None
+        if mod:
+            self.module_registry[path] = self._add_to_registry(mod)
+        else:
+            self.module_registry.pop(path, None)
+        self._rebuild_registry()
+        new = self.module_registry.get(path)
+        if old and not old.get('lazy'):
+            # reloaded commands may answer differently
+            self.command_cache.clear(set(old['commands']))
+        if any(x._executor == 'process' for x in self._module_handlers(old) + self._module_handlers(new)):
+            self._update_process_pool()
+        self._start_inits(path)
+        if new:
+            for event in new['events'].get('load', ()):
+                self._when_ready(event, self._event, event)
+            self._start_tasks(new['tasks'])
+        return True
+
+    def _bind(self, method):
+        """registry methods are bound to whichever network loaded them, rebinds
+           method to this one so responses go out on the right connection"""
+        if getattr(method, 'im_self', self) is self:
+            return method
+        return new.instancemethod(method.im_func, self, ChiiBot)
+
+    def _start_inits(self, path):
+        """runs inits of a module unless they already ran, tracking its readiness"""
+        registry = self.module_registry.get(path)
+        if registry is None or path in self.module_states or registry.get('lazy'):
+            return
+        inits = registry['inits']
+        if not inits:
+            self.module_states[path] = 'ready'
+            return
+        # the module may be reloaded while warming up, only the latest inits count
+        token = object()
+        self.module_states[path] = 'warming'
+        self._init_tokens[path] = token
+        self._init_waiters.pop(path, None)
+
+        def done(result, state):
+            if self._init_tokens.get(path) is token:
+                self.module_states[path] = state
+                print '[init] %s %s' % (path, state)
+                if state == 'ready' and self.process_pool is not None and self.process_pool.workers:
+                    # workers are forked copies, replace them as they come free so they see what the inits loaded
+                    self._update_process_pool()
+                for func, args in self._init_waiters.pop(path, ()):
+                    if state == 'ready':
+                        func(*args)
+            if state == 'failed':
+                self._init_errors[path] = result.value.subFailure.getErrorMessage()
+                result.value.subFailure.printTraceback()
+
+        print '[init] %s warming up' % path
+        started = [threads.deferToThread(x) if x._init_threaded else defer.maybeDeferred(x) for x in inits]
+        d = defer.DeferredList(started, fireOnOneErrback=True, consumeErrors=True)
+        d.addCallbacks(done, done, callbackArgs=('ready',), errbackArgs=('failed',))
+
+    def _when_ready(self, method, func, *args):
+        """calls func once method's module is ready, never if its inits failed"""
+        path = self.handler_owners.get(getattr(method, 'im_func', None))
+        state = self.module_states.get(path, 'ready')
+        if path in self.lazy_modules or state == 'ready':
+            func(*args)
+        elif state == 'warming':
+            self._init_waiters[path].append((func, args))
+
+    def _not_ready(self, method):
+        """returns reason method's module can't run yet, None if it's ready"""
+        path = self.handler_owners.get(getattr(method, 'im_func', None))
+        state = self.module_states.get(path, 'ready')
+        if path in self.lazy_modules or state == 'ready':
+            return None
+        if state == 'failed':
+            return '%s failed to start: %s' % (path, self._init_errors.get(path))
+        return '%s is still warming up, try again in a bit' % path
+
+    def _load_lazy(self, path):
+        """imports a lazily loaded module, replacing its stubs"""
+        if not threadable.isInIOThread():
+            return threads.blockingCallFromThread(reactor, self._load_lazy, path)
+        if path in self.lazy_modules:
+            self.lazy_modules.discard(path)
+            self._reload_module(path, force=False)
+
+    def _print_import_stats(self):
+        """prints import time and memory growth of every module, slowest first"""
+        print '%-30s %10s %10s' % ('module', 'seconds', 'max rss kb')
+        for path, (seconds, memory) in sorted(self.import_stats.iteritems(), key=lambda x: -x[1][0]):
+            print '%-30s %10.3f %10d' % (path, seconds, memory)
+        print '%-30s %10.3f' % ('total', sum(x[0] for x in self.import_stats.itervalues()))
+
+    def _module_handlers(self, registry):
+        if not registry:
+            return []
+        handlers = registry['commands'].values()
+        for methods in registry['events'].itervalues():
+            handlers.extend(methods)
+        handlers.extend(x[0] for x in registry['tasks'].itervalues())
+        return handlers
+
+    def _changed_modules(self):
+        """returns paths of modules which were added, removed or changed on disk"""
+        modules = self._find_modules()
+        changed = [x[0] for x in modules if self.module_hashes.get(x[0]) != self._module_hash(x[3])]
+        found = set(x[0] for x in modules)
+        return changed + [x for x in self.module_registry if x not in found]
+
+    def _update_process_pool(self):
+        """registers process handlers with the pool, workers are only forked
+           once jobs are submitted"""
+        if self.config['processes'] == 0:
+            return
+        handlers = set(x.im_func for x in self.commands.values() if hasattr(x, 'im_func') and x._executor == 'process')
+        for events in self.events.values():
+            handlers.update(x.im_func for x in events if x._executor == 'process')
+        handlers.update(x[0].im_func for x in self.tasks.values() if x[0]._executor == 'process')
+        if ChiiBot.process_pool is None:
+            ChiiBot.process_pool = ChiiProcessPool(self.config)
+            reactor.addSystemEventTrigger('before', 'shutdown', ChiiBot.process_pool.stop)
+        self.process_pool.update(handlers)
+
     # command, event task methods that execute specify commands for given behavior
-    def _command(self, command, channel, nick, host, msg):
-        """excecutes a command"""
+    def _command(self, command, channel, nick, host, msg, queued=None):
+        """excecutes a command, queued is when it was dispatched"""
         if len(msg) > 1:
             args = msg[1:]
         else:
             args = ()
+        # lambdas only have the name they were called by
+        name = getattr(command, '_command_names', (msg[0][1:].lower(),))[0]
         try:
-            response = command(channel, nick, host, *args)
+            if getattr(command, '_executor', None) == 'process':
+                run = lambda: self._process_handler(command, (channel, nick, host) + tuple(args))
+            else:
+                run = lambda: command(channel, nick, host, *args)
+            if getattr(command, '_cache', None):
+                response = self.metrics.timed('command', name, queued, self.command_cache.call, command, args, run)
+            else:
+                response = self.metrics.timed('command', name, queued, run)
         except Exception as e:
             response = 'ur shit am fuked! %s' % e
             traceback.print_exc()
-        if response:
-            self.msg(channel, response)
-            self.logger.log("<%s> %s" % (self.nickname, response), channel)
+        self._respond(response, channel, 'normal' if command._restrict is None else 'high')
 
-    def _event(self, event, args=(), respond_to=False):
-        """executes an event"""
+    def _event(self, event, args=(), respond_to=False, queued=None):
+        """executes an event, queued is when it was dispatched"""
         try:
-            response = event(*args)
+            if getattr(event, '_executor', None) == 'process':
+                response = self.metrics.timed('event', event.__name__, queued, self._process_handler, event, args)
+            else:
+                response = self.metrics.timed('event', event.__name__, queued, event, *args)
         except Exception as e:
             response = 'ur shit am fuked! %s' % e
             traceback.print_exc()
-        if response and respond_to:
-            # only return something if this event is caught in a channel
-            self.msg(respond_to, response)
+        # only return something if this event is caught in a channel
+        self._respond(response, respond_to, 'low')
+
+    def _respond(self, response, respond_to, priority='normal'):
+        """sends response of a command or event, waiting for it if deferred"""
+        if isinstance(response, defer.Deferred):
+            if threadable.isInIOThread():
+                response.addCallbacks(self._respond, self._respond_error,
+                                      callbackArgs=(respond_to, priority), errbackArgs=(respond_to, priority))
+            else:
+                reactor.callFromThread(self._respond, response, respond_to, priority)
+        elif response and respond_to:
+            self.msg(respond_to, response, priority=priority)
             self.logger.log("<%s> %s" % (self.nickname, response), respond_to)
 
-    def _task(self, name, func, repeat=60, scale=None):
-        """executes looping task"""
-        def loop_task(func, repeat):
-            lc = LoopingCall(func)
-            lc.start(repeat)
-            self.running_tasks[func.__name__] = lc
-            print 'starting task %s. repeating every %s' % (name, self._fmt_seconds(repeat))
-
-        time_scale = {
-            'min': 60,
-            'hou': 3600,
-            'day': 86400,
-            'wee': 604800,
-        }
-
-        if type(repeat) is not int:
-            repeat = 1
-            scale = repeat
-        if scale is None:
-            lc = loop_task(func, repeat)
-        elif scale[:3] in time_scale:
-            repeat = repeat * time_scale[scale[:3]]
-            lc = loop_task(func, repeat)
+    def _respond_error(self, f, respond_to, priority='normal'):
+        f.printTraceback()
+        self._respond('ur shit am fuked! %s' % f.getErrorMessage(), respond_to, priority)
+
+    def _process_handler(self, method, args):
+        """runs a command or event in the process pool, returns deferred response"""
+        def replay(result):
+            response, calls = result
+            for name, call_args in calls:
+                getattr(self, name)(*call_args)
+            return response
+
+        if self.process_pool is None:
+            return method(*args)
+        if hasattr(method, '_lambda'):
+            d = self.process_pool.submit('lambda', method._lambda, args, timeout=method._timeout)
+        else:
+            # config itself holds a lock and can't be pickled
+            proxy = ProcessProxy(self.config.snapshot, self.nickname)
+            d = self.process_pool.submit('handler', id(method.im_func), args, proxy, timeout=method._timeout)
+        return d.addCallback(replay)
+
+    time_scale = {
+        'sec': 1,
+        'min': 60,
+        'hou': 3600,
+        'day': 86400,
+        'wee': 604800,
+    }
+
+    def _task_spec(self, repeat, scale=None, cron=None):
+        """returns when a task runs, raises ValueError if that makes no sense"""
+        if cron:
+            return CronSpec(cron)
+        if isinstance(repeat, basestring):
+            if repeat.startswith('@') or ' ' in repeat.strip():
+                return CronSpec(repeat)
+            # @task('hourly') runs once an hour
+            repeat, scale = 1, repeat
+        if not isinstance(repeat, (int, long, float)):
+            raise ValueError('repeat %r is not a number of seconds' % (repeat,))
+        if scale is not None:
+            if scale[:3] not in self.time_scale:
+                raise ValueError('unknown scale %s' % scale)
+            repeat = repeat * self.time_scale[scale[:3]]
+        return IntervalSpec(repeat)
+
+    def _task(self, name, func):
+        """runs a task once where it asked to, returns its result or a deferred"""
+        if func._executor == 'process':
+            return self.metrics.timed('task', name, None, self._process_handler, func, ())
+        if func._executor == 'thread':
+            if self.dispatcher is not None:
+                return self.dispatcher.submit('task', self.metrics.timed, 'task', name, None, func)
+            return threads.deferToThread(self.metrics.timed, 'task', name, None, func)
+        return self.metrics.timed('task', name, None, func)
+
+    def _schedule_task(self, name, func, repeat, scale):
+        """adds a task to the scheduler"""
+        if not threadable.isInIOThread():
+            return reactor.callFromThread(self._schedule_task, name, func, repeat, scale)
+        try:
+            spec = self._task_spec(repeat, scale, func._task_cron)
+        except ValueError as e:
+            print 'not starting task %s: %s' % (name, e)
+            return
+        if self.scheduler is None:
+            ChiiBot.scheduler = ChiiScheduler(self.config['task_tick'] or 1.0)
+        # interval tasks run once at start, like they did on LoopingCalls
+        self.scheduler.add(name, lambda: self._task(name, func), spec, func._task_jitter, func._task_coalesce,
+                           now=isinstance(spec, IntervalSpec))
+        if isinstance(spec, IntervalSpec):
+            print 'starting task %s. repeating every %s' % (name, self._fmt_seconds(int(spec.seconds)) or spec)
         else:
-            lc = None
+            print 'starting task %s. %s' % (name, spec)
+
+    def _task_control(self, action, name):
+        """pauses, resumes or runs a task now on the reactor, returns it, None
+           if there's no such task or False if it's running already"""
+        if not threadable.isInIOThread():
+            return threads.blockingCallFromThread(reactor, self._task_control, action, name)
+        if self.scheduler is None:
+            return None
+        return {'pause': self.scheduler.pause, 'resume': self.scheduler.resume, 'run': self.scheduler.run_now}[action](name)
 
     # command, event, task handlers
     def _handle_command(self, channel, nick, host, msg):
@@ -315,44 +3192,67 @@ class ChiiBot:
         msg = msg.split()
         command = self.commands.get(msg[0][1:].lower(), None)
         if command:
+            command = self._bind(command)
             if self._check_permission(command._restrict, nick, host):
-                if self.config['threaded']:
-                    threads.deferToThread(self._command, command, channel, nick, host, msg)
-                else:
-                    defer.execute(self._command, command, channel, nick, host, msg)
+                not_ready = self._not_ready(command)
+                if not_ready:
+                    self._respond(not_ready, channel)
+                    return
+                job_class = 'command' if command._restrict is None else 'admin'
+                self._dispatch(job_class, self._command, command, channel, nick, host, msg, time.time())
 
     def _handle_event(self, event_type, args=(), respond_to=False):
         """handles event dispatch"""
-        for event in self.events[event_type]:
-            if self.config['threaded']:
-                threads.deferToThread(self._event, event, args, respond_to)
-            else:
-                defer.execute(self._event, event, args, respond_to)
-
-    def _start_tasks(self):
-        """starts all tasks"""
-        if self.tasks:
-            for task in self.tasks:
-                func, repeat, scale = self.tasks[task]
-                if self.config['threaded']:
-                    threads.deferToThread(self._task, task, func, repeat, scale)
-                else:
-                    defer.execute(self._task, task, func, repeat, scale)
+        if event_type in self.event_triggers and args:
+            # only schedule handlers whose triggers match the message text
+            events = self.event_triggers[event_type].match(args[-1])
+        else:
+            events = self.events[event_type]
+        for event in events:
+            event = self._bind(event)
+            if event_type == 'load':
+                # load events wait for their module's inits instead of being dropped
+                self._when_ready(event, self._dispatch, 'event', self._event, event, args, respond_to, time.time())
+            elif not self._not_ready(event):
+                self._dispatch('event', self._event, event, args, respond_to, time.time())
 
-    def _stop_tasks(self):
-        """stops all tasks"""
-        if self.tasks:
-            for task in self.tasks:
-                try:
-                    self.running_tasks[task].stop()
-                except:
-                    pass
+    def _dispatch(self, job_class, func, handler, *args):
+        """runs func(handler, *args) on the worker pool if threaded, otherwise
+           or if handler's executor is 'reactor' on the reactor"""
+        if not self.config.snapshot.threaded or getattr(handler, '_executor', None) == 'reactor':
+            return defer.execute(func, handler, *args)
+        if self.dispatcher is None:
+            return threads.deferToThread(func, handler, *args)
+        def shed(f):
+            f.trap(DispatchShed)
+            log.msg('dispatch queue full, shed %s job' % job_class)
+        d = self.dispatcher.submit(job_class, func, handler, *args)
+        d.addErrback(shed)
+        return d
+
+    def _start_tasks(self, tasks=None):
+        """starts all tasks, or just the given ones"""
+        if tasks is None:
+            tasks = self.tasks
+        for task in tasks:
+            func, repeat, scale = tasks[task]
+            func = self._bind(func)
+            self._when_ready(func, self._schedule_task, task, func, repeat, scale)
+
+    def _stop_tasks(self, tasks=None):
+        """stops all tasks, or just the given ones"""
+        if not threadable.isInIOThread():
+            return reactor.callFromThread(self._stop_tasks, tasks)
+        if tasks is None:
+            tasks = self.tasks
+        if self.scheduler:
+            for task in tasks:
+                self.scheduler.remove(task)
 
     # a couple of ways to do deferred messaging
     def batch_msg(self, channel, msg):
-        """tries to prevent flooding by sending messages staggered 1 second per line"""
-        for delay, line in enumerate(msg.split('\n')):
-            self.msg_later(channel, line, delay)
+        """sends multi-line message, the outbound queue takes care of flooding"""
+        self.msg(channel, msg)
 
     def msg_later(self, channel, msg, delay):
         """uses reactor.callLater to send a message after a given delay"""
@@ -397,16 +3297,86 @@ class ChiiBot:
         d.addCallback(lambda result: cb(result))
         return d
 
+    def _defer_to_process(self, func, *args):
+        """runs module level func in the process pool, returns deferred result"""
+        if self.process_pool is None:
+            return defer.execute(func, *args)
+        return self.process_pool.submit('function', func, args).addCallback(lambda result: result[0])
+
+    # profiling
+    def _profile_dir(self):
+        path = os.path.join(self.config['logs_dir'] or '', 'profiles')
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return path
+
+    def _profile_command(self, channel, nick, host, name, args):
+        """runs command once under cProfile and saves the stats in logs_dir.
+           Returns its response, where the stats went and the pstats. Deferred
+           responses are only profiled until they're returned"""
+        command = self._bind(self.commands[name])
+        profiler = cProfile.Profile()
+        try:
+            response = profiler.runcall(command, channel, nick, host, *args)
+        except Exception as e:
+            response = 'ur shit am fuked! %s' % e
+            traceback.print_exc()
+        path = os.path.join(self._profile_dir(), '%s-%s.prof' % (name, time.strftime('%Y%m%d-%H%M%S')))
+        profiler.dump_stats(path)
+        return response, path, pstats.Stats(profiler)
+
+    def _start_sampler(self, interval=None):
+        """starts sampling every thread, returns False if it already is"""
+        if not threadable.isInIOThread():
+            return threads.blockingCallFromThread(reactor, self._start_sampler, interval)
+        if self.sampler:
+            return False
+        ChiiBot.sampler = ChiiSampler(self.module_registry, interval or self.config['profile_interval'])
+        self.sampler.start()
+        return True
+
+    def _stop_sampler(self):
+        """stops sampling, returns the sampler and where its collapsed stacks went"""
+        if not threadable.isInIOThread():
+            return threads.blockingCallFromThread(reactor, self._stop_sampler)
+        sampler = self.sampler
+        if sampler is None:
+            return None, None
+        sampler.stop()
+        ChiiBot.sampler = None
+        path = os.path.join(self._profile_dir(), 'samples-%s.folded' % time.strftime('%Y%m%d-%H%M%S'))
+        sampler.dump(path)
+        return sampler, path
+
     # misc functions
     def _check_permission(self, role, nick, host):
         """checks whether nick, host, or nick!host has required role"""
         if role is None:
             return True
-        user = '!'.join((nick, host))
-        for rule in self.config['user_roles'][role]:
-            if fnmatch(user, rule):
-                return True
-        return False
+        if self.roles is None or self.roles_version != self.config.version:
+            # rules changed, recompile
+            ChiiBot.roles = RoleMatcher(self.config['user_roles'], self.config['role_cache_size'] or 4096)
+            ChiiBot.roles_version = self.config.version
+        return self.roles.check(role, nick, host)
+
+    def _forget_permissions(self, nick):
+        if self.roles:
+            self.roles.forget(nick)
+
+    def _help_commands(self, roles):
+        """returns sorted names of commands available to a set of roles"""
+        roles = frozenset(roles)
+        if roles not in self.help_index:
+            self.help_index[roles] = sorted(x for x in self.commands
+                                            if self.commands[x]._restrict is None or self.commands[x]._restrict in roles)
+        return self.help_index[roles]
+
+    def _update_help_index(self):
+        """precomputes help for no roles and every single role, call when commands change"""
+        ChiiBot.help_index = {}
+        self._help_commands(())
+        for role in self.config['user_roles'] or ():
+            self._help_commands((role,))
 
     def _fmt_seconds(self, s):
         """returns formatted time"""
@@ -417,63 +3387,164 @@ class ChiiBot:
         return ' '.join(' '.join((str(x), time[x])) for x in (d, h, m, s) if x is not 0)
 
     def _rehash(self):
-        self._handle_event('unload')
-        self._stop_tasks()
-        self._update_registry()
-        self._handle_event('load')
-        self._start_tasks()
+        """reloads modules which changed on disk, returns their paths"""
+        changed = self._changed_modules()
+        for path in changed:
+            self._reload_module(path)
+        return changed
+
+    def _watch_modules(self):
+        """reloads modules as soon as they change on disk"""
+        def changed(filename):
+            for path, package, module, module_file in self._find_modules():
+                if os.path.abspath(module_file) == os.path.abspath(filename):
+                    if self.module_hashes.get(path) != self._module_hash(module_file):
+                        self._reload_module(path)
+                    return
+            # new module in a watched package
+            if filename.endswith('.py'):
+                for path in self._changed_modules():
+                    self._reload_module(path)
+
+        if self.config['watch_modules'] and self.watcher is None:
+            ChiiBot.watcher = ModuleWatcher(self.config['modules'], changed)
+            ChiiBot.watcher.start()
 
     def _quit(self, message=None):
+        """quits this network, we stop once every network is quit. Tasks
+           move to another network or stop when the connection is lost"""
         self._handle_event('quit')
-        self._stop_tasks()
-        self.factory.doStop()
+        self.factory.quit()
         self.quit(message)
-        reactor.callLater(1, self.logger.close, None)
-        reactor.callLater(1, reactor.stop, None)
-        reactor.stop()
+        # in case the server doesn't hang up on us
+        reactor.callLater(5, self.transport.loseConnection)
 
 
 ### twisted protocol/factory ###
 class ChiiProto(irc.IRCClient, ChiiBot):
     """a very peculiar bot"""
-    _names_list = defaultdict(set)
+    outbound = None
+    members = None
+    network = None
+    network_config = {}
+    # flood control runs on this, benchmarks swap in a task.Clock
+    clock = reactor
+
+    def msg(self, user, message, length=None, priority='normal'):
+        """queues message to user or channel, split to fit the line limit"""
+        self.outbound.message('PRIVMSG', user, message, self.nickname, priority)
+
+    def notice(self, user, message, priority='normal'):
+        """queues notice to user or channel, split to fit the line limit"""
+        self.outbound.message('NOTICE', user, message, self.nickname, priority)
+
+    def sendLine(self, line, priority=None):
+        """every line goes through the outbound queue"""
+        self.outbound.line(line, priority)
+
+    def _send_now(self, line):
+        """sends a line the outbound queue let through"""
+        self.metrics.line(self.network, 1)
+        command, _, rest = line.partition(' ')
+        if command in ('PRIVMSG', 'NOTICE'):
+            target = rest.split(' ', 1)[0]
+            if self._is_channel(target):
+                self.metrics.message(self.network, target, 1)
+        irc.IRCClient.sendLine(self, line)
+
+    def lineReceived(self, line):
+        self.metrics.line(self.network, 0)
+        irc.IRCClient.lineReceived(self, line)
+
+    def _is_channel(self, target):
+        return target[:1] in (self.supported.getFeature('CHANTYPES') or ('#', '&'))
 
     def connectionMade(self):
+        self.outbound = ChiiOutbound(self._send_now, self.config, self.clock)
+        self.members = ChannelMembers()
+        self.requests = ChiiRequests(self.sendLine, self.members.key, self.config)
+        self.who_replies = []
         self.logger.log("[connected at %s]" % time.asctime(time.localtime(time.time())))
         irc.IRCClient.connectionMade(self)
 
-        # update list of commands, events, tasks, and start tasks
-        self._update_registry()
-        self._handle_event('load')
-        self._start_tasks()
+        self.networks[self.network] = self
+        self._start_modules()
+
+    def _start_modules(self):
+        """the first network to connect loads modules, the rest share them"""
+        if len(self.networks) == 1 and not self.module_registry:
+            self._update_registry()
+            self._handle_event('load')
+        if self.task_owner is None:
+            ChiiBot.task_owner = self
+            self._start_tasks()
+        self._watch_modules()
 
     def connectionLost(self, reason):
+        self.outbound.stop()
+        self.requests.clear(RequestError('disconnected'))
+        if self.networks.get(self.network) is self:
+            del self.networks[self.network]
+        if self.task_owner is self:
+            # hand tasks over to another network if there is one
+            self._stop_tasks()
+            ChiiBot.task_owner = None
+            for other in self.networks.values()[:1]:
+                ChiiBot.task_owner = other
+                other._start_tasks()
+        if self.watcher and not self.networks:
+            self.watcher.stop()
+            ChiiBot.watcher = None
         irc.IRCClient.connectionLost(self, reason)
         self.logger.log("[disconnected at %s]" % time.asctime(time.localtime(time.time())))
         self.logger.close()
 
+    def _setting(self, key):
+        """returns setting of this network, falling back to config"""
+        if key in self.network_config:
+            return self.network_config[key]
+        return self.config[key]
+
     def signedOn(self):
         """Called when bot has succesfully signed on to server."""
         self.setNick(self.nickname)
-        if self.config['ident_pass']:
-            self.msg('nickserv', 'identify %s' % self.config['ident_pass'])
-        for channel in self.config['channels']:
+        if self._setting('ident_pass'):
+            self.msg('nickserv', 'identify %s' % self._setting('ident_pass'))
+        for channel in self._setting('channels') or ():
             self.join(channel)
 
     def whois(self, user, channel=None):
-        """Retrieve information about the specified user."""
-        if not hasattr(self, '_saved_whois'):
-            self._saved_whois = {}
-        self._current_whois = (channel, user)
-        self._saved_whois[user] = {
+        """Retrieve information about the specified user, returns deferred
+           dict of it. With channel, it's sent there too."""
+        d = self.requests.request('whois', user, 'WHOIS ' + user, {
             'user': None,
             'server': None,
             'operator': False,
             'idle': 0,
             'channels': [],
-            'added': datetime.datetime.now()
-        }
-        self.sendLine('WHOIS ' + user)
+        })
+        if channel:
+            def show(info):
+                self.msg(channel, '\002user\002: %s!%s@%s' % info['user'])
+                self.msg(channel, '\002server\002: %s - %s' % info['server'])
+                self.msg(channel, '\002operator\002: %s' % info['operator'])
+                self.msg(channel, '\002idle\002: %s' % self._fmt_seconds(info['idle']))
+                self.msg(channel, '\002channels\002: %s' % ' '.join(info['channels']))
+            d.addCallbacks(show, lambda f: self.msg(channel, f.getErrorMessage()))
+        return d
+
+    def userhost(self, nick):
+        """returns deferred user@host of nick, None if there is no such nick"""
+        return self.requests.request('userhost', nick, 'USERHOST ' + nick)
+
+    def who(self, mask):
+        """returns deferred list of dicts with channel, user, host, server,
+           nick, flags and realname of every user matching mask"""
+        return self.requests.request('who', mask, 'WHO ' + mask, [])
+
+    def names(self, channel):
+        """returns deferred list of (nick, prefix modes) in channel"""
+        return self.requests.request('names', channel, 'NAMES ' + channel, [])
 
     def joined(self, channel):
         """This will get called when the bot joins a channel."""
@@ -482,6 +3553,8 @@ class ChiiProto(irc.IRCClient, ChiiBot):
     def privmsg(self, user, channel, msg):
         """This will get called when the bot receives a message."""
         nick, host = user.split('!')
+        if channel != self.nickname:
+            self.metrics.message(self.network, channel, 0)
 
         # handle message events
         if channel == self.nickname:
@@ -492,7 +3565,7 @@ class ChiiProto(irc.IRCClient, ChiiBot):
         self._handle_event('msg', args=(channel, nick, host, msg), respond_to=channel)
 
         # Check if we're getting a command
-        if msg.startswith(self.config['cmd_prefix']):
+        if msg.startswith(self.config.snapshot.cmd_prefix):
             self._handle_command(channel, nick, host, msg)
 
         # logs
@@ -504,6 +3577,8 @@ class ChiiProto(irc.IRCClient, ChiiBot):
         nick, host = user.split('!')
         if channel == self.nickname:
             channel = nick
+        else:
+            self.metrics.message(self.network, channel, 0)
         self.logger.log("* %s %s" % (nick, msg), channel)
         self._handle_event('action', args=(channel, nick, host, msg), respond_to=channel)
 
@@ -513,12 +3588,12 @@ class ChiiProto(irc.IRCClient, ChiiBot):
 
     def userLeft(self, user, channel):
         """Called when I see another user leaving a channel."""
-        nick, host = user.split('!')
         self._handle_event('user_left', args=(channel, user), respond_to=channel)
 
     def userQuit(self, user, quitMessage):
         """Called when I see another user disconnect from the network."""
-        nick, host = user.split('!')
+        nick, _, host = user.partition('!')
+        self._forget_permissions(nick)
         self._handle_event('user_quit', args=(nick, host, quitMessage))
 
     def userKicked(self, kickee, channel, kicker, message):
@@ -537,11 +3612,48 @@ class ChiiProto(irc.IRCClient, ChiiBot):
                 self.msg(channel, 'ping! reply from %s: %f seconds' % (user, secs))
             del self._ping_called_from
 
-    # irc callbacks
+    # irc callbacks, membership is updated before chii's callbacks run
+    def isupport(self, options):
+        casemapping = self.supported.getFeature('CASEMAPPING')
+        if casemapping:
+            self.members.set_casemapping(casemapping[0])
+
+    def irc_JOIN(self, prefix, params):
+        nick, _, host = prefix.partition('!')
+        self.members.join(params[-1], nick, host)
+        irc.IRCClient.irc_JOIN(self, prefix, params)
+
+    def irc_PART(self, prefix, params):
+        nick = prefix.split('!')[0]
+        if self.members.key(nick) == self.members.key(self.nickname):
+            self.members.leave(params[0])
+        else:
+            self.members.part(params[0], nick)
+        irc.IRCClient.irc_PART(self, prefix, params)
+
+    def irc_QUIT(self, prefix, params):
+        self.members.quit(prefix.split('!')[0])
+        irc.IRCClient.irc_QUIT(self, prefix, params)
+
+    def irc_KICK(self, prefix, params):
+        if self.members.key(params[1]) == self.members.key(self.nickname):
+            self.members.leave(params[0])
+        else:
+            self.members.part(params[0], params[1])
+        irc.IRCClient.irc_KICK(self, prefix, params)
+
+    def modeChanged(self, user, channel, set, modes, args):
+        prefixes = self.supported.getFeature('PREFIX') or {}
+        for mode, arg in zip(modes, args):
+            if mode in prefixes and arg:
+                self.members.mode(channel, arg, mode, set)
+
     def irc_NICK(self, prefix, params):
         """Called when an IRC user changes their nickname."""
         old_nick = prefix.split('!')[0]
         new_nick = params[0]
+        self.members.nick(old_nick, new_nick)
+        self._forget_permissions(old_nick)
         self.logger.log("%s is now known as %s" % (old_nick, new_nick))
         self._handle_event('user_nick_changed', args=(old_nick, new_nick))
 
@@ -557,103 +3669,455 @@ class ChiiProto(irc.IRCClient, ChiiBot):
         Called when we try to register or change to a nickname that is already
         taken.
         """
-        if self.config['identpass']:
-            self.msg('nickserv', 'ghost %s %s' % (self.nickname, self.config['identpass']))
+        if self._setting('ident_pass'):
+            self.msg('nickserv', 'ghost %s %s' % (self.nickname, self._setting('ident_pass')))
             self.setNick(self.nickname)
         else:
             self.setNick(self.alterCollidedNick(self._attemptedNick))
 
+    # replies to requests, ignored when nobody asked
+    def _whois_reply(self, params, key, value):
+        info = self.requests.result('whois', params[1])
+        if info is not None:
+            if key == 'channels':
+                info[key].extend(value)
+            else:
+                info[key] = value
+
     def irc_RPL_WHOISUSER(self, prefix, params):
-        channel, user = self._current_whois
-        self._saved_whois[user]['user'] = (params[2], params[3], params[5])
+        self._whois_reply(params, 'user', (params[2], params[3], params[5]))
 
     def irc_RPL_WHOISSERVER(self, prefix, params):
-        channel, user = self._current_whois
-        self._saved_whois[user]['server'] = (params[2], params[3])
+        self._whois_reply(params, 'server', (params[2], params[3]))
 
     def irc_RPL_WHOISOPERATOR(self, prefix, params):
-        channel, user = self._current_whois
-        self._saved_whois[user]['operator'] = True
+        self._whois_reply(params, 'operator', True)
 
     def irc_RPL_WHOISIDLE(self, prefix, params):
-        channel, user = self._current_whois
-        self._saved_whois[user]['idle'] = int(params[2])
+        self._whois_reply(params, 'idle', int(params[2]))
 
     def irc_RPL_WHOISCHANNELS(self, prefix, params):
-        channel, user = self._current_whois
-        self._saved_whois[user]['channels'].extend(params[2].split())
+        self._whois_reply(params, 'channels', params[2].split())
 
     def irc_RPL_ENDOFWHOIS(self, prefix, params):
-        channel, user = self._current_whois
-        if channel:
-            a, c, i, o, s, u = [self._saved_whois[user][x] for x in sorted(self._saved_whois[user])]
-            self.msg(channel, '\002user\002: %s!%s@%s' % u)
-            self.msg(channel, '\002server\002: %s - %s' % s)
-            self.msg(channel, '\002operator\002: %s' % o)
-            self.msg(channel, '\002idle\002: %s' % self._fmt_seconds(i))
-            self.msg(channel, '\002channels\002: %s' % ' '.join(x for x in c))
-        del self._current_whois
+        self.requests.done('whois', params[1])
 
     def irc_ERR_NOSUCHNICK(self, prefix, params):
-        if hasattr(self, '_current_whois'):
-            channel, user = self._current_whois
-            if channel:
-                self.msg(channel, 'no such user \002%s' % user)
-            del self._current_whois
-        else:
-            pass
+        self.requests.fail('whois', params[1], RequestError('no such user \002%s' % params[1]))
+
+    def irc_RPL_USERHOST(self, prefix, params):
+        # nick*=+user@host, * marks opers and + or - away
+        replies = params[1].split()
+        for reply in replies:
+            nick, _, host = reply.partition('=')
+            self.requests.done('userhost', nick.rstrip('*'), value=host[1:])
+        if not replies:
+            # missing nicks aren't in the reply at all, so an empty one can
+            # only be answered if it's unambiguous. It isn't cached, it may
+            # still be a late reply to a request which timed out
+            asked = self.requests.outstanding('userhost')
+            if len(asked) == 1:
+                self.requests.done('userhost', asked[0], value=None, cache=False)
+
+    def irc_RPL_WHOREPLY(self, prefix, params):
+        # replies don't say which mask they're for, the end of them does
+        hops, _, realname = params[-1].partition(' ')
+        self.who_replies.append(dict(zip(('channel', 'user', 'host', 'server', 'nick', 'flags'), params[1:7]), realname=realname))
+
+    def irc_RPL_ENDOFWHO(self, prefix, params):
+        users, self.who_replies = self.who_replies, []
+        self.requests.done('who', params[1], value=users)
 
     def _names(self, channel, action=None):
-        self._names_cb = (channel, action)
-        self.sendLine('NAMES %s' % channel)
+        """gets names in channel, then messages them to action[1] if action
+           is ('msg', target) or sets mode action[1] on them if it's ('mode', mode)"""
+        def done(nicks):
+            me = self.members.key(self.nickname)
+            nicks = [x[0] for x in nicks if self.members.key(x[0]) != me]
+            if action[0] == 'msg':
+                self.msg(action[1], 'users in %s: %s' % (channel, ' '.join(nicks)))
+            elif action[0] == 'mode':
+                self._mass_mode(channel, action[1], nicks)
+        d = self.names(channel)
+        if action:
+            d.addCallback(done)
+        return d
+
+    def _others(self, channel):
+        """returns nicks in channel, minus you!"""
+        me = self.members.key(self.nickname)
+        return [x for x in self.members.members(channel) if self.members.key(x) != me]
+
+    def _mass_mode(self, channel, mode, nicks=None):
+        """sets a mode like -o on nicks, everyone else in channel by default,
+           as many per line as the server allows"""
+        if nicks is None:
+            nicks = self._others(channel)
+        per_line = self.supported.getFeature('MODES') or 3
+        for i in xrange(0, len(nicks), per_line):
+            chunk = nicks[i:i + per_line]
+            self.sendLine('MODE %s %s%s %s' % (channel, mode[0], mode[1:] * len(chunk), ' '.join(chunk)))
 
     def irc_RPL_NAMREPLY(self, prefix, params):
-        # get list of users minus prefix & minus you!
-        def strip_prefix(user):
-            for prefix in ('+', '@'):
-                if user.startswith(prefix):
-                    user = user[1:]
-            return user
-
-        channel, users = params[2], params[3]
-        self._names_list[channel] = set()
-        for user in users.split():
-            user = strip_prefix(user)
-            if user != self.nickname:
-                self._names_list[channel].add(user)
+        # NAMES replies come in chunks, members are only replaced at the end
+        modes = dict((x[0], mode) for mode, x in (self.supported.getFeature('PREFIX') or {}).iteritems())
+        nicks = []
+        for user in params[3].split():
+            nick = user.lstrip(''.join(modes))
+            nicks.append((nick, ''.join(modes[x] for x in user[:len(user) - len(nick)])))
+        self.members.names_reply(params[2], nicks)
+        requested = self.requests.result('names', params[2])
+        if requested is not None:
+            requested.extend(nicks)
 
     def irc_RPL_ENDOFNAMES(self, prefix, params):
-        def msg(*args):
-            self.msg(args[0], 'users in %s: %s' % (channel, ' '.join(self._names_list[channel])))
-
-        def mode(*args):
-            prefix, mode = args[0]
-            mode = mode * len(self._names_list[channel])
-            self.sendLine('MODE %s %s%s %s' % (channel, prefix, mode, ' '.join(self._names_list[channel])))
-
-        error = lambda *args: None
-
-        if hasattr(self, '_names_cb'):
-            channel, action = self._names_cb
-            if params[1] == channel and action:
-                dispatch = {
-                    'msg': msg,
-                    'mode': mode,
-                }.get(action[0], error)(action[1])
-                del self._names_cb
-
-class ChiiFactory(protocol.ClientFactory):
-    """A factory for ChiiBots."""
-    def __init__(self, chii):
+        self.members.names_end(params[1])
+        self.requests.done('names', params[1])
+
+class ChiiFactory(protocol.ReconnectingClientFactory):
+    """A factory for ChiiBots, one per network. Lost and failed connections
+       are retried with backoff, a network going away doesn't take the others
+       with it. Once every network is quit the reactor stops."""
+    maxDelay = 300
+    # factories of networks which haven't quit
+    running = set()
+
+    def __init__(self, chii, network=None, settings=None, logger=None):
         self.protocol = chii
+        self.network = network
+        self.settings = settings or {}
+        self.logger = logger
+        self.running.add(self)
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        p = protocol.ClientFactory.buildProtocol(self, addr)
+        p.network = self.network
+        p.network_config = self.settings
+        if 'nickname' in self.settings:
+            p.nickname = self.settings['nickname']
+        if 'realname' in self.settings:
+            p.realname = self.settings['realname']
+        if self.logger:
+            p.logger = self.logger
+        return p
 
     def clientConnectionLost(self, connector, reason):
         """If we get disconnected, reconnect to server."""
-        connector.connect()
+        if self.continueTrying:
+            print 'connection to %s lost: %s, reconnecting' % (self.network, reason.getErrorMessage())
+        protocol.ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
+        self._stopped()
 
     def clientConnectionFailed(self, connector, reason):
-        print "connection failed:", reason
-        reactor.stop()
+        print 'connection to %s failed: %s' % (self.network, reason.getErrorMessage())
+        protocol.ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
+        self._stopped()
+
+    def quit(self):
+        """stops reconnecting, the network is gone once it's disconnected"""
+        self.stopTrying()
+
+    def _stopped(self):
+        if not self.continueTrying and self in self.running:
+            self.running.discard(self)
+            if not self.running and reactor.running:
+                reactor.stop()
+
+### shards ###
+class ChiiFrontend(ChiiProto):
+    """Owns the connection and flood control but runs no modules. Events and
+       commands are sent to shard processes, by channel so every channel's
+       messages are handled in order, and irc calls stream back."""
+    shards = None
+
+    def _start_modules(self):
+        pass
+
+    def _handle_command(self, channel, nick, host, msg):
+        self.shards.send(channel, ('command', self.network, self.nickname, channel, nick, host, msg))
+
+    def _handle_event(self, event_type, args=(), respond_to=False):
+        # events that aren't about one channel go to every shard
+        self.shards.send(respond_to, ('event', self.network, self.nickname, event_type, args, respond_to))
+
+    def _forget_permissions(self, nick):
+        self.shards.send(None, ('forget', self.network, self.nickname, nick))
+
+class ShardProcess(protocol.ProcessProtocol):
+    """Frontend end of the pipes to a shard, messages are length prefixed marshal"""
+    def __init__(self, shards, n):
+        self.shards = shards
+        self.n = n
+        self.buffer = ''
+        self.alive = False
+
+    def connectionMade(self):
+        self.alive = True
+
+    def send(self, data):
+        self.transport.writeToChild(0, struct.pack('!I', len(data)) + data)
+
+    def childDataReceived(self, fd, data):
+        self.buffer += data
+        while len(self.buffer) >= 4:
+            size = struct.unpack_from('!I', self.buffer)[0]
+            if len(self.buffer) < size + 4:
+                break
+            data, self.buffer = self.buffer[4:size + 4], self.buffer[size + 4:]
+            self.shards.received(self.n, marshal.loads(data))
+
+    def processExited(self, reason):
+        # not processEnded, forked process pool workers may hold the pipes open
+        self.alive = False
+        self.shards.ended(self.n, reason)
+
+class ChiiShards:
+    """Shard processes of the frontend. A shard which dies is started again,
+       messages for it are kept until then, up to max_queue."""
+    def __init__(self, config, count):
+        self.config = config
+        self.count = count
+        self.processes = [None] * count
+        self.pending = [deque(maxlen=config['max_queue'] or 256) for x in xrange(count)]
+        self.stopping = False
+
+    def start(self):
+        for n in xrange(self.count):
+            self._spawn(n)
+
+    def stop(self):
+        self.stopping = True
+        for process in self.processes:
+            if process and process.alive:
+                process.transport.closeStdin()
+
+    def send(self, key, message):
+        """sends message to the shard for key, every shard if key is empty"""
+        data = marshal.dumps(message)
+        shards = [zlib.crc32(key.lower()) % self.count] if key else xrange(self.count)
+        for n in shards:
+            process = self.processes[n]
+            if process and process.alive:
+                process.send(data)
+            else:
+                self.pending[n].append(data)
+
+    def received(self, n, message):
+        kind, network, name, args, kwargs = message[:5]
+        proto = ChiiBot.networks.get(network)
+        if proto is None:
+            return
+        if kind == 'log':
+            proto.logger.log(*args)
+        elif kind == 'config':
+            self.config.apply(args[0])
+            self.config.save()
+            self.send(None, ('config', network, proto.nickname, args[0]))
+        elif kind == 'query':
+            self._answer(n, proto, message[5], name, args, kwargs)
+        elif name in ChiiShard.forwarded:
+            getattr(proto, name)(*args, **kwargs)
+
+    def _answer(self, n, proto, id, name, args, kwargs):
+        """runs a query of shard n, sending the answer back to it"""
+        if name == 'search':
+            if proto.logger.search:
+                d = threads.deferToThread(proto.logger.search.search, *args, **kwargs)
+            else:
+                d = defer.fail(RequestError('not indexing logs'))
+        elif name in ChiiShard.queries:
+            d = defer.maybeDeferred(getattr(proto, name), *args, **kwargs)
+        else:
+            d = defer.fail(RequestError('no such query %s' % name))
+        def send(ok, value):
+            process = self.processes[n]
+            if process and process.alive:
+                process.send(marshal.dumps(('answer', proto.network, proto.nickname, id, ok, value)))
+        d.addCallbacks(lambda value: send(True, value), lambda f: send(False, f.getErrorMessage()))
+
+    def ended(self, n, reason):
+        if not self.stopping:
+            print 'shard %d died: %s, restarting' % (n, reason.getErrorMessage())
+            reactor.callLater(1, self._spawn, n)
+
+    def _spawn(self, n):
+        if self.stopping:
+            return
+        process = ShardProcess(self, n)
+        argv = [sys.executable, os.path.abspath(__file__).replace('.pyc', '.py'), '--shard', str(n)]
+        if self.config.file != CONFIG_FILE:
+            argv += ['-c', self.config.file]
+        # shard reads messages from stdin and writes to fd 3, its output goes to ours
+        reactor.spawnProcess(process, sys.executable, argv, env=os.environ, path=os.getcwd(),
+                             childFDs={0: 'w', 1: 1, 2: 2, 3: 'r'})
+        self.processes[n] = process
+        while self.pending[n]:
+            process.send(self.pending[n].popleft())
+
+class ChiiShard(ChiiBot):
+    """Stands in for a network's protocol in a shard process, irc calls are
+       sent to the frontend which owns the connection. Queries are answered
+       by it too, they return deferreds here."""
+    forwarded = ProcessProxy.outputs + ('join', 'leave', 'setNick', 'quit', '_ping', '_quit', '_mass_mode', 'invite', 'away', 'back', 'say')
+    queries = ('whois', 'userhost', 'who', 'names')
+
+    def __init__(self, channel, network, nickname):
+        self.channel = channel
+        self.network = network
+        self.nickname = nickname
+        self.logger = ShardLogger(self.config, channel, network)
+
+    def __getattr__(self, name):
+        if name in self.queries:
+            return lambda *args, **kwargs: self.channel.query(self.network, name, args, kwargs)
+        if name in self.forwarded:
+            return lambda *args, **kwargs: self.channel.call('call', self.network, name, args, kwargs)
+        raise AttributeError(name)
+
+    def _quit(self, message=None):
+        self.channel.call('call', self.network, '_quit', (message,), {})
+
+class ShardLogger:
+    """The frontend writes the logs, shards send lines to it and only read them"""
+    def __init__(self, config, channel, network):
+        self.channel = channel
+        self.network = network
+        self.logs_dir = config['logs_dir']
+        if self.logs_dir and config['networks']:
+            self.logs_dir = os.path.join(self.logs_dir, network)
+        self.search = ShardSearch(channel, network) if self.logs_dir and config['log_search'] else None
+
+    def log(self, message, channel=None):
+        self.channel.call('log', self.network, None, (message, channel), {})
+
+    def index(self, channel):
+        if channel.startswith('#'):
+            channel = channel[1:]
+        return LogIndex(os.path.join(self.logs_dir, channel + '.log'))
+
+    def flush(self, *args):
+        pass
+
+    close = flush
+
+class ShardSearch:
+    """The frontend has the search index, searches are asked of it and the
+       deferred (total hits, hits) comes back"""
+    def __init__(self, channel, network):
+        self.channel = channel
+        self.network = network
+
+    def search(self, *args, **kwargs):
+        return self.channel.query(self.network, 'search', args, kwargs)
+
+class ShardChannel(basic.Int32StringReceiver):
+    """Shard end of the pipes to the frontend"""
+    MAX_LENGTH = 16 * 1024 * 1024
+
+    def __init__(self, config, n):
+        self.n = n
+        self.bots = {}
+        # deferred answers of queries sent to the frontend, by id
+        self.answers = {}
+        self.queries = 0
+        ChiiShard.config = config
+        # the frontend writes the config, every shard saving its own copy
+        # would lose the others' changes
+        config.sync = self._sync_config
+        for network, settings in config.networks().iteritems():
+            self._bot(network, settings['nickname'])
+
+    def _sync_config(self, changes):
+        """sends a shard's config changes to the frontend, which saves them
+           and passes them on to every shard"""
+        bot = self.bots.values()[0]
+        self.call('config', bot.network, None, (changes,), {})
+
+    def connectionMade(self):
+        bot = self.bots.values()[0]
+        bot._update_registry()
+        bot._handle_event('load')
+        # tasks only run in the first shard
+        if self.n == 0:
+            ChiiBot.task_owner = bot
+            bot._start_tasks()
+        bot._watch_modules()
+
+    def _bot(self, network, nickname):
+        if network not in self.bots:
+            self.bots[network] = ChiiBot.networks[network] = ChiiShard(self, network, nickname)
+        bot = self.bots[network]
+        bot.nickname = nickname
+        return bot
+
+    def stringReceived(self, data):
+        message = marshal.loads(data)
+        kind, bot = message[0], self._bot(*message[1:3])
+        if kind == 'command':
+            bot._handle_command(*message[3:])
+        elif kind == 'event':
+            event_type, args, respond_to = message[3:]
+            bot._handle_event(event_type, tuple(args), respond_to)
+        elif kind == 'forget':
+            bot._forget_permissions(message[3])
+        elif kind == 'answer':
+            id, ok, value = message[3:]
+            d = self.answers.pop(id, None)
+            if d and ok:
+                d.callback(value)
+            elif d:
+                d.errback(RequestError(value))
+        elif kind == 'config':
+            # config changed in some shard, maybe this one
+            changes = message[3]
+            ChiiShard.config.apply(changes)
+            bot._handle_event('config', (sorted(set(x[1][0] for x in changes)),))
+
+    def call(self, kind, network, name, args, kwargs):
+        if not threadable.isInIOThread():
+            return reactor.callFromThread(self.call, kind, network, name, args, kwargs)
+        try:
+            self.sendString(marshal.dumps((kind, network, name, args, kwargs)))
+        except ValueError as e:
+            print "can't send %s%r to frontend: %s" % (name, args, e)
+
+    def query(self, network, name, args, kwargs):
+        """sends a query to the frontend, returns deferred answer"""
+        if not threadable.isInIOThread():
+            d = defer.Deferred()
+            reactor.callFromThread(lambda: self.query(network, name, args, kwargs).chainDeferred(d))
+            return d
+        self.queries += 1
+        d = self.answers[self.queries] = defer.Deferred()
+        try:
+            self.sendString(marshal.dumps(('query', network, name, args, kwargs, self.queries)))
+        except ValueError as e:
+            del self.answers[self.queries]
+            d.errback(RequestError("can't send %s%r to frontend: %s" % (name, args, e)))
+        return d
+
+    def connectionLost(self, reason):
+        # frontend is gone
+        answers, self.answers = self.answers, {}
+        for d in answers.itervalues():
+            d.errback(RequestError('frontend is gone'))
+        if reactor.running:
+            reactor.stop()
+
+def run_shard(config, n):
+    """main of a shard process"""
+    from twisted.internet import stdio
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if config['threaded']:
+        ChiiBot.dispatcher = ChiiDispatcher(config)
+        reactor.callWhenRunning(ChiiBot.dispatcher.start)
+        reactor.addSystemEventTrigger('before', 'shutdown', ChiiBot.dispatcher.stop)
+    if config['metrics_port']:
+        # handlers run here, so each shard serves its own on the ports after the frontend's
+        listen_metrics(config['metrics_port'] + n + 1, config['metrics_interface'])
+    stdio.StandardIO(ShardChannel(config, n), stdin=0, stdout=3)
+    reactor.run()
 
 # we do this so we can easily import the config into our modules from here
 config = ChiiConfig(CONFIG_FILE)
@@ -663,6 +4127,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='simple python bot')
     parser.add_argument('-c', '--config', metavar='config file', help='specify a non-default configuration file to use')
     parser.add_argument('--save-defaults', metavar='config file', nargs='?', const=True, help='specify a non-default configuration file to use', )
+    parser.add_argument('--profile-startup', action='store_true', help='import every module eagerly and print import time and memory per module')
+    parser.add_argument('--shard', type=int, help=argparse.SUPPRESS)
     args = parser.parse_args()
 
     if args.config:
@@ -681,27 +4147,46 @@ if __name__ == '__main__':
     if config['log_stdout']:
         log.startLogging(sys.stdout)
 
+    # shards only run modules, the process which started them has the connections
+    if args.shard is not None:
+        run_shard(config, args.shard)
+        sys.exit(0)
+
     # setup our protocol & factory
+    ChiiProto.profile_startup = args.profile_startup
     ChiiProto.config = config
     ChiiProto.nickname = config['nickname']
     ChiiProto.realname = config['realname']
+    chii = ChiiProto
+    if config['shards']:
+        chii = ChiiFrontend
+        ChiiFrontend.shards = ChiiShards(config, config['shards'])
+        reactor.callWhenRunning(ChiiFrontend.shards.start)
+        reactor.addSystemEventTrigger('before', 'shutdown', ChiiFrontend.shards.stop)
 
     # setup logging
-    ChiiProto.logger = ChiiLogger(config)
+    if not config['networks']:
+        ChiiProto.logger = ChiiLogger(config)
 
-    # yaya make our chii
-    factory = ChiiFactory(ChiiProto)
+    # yaya make our chii, one connection per network sharing the same modules
+    for n, (name, settings) in enumerate(config.networks().iteritems()):
+        # with several networks each logs on its own, chii's log is only kept once
+        logger = ChiiLogger(config, name, log_chii=n == 0) if config['networks'] else None
+        factory = ChiiFactory(chii, name, settings, logger)
 
-    # connect factory to this host and port
-    if config['ssl']:
-        from twisted.internet import ssl
-        contextFactory = ssl.ClientContextFactory()
-        reactor.connectSSL(config['server'], config['port'], factory, contextFactory)
-    else:
-        reactor.connectTCP(config['server'], config['port'], factory)
+        # connect factory to this host and port
+        if settings['ssl']:
+            from twisted.internet import ssl
+            contextFactory = ssl.ClientContextFactory()
+            reactor.connectSSL(settings['server'], settings['port'], factory, contextFactory)
+        else:
+            reactor.connectTCP(settings['server'], settings['port'], factory)
 
     # run bot
-    if config['threaded']:
-        thread_size = config['threads'] or 4
-        reactor.suggestThreadPoolSize(thread_size)
+    if config['threaded'] and not config['shards']:
+        ChiiProto.dispatcher = ChiiDispatcher(config)
+        reactor.callWhenRunning(ChiiProto.dispatcher.start)
+        reactor.addSystemEventTrigger('before', 'shutdown', ChiiProto.dispatcher.stop)
+    if config['metrics_port']:
+        listen_metrics(config['metrics_port'], config['metrics_interface'])
     reactor.run()
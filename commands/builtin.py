@@ -1,3 +1,4 @@
+import os, time
 from chii import command
 
 @command(restrict='admins')
@@ -46,16 +47,129 @@ def config(self, channel, nick, host, *args):
 @command(restrict='admins')
 def rehash(self, channel, nick, host, *args):
     """u don't know me"""
-    self._rehash()
-    return '\002rehash !!\002 rehashed'
+    changed = self._rehash()
+    return '\002rehash !!\002 rehashed %s' % (', '.join(changed) or 'nothing, nothing changed')
+
+@command(restrict='admins')
+def reload(self, channel, nick, host, *args):
+    """reloads a module, eg. commands.misc"""
+    if not args:
+        return 'reload what?'
+    path = args[0]
+    if path not in self.module_registry:
+        # allow leaving out the package
+        matches = [x for x in self.module_registry if x.rsplit('.', 1)[-1] == path]
+        if len(matches) == 1:
+            path = matches[0]
+    if self._reload_module(path):
+        return '\002reload !!\002 reloaded %s' % path
+    return 'no module called %s' % path
+
+@command(restrict='admins')
+def cache(self, channel, nick, host, *args):
+    """shows hits/misses/shared/errors of cached commands, or clear [command]"""
+    if args and args[0] == 'clear':
+        self.command_cache.clear(set(args[1:]) or None)
+        return '\002cache !!\002 cleared %s' % (', '.join(args[1:]) or 'everything')
+    stats = self.command_cache.stats
+    if not stats:
+        return 'nothing cached yet'
+    return ' '.join('\002%s\002: %d/%d/%d/%d' % ((name,) + tuple(stats[name])) for name in sorted(stats))
+
+@command(restrict='admins')
+def stats(self, channel, nick, host, *args):
+    """slowest handlers and line rates, stats <handler> for one or stats channels for traffic"""
+    metrics = self.metrics
+    def ms(seconds):
+        return '%dms' % (seconds * 1000) if seconds != float('inf') else '>30s'
+
+    def show(kind, name):
+        runs, errors, wait50, wait95, run50, run95 = metrics.handler(kind, name)
+        return '\002%s %s\002 %d runs, %d errors, waited %s/%s, ran %s/%s' % (kind, name, runs, errors, ms(wait50), ms(wait95), ms(run50), ms(run95))
+
+    if args and args[0] == 'channels':
+        channels = sorted(metrics.channels.items(), key=lambda x: -sum(x[1]))
+        return ' '.join('\002%s\002 %d/%d' % (channel, counts[0], counts[1]) for (network, channel), counts in channels[:10]) or 'no traffic yet'
+    if args:
+        found = [show(kind, name) for kind, name in sorted(metrics.handlers) if name == args[0]]
+        return ' | '.join(found) or 'no stats for %s' % args[0]
+    lines = ' '.join('\002%s\002 in %d (%.1f/min) out %d (%.1f/min)' % (network, counts[0], metrics.rate(network, 0) * 60, counts[1], metrics.rate(network, 1) * 60)
+                     for network, counts in sorted(metrics.lines.items()))
+    slowest = sorted(metrics.handlers, key=lambda x: -metrics.handler(*x)[5])[:5]
+    return '\002stats !!\002 up %s, %s | slowest (p50/p95): %s' % (self._fmt_seconds(int(time.time() - metrics.started)) or 'a moment', lines or 'no lines yet',
+                                                               ' | '.join(show(*x) for x in slowest) or 'nothing ran yet')
+
+@command(restrict='admins')
+def tasks(self, channel, nick, host, *args):
+    """lists tasks with runs/failures, or tasks pause|resume|run <task>"""
+    def ago(seconds):
+        return self._fmt_seconds(int(seconds)) or 'a moment'
+
+    if args and args[0] in ('pause', 'resume', 'run'):
+        if len(args) < 2:
+            return '%s what?' % args[0]
+        task = self._task_control(args[0], args[1])
+        if task is None:
+            return 'no task called %s' % args[1]
+        if task is False:
+            return '%s is running already' % args[1]
+        return '\002tasks !!\002 %s %s' % (task.name, {'pause': 'paused', 'resume': 'resumed', 'run': 'running'}[args[0]])
+    if args:
+        return 'dong it rong'
+
+    now = time.time()
+    def show(task):
+        if task.paused:
+            state = 'paused'
+        elif task.running:
+            state = 'running'
+        else:
+            state = 'next in %s' % ago(task.due - now)
+        last = ''
+        if task.last_run is not None:
+            last = ', last %s ago took %dms' % (ago(now - task.last_run), task.last_duration * 1000)
+            if task.last_error:
+                last += ' (%s)' % task.last_error
+        return '\002%s\002 %s, %s, %d runs %d failed %d missed%s' % (task.name, task.spec, state, task.runs, task.failures, task.missed, last)
+
+    tasks = self.scheduler.tasks.values() if self.scheduler else []
+    return ' | '.join(show(x) for x in tasks) or 'no tasks'
+
+@command(restrict='admins')
+def profile(self, channel, nick, host, *args):
+    """profile <command> [args] runs it once under cProfile, profile start [interval] and profile stop sample everything"""
+    if not args:
+        if self.sampler:
+            return 'sampling for %s, %d samples so far' % (self._fmt_seconds(int(time.time() - self.sampler.started)) or 'a moment', self.sampler.samples)
+        return 'profile what?'
+    if args[0] == 'start':
+        if self._start_sampler(float(args[1]) if len(args) > 1 else None):
+            return '\002profile !!\002 sampling, stop when u seen enough'
+        return 'already sampling'
+    if args[0] == 'stop':
+        sampler, path = self._stop_sampler()
+        if sampler is None:
+            return 'not sampling'
+        owners = sampler.owners()
+        total = sum(x[1] for x in owners) or 1
+        owners = ', '.join('%s %d%%' % (owner, count * 100 / total) for owner, count in owners[:5])
+        return '\002profile !!\002 %d samples in %s: %s' % (sampler.samples, path, owners or 'nothing ran')
+
+    name = args[0].lstrip(self.config['cmd_prefix']).lower()
+    if name not in self.commands:
+        return 'no command called %s' % name
+    if not self._check_permission(self.commands[name]._restrict, nick, host):
+        return 'not allowed to %s' % name
+    response, path, stats = self._profile_command(channel, nick, host, name, args[1:])
+    slowest = sorted(stats.stats.iteritems(), key=lambda x: -x[1][2])[:3]
+    self.msg(channel, '\002profile !!\002 %s took %dms, stats in %s, slowest: %s' % (name, stats.total_tt * 1000, path,
+             ', '.join('%s:%s %dms' % (os.path.basename(func[0]), func[2], timing[2] * 1000) for func, timing in slowest)))
+    return response
 
 @command
 def help(self, channel, nick, host, command=None, *args):
     """returns help nogga"""
-    commands = filter(lambda x: self.commands[x]._restrict is None, self.commands)
-    for role in self.config['user_roles']:
-        if self._check_permission(role, nick, host):
-            commands.extend(filter(lambda x: self.commands[x]._restrict == role, self.commands))
+    commands = self._help_commands(role for role in self.config['user_roles'] if self._check_permission(role, nick, host))
 
     if command in commands:
         method = self.commands[command]
@@ -71,7 +185,7 @@ def help(self, channel, nick, host, command=None, *args):
         else:
             return '\002help ??\002 eh wut'
     else:
-        return '\002help ?? available commands\002 >> %s' % ', '.join(sorted(commands))
+        return '\002help ?? available commands\002 >> %s' % ', '.join(commands)
 
 @command
 def say(self, channel, nick, host, *args):
@@ -123,11 +237,11 @@ def deop(self, channel, nick, host, *args):
         modes = 'o' * len(args)
         users = ' '.join(args).strip()
         if users == '*':
-            self._names(channel, ('mode', '-o'))
+            self._mass_mode(channel, '-o')
         else:
             self.sendLine('MODE %s -%s %s' % (channel, modes, users))
     else:
-        self._names(channel, ('mode', '-o'))
+        self._mass_mode(channel, '-o')
 
 @command('voice', 'v', restrict='admins')
 def voice(self, channel, nick, host, *args):
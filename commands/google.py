@@ -1,10 +1,10 @@
-import json, urllib, urllib2, re, sys
-from chii import command, config
+import re, sys
+from chii import command, config, init
 
 GOOGLE_API_KEY = config['google_api_key']
 
 if GOOGLE_API_KEY:
-    MY_IP = urllib.urlopen('http://www.whatismyip.com/automation/n09230945.asp').read()
+    MY_IP = None
     YOUTUBE_PATTERN = re.compile('(http://www.youtube.com[^\&]+)')
     SEARCH_API = (
         {'url': 'web', 'aliases': ('g', 'google')},
@@ -14,36 +14,52 @@ if GOOGLE_API_KEY:
         {'url': 'video', 'aliases': ('yt', 'youtube')},
     )
 
+    HEADERS = {'Referer': 'http://quoth.notune.com'}
+
+    @init(threaded=False)
+    def find_ip(self):
+        """looks up our ip, google wants it with every search"""
+        def found(response):
+            global MY_IP
+            MY_IP = response.body.strip()
+        return self.http.get('http://www.whatismyip.com/automation/n09230945.asp').addCallback(found)
+
+    # searches add callbacks to http deferreds, which is only safe on the reactor
     def build_search(api):
-        @command(*api['aliases'])
+        @command(*api['aliases'], cache=3600, executor='reactor')
         def search(self, channel, nick, host, *args):
             if args:
                 query = '%20'.join(args)
             else:
                 return 'you require a query'
+            def top(data):
+                result = data['responseData']['results'][0]
+                title, url = result['titleNoFormatting'], result['url']
+                msg = 'top result: %s - %s' % (title, url)
+                return str(msg)
             url = 'https://ajax.googleapis.com/ajax/services/search/%s?v=1.0&q=%s&key=%s&userip=%s' % (api['url'], query, GOOGLE_API_KEY, MY_IP)
-            request = urllib2.Request(url, None, {'Referer': 'http://quoth.notune.com'})
-            response = urllib2.urlopen(request)
-            result = json.load(response)['responseData']['results'][0]
-            title, url = result['titleNoFormatting'], result['url']
-            msg = 'top result: %s - %s' % (title, url)
-            return str(msg)
+            return self.http.get_json(url, headers=HEADERS).addCallback(top)
         search.__doc__ = "searches %s" % api['url']
         return search
 
     for api in SEARCH_API:
         setattr(sys.modules[__name__], api['url'], build_search(api))
 
-    @command('yt', 'youtube')
+    @command('yt', 'youtube', cache=3600, executor='reactor')
     def youtube_search(*args):
         """search youtube"""
-        msg, url = video(*args).rsplit(' ', 1)
-        url = url.replace('%3F', '?').replace('%3D', '=')
-        if 'youtube' in url:
-            url = re.search(YOUTUBE_PATTERN, url).group()
-        return ' '.join((msg, url))
+        def clean(result):
+            msg, url = result.rsplit(' ', 1)
+            url = url.replace('%3F', '?').replace('%3D', '=')
+            if 'youtube' in url:
+                url = re.search(YOUTUBE_PATTERN, url).group()
+            return ' '.join((msg, url))
+        result = video(*args)
+        if isinstance(result, str):
+            return result
+        return result.addCallback(clean)
 
-    @command('gt', 'translate')
+    @command('gt', 'translate', cache=86400, executor='reactor')
     def google_translate(self, channel, nick, host, language_pair=None, *args):
         """so kawaii"""
         if not args or not language_pair:
@@ -53,6 +69,4 @@ if GOOGLE_API_KEY:
         query = '%20'.join(args)
 
         url = 'https://ajax.googleapis.com/ajax/services/language/translate?v=1.0&q=%s&langpair=%s' % (query, language_pair)
-        request = urllib2.Request(url, None, {'Referer': 'http://quoth.notune.com'})
-        response = urllib2.urlopen(request)
-        return json.load(response)['responseData']['translatedText']
+        return self.http.get_json(url, headers=HEADERS).addCallback(lambda data: data['responseData']['translatedText'])
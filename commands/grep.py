@@ -0,0 +1,54 @@
+import datetime, time
+from twisted.internet import defer
+from chii import command
+
+OPTIONS = ('nick', 'chan', 'since', 'until', 'page')
+
+def parse_date(value):
+    return time.mktime(datetime.datetime.strptime(value, '%Y-%m-%d').timetuple())
+
+@command
+def grep(self, channel, nick, host, *args):
+    """searches the logs of this channel
+    options: nick:<nick> since:<yyyy-mm-dd> until:<yyyy-mm-dd> page:<n>, admins can use chan:<channel> or chan:*
+    and search in private"""
+    if not self.logger.search:
+        return 'not indexing logs, grep the old fashioned way'
+
+    query, options = [], {}
+    for arg in args:
+        key, sep, value = arg.partition(':')
+        if sep and key in OPTIONS and value:
+            options[key] = value
+        else:
+            query.append(arg)
+
+    admin = self._check_permission('admins', nick, host)
+    # in private the log would be a conversation with whoever had this nick
+    if not channel.startswith('#') and not admin:
+        return 'grep in a channel, only admins can search private logs'
+    search_channel = channel
+    if 'chan' in options:
+        if not admin:
+            return 'only admins can search other channels'
+        search_channel = None if options['chan'] == '*' else options['chan']
+    try:
+        since = parse_date(options['since']) if 'since' in options else None
+        until = parse_date(options['until']) if 'until' in options else None
+        page = int(options.get('page', 1))
+    except ValueError:
+        return 'dates are yyyy-mm-dd and pages are numbers'
+
+    def show(result):
+        total, hits = result
+        if not hits:
+            return 'nothing found'
+        pages = (total + 4) // 5
+        lines = ['\002grep\002 %d hits, page %d/%d' % (total, page, pages)]
+        for hit in hits:
+            day = time.strftime('%Y-%m-%d', time.localtime(hit['time']))
+            lines.append('%s #%s %s' % (day, hit['channel'], hit['line']))
+        return '\n'.join(lines)
+    # in a shard the index is the frontend's, and the result is deferred
+    return defer.maybeDeferred(self.logger.search.search, ' '.join(query), nick=options.get('nick'),
+                               channel=search_channel, since=since, until=until, page=page).addCallback(show)
@@ -12,7 +12,7 @@ for x in DANGEROUS:
     x = None
 
 if HELPER_FUNCS:
-    import random
+    import json, random
     # funcs available to lambda
     def rand(choices=None):
         """wrapper for random, to make it a bit easier to use common functions from lambdas"""
@@ -25,24 +25,14 @@ if HELPER_FUNCS:
         else:
             return 'wtf mang'
 
-    try:
-        import httplib2
-        h = httplib2.Http('.cache')
+    from chii import fetch
 
-        def get(url):
-            return h.request(url, 'GET')[1]
+    def get(url):
+        return fetch(url, {'Referer': 'http://quoth.notune.com'})
 
-        def head(url):
-            return h.request(url, 'GET')[0]
-    except:
-        import urllib2
-        def get(url):
-            request = urllib2.Request(url, None, {'Referer': 'http://quoth.notune.com'})
-            return urllib2.urlopen(request)
-    
     def json_get(url):
-        return json.load(get(url))
-    
+        return json.loads(get(url))
+
     try:
         import yaml
         def yaml_get(url):
@@ -77,6 +67,10 @@ def wrap_lambda(func, func_s, name, nick):
     help_def = func_s.replace('channel, nick, host, ', '')
     wrapped_lambda.__doc__ = "lambda function added by \002%s\002\n%s = %s" % (nick, name, help_def)
     wrapped_lambda._restrict = None
+    # lambdas run in the process pool, rebuilt from source by the worker
+    wrapped_lambda._executor = 'process'
+    wrapped_lambda._timeout = None
+    wrapped_lambda._lambda = (__name__, func_s, name, nick)
     return wrapped_lambda
 
 @command('lambda')
@@ -109,11 +103,12 @@ def lambda_command(self, channel, nick, host, *args):
             return 'not a valid lambda function: %s' % e
         # save to config if persist_lambda is on
         if PERSIST:
-            if not SAVED_LAMBDAS:
+            if not self.config['lambdas']:
                 self.config['lambdas'] = {}
             self.config['lambdas'][name] = [func_s, nick]
             self.config.save()
         self.commands[name] = wrap_lambda(func, func_s, name, nick)
+        self._update_help_index()
         return 'added new lambda function to commands as %s' % name
 
     dispatch = {
@@ -142,4 +137,20 @@ if PERSIST and SAVED_LAMBDAS:
                 print 'not a valid lambda function: %s' % e
                 break
             self.commands[name] = wrap_lambda(func, func_s, name, nick)
+            self._update_help_index()
             print 'added new lambda function to commands as %s' % name
+
+if PERSIST:
+    @event('config')
+    def sync_lambdas(self, keys):
+        """lambdas added or deleted elsewhere, like in another shard"""
+        if 'lambdas' not in keys:
+            return
+        saved = self.config['lambdas'] or {}
+        for name, method in self.commands.items():
+            if hasattr(method, '_lambda') and name not in saved:
+                del self.commands[name]
+        for name, (func_s, nick) in saved.iteritems():
+            if name not in self.commands:
+                self.commands[name] = wrap_lambda(eval(func_s), func_s, name, nick)
+        self._update_help_index()
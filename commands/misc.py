@@ -1,4 +1,5 @@
-import json, random, os, urllib, urllib2
+import random, time, urllib
+from twisted.internet import defer
 from chii import config, command
 
 IMGUR_API_KEY = config['imgur_api_key']
@@ -34,21 +35,19 @@ def lambchops(self, channel, nick, host, *args):
 @command
 def last(self, channel, nick, host, *args):
     """that last bit was quite funny!"""
-    def get_line(f, size):
-        while True:
-            size -= 1
-            f.seek(size)
-            line = f.read()
-            if line.startswith('\n'):
-                return f, size, line
-
     if self.config['log_channels']:
-        log_file = os.path.join(self.config['logs_dir'], channel[1:] + '.log')
-        size = os.path.getsize(log_file) - 2 # skip last \n hopefully
-        with open(log_file) as f:
-            last = get_line(f, size) # find last line
-            line = get_line(last[0], last[1])[2].split('\n')[1].split(']', 1)[1] # get line before and clean it up!
-        self.topic(channel, line.strip())
+        command = self.config['cmd_prefix'] + 'last'
+        def last_line(index):
+            # skip our own command if it's already been logged
+            for line in reversed(index.tail(2)):
+                line = line.split(']', 1)[-1].strip()
+                if not line.split(' ', 1)[-1].startswith(command):
+                    break
+            else:
+                return 'nothing happened yet'
+            self.topic(channel, line)
+        # the index is deferred when we're on the reactor
+        return defer.maybeDeferred(self.logger.index, channel).addCallback(last_line)
     else:
         return 'not logging, I have no fucking clue what happened 2 seconds ago'
 
@@ -62,12 +61,22 @@ def directions(self, channel, nick, host, *args):
     return url % tuple(directions)
 
 if IMGUR_API_KEY:
-    @command
+    # imgur only updates its stats every so often, so they're fetched at most
+    # every STATS_TTL seconds and a random pick is made from them every time
+    STATS_TTL = 300
+    popular_images = {'expires': 0, 'images': None}
+
+    @command(executor='reactor')
     def imgur(self, channel, nick, host, *args):
         """<densy> this mode is full of fail"""
+        def remember(data):
+            popular_images.update(expires=time.time() + STATS_TTL, images=data['stats']['most_popular_images'])
+            return popular_images['images']
+
+        def recommend(images):
+            return 'densy recommended. doctor approved: http://imgur.com/%s' % str(get_random(images))
+
+        if popular_images['images'] and time.time() < popular_images['expires']:
+            return recommend(popular_images['images'])
         url = 'http://api.imgur.com/2/stats.json'
-        request = urllib2.Request(url, None, {'key': IMGUR_API_KEY})
-        response = urllib2.urlopen(request)
-        results = json.load(response)['stats']['most_popular_images']
-        result = get_random(results)
-        return 'densy recommended. doctor approved: http://imgur.com/%s' % str(result)
+        return self.http.get_json(url, headers={'key': IMGUR_API_KEY}).addCallback(remember).addCallback(recommend)
@@ -1,55 +1,323 @@
-from chii import config, command
+from chii import config, command, init
 
 BRAIN = config['retard_brain']
 CHATTINESS = 0
 WORD_COUNT = 10
 WORD_MAX = 1000
+# sentences shorter than this are tried again, a few times at most as a small
+# brain may never come up with a longer one
+SENTENCE_MIN = 20
+SENTENCE_TRIES = 10
+# successors walked before a key gets a cumulative count array to bisect, and
+# how many of those arrays are kept
+WALK_MAX = 32
+CUMULATIVE_MAX = 256
 SENTENCE_SEPS = ('. ', '! ', '? ', '\n')
 
 if BRAIN:
-    import random, re, os
-    from collections import defaultdict
+    import array, bisect, random, os, threading
+    from collections import deque
+
+    class IntTable(object):
+        """int to int map doing open addressing over two arrays, so there are
+           no objects per entry to take up memory or for the garbage collector
+           to walk. Keys are stored + 1, 0 marks a free slot"""
+        __slots__ = ('keys', 'values', 'mask', 'size')
+
+        def __init__(self, capacity=1024):
+            self.keys = array.array('l', [0]) * capacity
+            self.values = array.array('i', [0]) * capacity
+            self.mask = capacity - 1
+            self.size = 0
+
+        def _slot(self, key):
+            """returns the slot key is in, or the free one it would go in"""
+            keys, mask = self.keys, self.mask
+            # pairs are packed high << 32 | low, fold high into low and take
+            # the middle bits of a multiplicative hash of that
+            i = ((key ^ (key >> 32) * 0x9e3779b1) & 0x7fffffff) * 0x9e3779b1 >> 29 & mask
+            while keys[i] and keys[i] != key:
+                i = (i + 1) & mask
+            return i
+
+        def get(self, key, default=-1):
+            # _slot inlined, this is most of the time spent learning
+            keys, mask = self.keys, self.mask
+            key += 1
+            i = ((key ^ (key >> 32) * 0x9e3779b1) & 0x7fffffff) * 0x9e3779b1 >> 29 & mask
+            while keys[i]:
+                if keys[i] == key:
+                    return self.values[i]
+                i = (i + 1) & mask
+            return default
+
+        def add(self, key, value):
+            """adds a key which isn't in the table yet"""
+            if (self.size + 1) * 3 > len(self.keys) * 2:
+                self._grow()
+            i = self._slot(key + 1)
+            self.keys[i] = key + 1
+            self.values[i] = value
+            self.size += 1
+
+        def _grow(self):
+            # the new table is filled in before it's swapped in, so lookups
+            # never see it half built
+            old_keys, old_values = self.keys, self.values
+            keys = array.array('l', [0]) * (len(old_keys) * 2)
+            values = array.array('i', [0]) * (len(old_keys) * 2)
+            mask = len(keys) - 1
+            for i in xrange(len(old_keys)):
+                key = old_keys[i]
+                if key:
+                    j = ((key ^ (key >> 32) * 0x9e3779b1) & 0x7fffffff) * 0x9e3779b1 >> 29 & mask
+                    while keys[j]:
+                        j = (j + 1) & mask
+                    keys[j] = key
+                    values[j] = old_values[i]
+            self.keys, self.values, self.mask = keys, values, mask
+
+    class WordTable(object):
+        """interns words to ids. Every word's bytes are kept once, in one
+           bytearray, and the table of ids is open addressed by the word's hash,
+           comparing slices of the text on a hash match. Ids are stored + 1, 0
+           marks a free slot"""
+        __slots__ = ('text', 'offsets', 'hashes', 'slots', 'mask')
+
+        def __init__(self, capacity=1024):
+            self.text = bytearray()
+            self.offsets = array.array('l', [0])
+            self.hashes = array.array('l')
+            self.slots = array.array('i', [0]) * capacity
+            self.mask = capacity - 1
+
+        def __len__(self):
+            return len(self.hashes)
+
+        def word(self, id):
+            return str(self.text[self.offsets[id]:self.offsets[id + 1]])
+
+        def get(self, word, default=None):
+            """returns id of word, default if it was never interned"""
+            slots, hashes, offsets, text = self.slots, self.hashes, self.offsets, self.text
+            h = hash(word)
+            i = h & self.mask
+            while slots[i]:
+                id = slots[i] - 1
+                if hashes[id] == h and text[offsets[id]:offsets[id + 1]] == word:
+                    return id
+                i = (i + 1) & self.mask
+            return default
+
+        def intern(self, word):
+            """returns id of word, adding it if it's new"""
+            slots, hashes, offsets, text = self.slots, self.hashes, self.offsets, self.text
+            h = hash(word)
+            i = h & self.mask
+            while slots[i]:
+                id = slots[i] - 1
+                if hashes[id] == h and text[offsets[id]:offsets[id + 1]] == word:
+                    return id
+                i = (i + 1) & self.mask
+            id = len(hashes)
+            # the word goes in the table last, so a process forked halfway
+            # through never finds an id without its word
+            text.extend(word)
+            offsets.append(len(text))
+            hashes.append(h)
+            slots[i] = id + 1
+            if (id + 1) * 3 > len(slots) * 2:
+                self._grow()
+            return id
+
+        def _grow(self):
+            slots = array.array('i', [0]) * (len(self.slots) * 2)
+            mask = len(slots) - 1
+            for id in xrange(len(self.hashes)):
+                i = self.hashes[id] & mask
+                while slots[i]:
+                    i = (i + 1) & mask
+                slots[i] = id + 1
+            self.slots, self.mask = slots, mask
 
     class MarkovChain:
-        chain = defaultdict(list)
+        """Which words followed every pair of words, and how often. Words are
+           interned to ids, a pair of ids is packed into one int and both pairs
+           and their successors are looked up in IntTables. A pair's successors
+           are a linked list of (word, count) kept in arrays. Repeats only bump
+           a count, and it's all arrays, which the cyclic garbage collector
+           doesn't track. Learning and generating take a lock, as lines are
+           learned from whichever thread the command or init runs in."""
+        def __init__(self):
+            # word <-> id
+            self.ids = WordTable()
+            self.ids.intern('\n')
+            # pair -> key, and every key's pair, first successor and total count
+            self.keys = IntTable()
+            self.pairs = array.array('l')
+            self.heads = array.array('i')
+            self.totals = array.array('i')
+            # key << 32 | word -> successor, and every successor's word, count and link to the next one of its key
+            self.successors = IntTable()
+            self.words = array.array('i')
+            self.counts = array.array('i')
+            self.links = array.array('i')
+            # key -> (total, cumulative counts, words) of keys with lots of successors
+            self.cumulative = {}
+            # lines learned so far
+            self.lines = 0
+            self.pid, self.lock = os.getpid(), threading.Lock()
+
+        def _lock(self):
+            """returns the lock. A forked process gets a new one, the one it was
+               forked with may be held by a thread that didn't come along"""
+            if self.pid != os.getpid():
+                self.pid, self.lock = os.getpid(), threading.Lock()
+            return self.lock
+
+        def _word(self, id):
+            return self.ids.word(id)
+
+        def _key(self, w1, w2):
+            """returns key of a pair of word ids, -1 if the pair was never seen"""
+            if w1 is None or w2 is None:
+                return -1
+            return self.keys.get(w1 << 32 | w2)
+
+        def _choose(self, key):
+            """returns id of a random successor of key, weighted by count. Keys
+               with more than WALK_MAX successors get their cumulative counts
+               cached and bisected instead of walking the whole list"""
+            total = self.totals[key]
+            n = random.randrange(total)
+            cached = self.cumulative.get(key)
+            if cached is None or cached[0] != total:
+                counts, links = self.counts, self.links
+                successor, left = self.heads[key], n
+                for i in xrange(WALK_MAX):
+                    if left < counts[successor]:
+                        return self.words[successor]
+                    left -= counts[successor]
+                    successor = links[successor]
+                bounds, words = array.array('l'), array.array('i')
+                successor, seen = self.heads[key], 0
+                while successor >= 0:
+                    seen += counts[successor]
+                    bounds.append(seen)
+                    words.append(self.words[successor])
+                    successor = links[successor]
+                if key not in self.cumulative and len(self.cumulative) >= CUMULATIVE_MAX:
+                    self.cumulative.popitem()
+                cached = self.cumulative[key] = (total, bounds, words)
+            return cached[2][bisect.bisect_right(cached[1], n)]
 
         def add_to_brain(self, line, write_to_file=False):
             if write_to_file:
                 with open(BRAIN, 'a') as f:
                     f.write(line + '\n')
-            w1 = w2 = "\n"
-            for word in line.split(' '):
-                self.chain[(w1, w2)].append(word)
+            if isinstance(line, unicode):
+                # words are kept as bytes
+                line = line.encode('utf-8')
+            with self._lock():
+                self._learn(line)
+
+        def _learn(self, line):
+            self.lines += 1
+            intern = self.ids.intern
+            ids = [intern(x) for x in line.split(' ')]
+            ids.append(0)
+            # this runs for every word ever learned, so IntTable.get is inlined
+            # and everything is a local
+            keys, pairs, heads, totals = self.keys, self.pairs, self.heads, self.totals
+            successors, counts, links = self.successors, self.counts, self.links
+            w1 = w2 = 0
+            for word in ids:
+                pair = (w1 << 32 | w2) + 1
+                table, mask = keys.keys, keys.mask
+                i = ((pair ^ (pair >> 32) * 0x9e3779b1) & 0x7fffffff) * 0x9e3779b1 >> 29 & mask
+                found = table[i]
+                while found and found != pair:
+                    i = (i + 1) & mask
+                    found = table[i]
+                # writes go so that a process forked halfway through still
+                # finds every key and successor whole: new entries are added
+                # to the tables after their arrays, and totals never run
+                # ahead of counts
+                if found:
+                    key = keys.values[i]
+                else:
+                    key = len(pairs)
+                    pairs.append(pair - 1)
+                    heads.append(-1)
+                    totals.append(0)
+                    keys.add(pair - 1, key)
+                pair = (key << 32 | word) + 1
+                table, mask = successors.keys, successors.mask
+                i = ((pair ^ (pair >> 32) * 0x9e3779b1) & 0x7fffffff) * 0x9e3779b1 >> 29 & mask
+                found = table[i]
+                while found and found != pair:
+                    i = (i + 1) & mask
+                    found = table[i]
+                if found:
+                    counts[successors.values[i]] += 1
+                else:
+                    self.words.append(word)
+                    counts.append(1)
+                    links.append(heads[key])
+                    heads[key] = len(counts) - 1
+                    successors.add(pair - 1, len(counts) - 1)
+                totals[key] += 1
                 w1, w2 = w2, word
-            self.chain[w1, w2].append('\n')
 
         def get_key(self, msg=None):
+            if isinstance(msg, unicode):
+                msg = msg.encode('utf-8')
             if msg and len(msg.split()) > 1:
                 words = msg.split()
                 w1, w2 = words[0:2]
                 for word in words:
-                    if self.chain[(w1, w2)] != []:
+                    if self._key(self.ids.get(w1), self.ids.get(w2)) >= 0:
                         return w1, w2
                     w1, w2 = w2, word
-            return random.choice(self.chain.keys())
+            pair = self.pairs[random.randrange(len(self.pairs))]
+            return self._word(pair >> 32), self._word(pair & 0xffffffff)
 
         def generate_sentence(self, msg):
+            with self._lock():
+                sentence = self._sentence(msg)
+                for i in xrange(SENTENCE_TRIES - 1):
+                    if len(sentence) >= SENTENCE_MIN:
+                        break
+                    sentence = max(sentence, self._sentence(None), key=len)
+            return sentence
+
+        def _sentence(self, msg):
             sentence = ''
             w1, w2 = self.get_key(msg)
+            key, w2 = self._key(self.ids.get(w1), self.ids.get(w2)), self.ids.get(w2)
             for i in xrange(WORD_MAX):
-                try:
-                    word = random.choice(self.chain[(w1, w2)])
-                except IndexError:
-                    word = random.choice(self.chain[self.get_key()])
-                word = word.strip()
+                if key < 0:
+                    # dead end, carry on from a random pair
+                    key = random.randrange(len(self.pairs))
+                word = self._word(self._choose(key)).strip()
                 if not word:
                     break
                 sentence = ' '.join((sentence, word))
-                w1, w2 = w2, word
-            if len(sentence) < 20:
-                return self.generate_sentence(None)
+                word = self.ids.get(word)
+                key, w2 = self._key(w2, word), word
             return sentence
 
+    def generate(msg, lines, recent):
+        """runs in the process pool, so it has to be a module level function.
+           Workers have the brain as it was when they were forked, so they
+           first learn whatever of the lines learned since is still in recent"""
+        missing = lines - markov_chain.lines
+        if missing > 0:
+            for line in recent[-missing:]:
+                markov_chain.add_to_brain(line)
+            markov_chain.lines = lines
+        return markov_chain.generate_sentence(msg)
+
     @command
     def retard(self, channel, nick, host, *args):
         msg = ' '.join(args)
@@ -63,12 +331,21 @@ if BRAIN:
 
         prefix = "%s:" % nick
         markov_chain.add_to_brain(msg, write_to_file=True)
-        return prefix + clean_sentence(markov_chain.generate_sentence(msg))
+        recent.append(msg)
+        d = self._defer_to_process(generate, msg, markov_chain.lines, list(recent))
+        d.addCallback(lambda sentence: prefix + clean_sentence(sentence))
+        return d
 
     markov_chain = MarkovChain()
+    # lines learned lately, for process pool workers to catch up on. A worker
+    # lagging further behind than this misses some until it's recycled
+    recent = deque(maxlen=1000)
 
-    if os.path.exists(BRAIN):
-        with open(BRAIN) as f:
-            for line in f.readlines():
-                markov_chain.add_to_brain(line)
-        print 'Retard Brain Loaded'
+    @init
+    def load_brain(self):
+        """learning a big brain takes a while, so it's done off the reactor"""
+        if os.path.exists(BRAIN):
+            with open(BRAIN) as f:
+                for line in f:
+                    markov_chain.add_to_brain(line)
+            print 'Retard Brain Loaded'
@@ -1,5 +1,6 @@
 from chii import config, command
 from fnmatch import fnmatch
+from twisted.internet import threads
 import tweepy
 
 CONSUMER_KEY = config['consumer_key'] or '7YQFmkKuayyGpGrqgQGcA'
@@ -39,6 +40,7 @@ def tweet(self, channel, nick, host, *args):
         except Exception as e:
             return e
 
+    # tweepy talks http itself, keep it off the reactor
     auth = tweepy.OAuthHandler(CONSUMER_KEY, CONSUMER_SECRET)
     for user in self.config['tweet']:
         if fnmatch('!'.join((nick, host)), user):
@@ -48,10 +50,10 @@ def tweet(self, channel, nick, host, *args):
         config = self.config['tweet']['bot']
     if args and config:
         if 'token' and 'secret' in config:
-            return update_status(args, auth, config)
+            return threads.deferToThread(update_status, args, auth, config)
         else:
-            return save_oauth_token(auth, args[0])
+            return threads.deferToThread(save_oauth_token, auth, args[0])
     elif config:
         return 'tweet?'
     else:
-        return get_auth_url(auth)
+        return threads.deferToThread(get_auth_url, auth)
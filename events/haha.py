@@ -22,7 +22,7 @@ if THRESHOLD:
             'hahahahahaahhahahaahahahahhhahhhhahahahahahahahahahahahahahahahaahahahaha',
     )
 
-    @event('msg')
+    @event('msg', contains='haha', nocase=True)
     def haha(self, channel, nick, host, msg):
         if random.random() < self.config['haha_threshold']:
             if 'haha' in msg.lower():
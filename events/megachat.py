@@ -6,7 +6,7 @@ except:
 if megahal:
     from megahal import *
     import os, random, re
-    from chii import config, event
+    from chii import config, event, init
 
     # get config or set defaults
     if config['megahal_brain']:
@@ -18,8 +18,14 @@ if megahal:
     else:
         CHATTINESS = 0
     
-    megahal = MegaHAL(brainfile=BRAIN, order=DEFAULT_ORDER, timeout=DEFAULT_TIMEOUT)
-    
+    brain = None
+
+    @init
+    def megaopen(self):
+        """loading the brain takes a while, so it's done off the reactor"""
+        global brain
+        brain = MegaHAL(brainfile=BRAIN, order=DEFAULT_ORDER, timeout=DEFAULT_TIMEOUT)
+
     @event('msg')
     def megachat(self, channel, nick, host, msg):
         if self.nickname.lower() in msg.lower():
@@ -29,11 +35,12 @@ if megahal:
             prefix = ''
     
         if prefix or random.random() <= CHATTINESS:
-            return prefix + megahal.get_reply(msg)
+            return prefix + brain.get_reply(msg)
         elif nick == 'ali':
-            return prefix + megahal.get_reply(msg)            
+            return prefix + brain.get_reply(msg)            
     
     @event('unload', 'quit')
     def megaclose(self, *args):
-        megahal.sync()
-        megahal.close()
+        if brain:
+            brain.sync()
+            brain.close()
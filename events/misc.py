@@ -1,12 +1,11 @@
 from chii import event
 import random
 
-@event('action')
+@event('action', contains='trout')
 def trout(self, channel, nick, host, action):
-    if 'trout' in action:
-        self.me(channel, 'slaps %s around with a large carp' % nick)
+    self.me(channel, 'slaps %s around with a large carp' % nick)
 
-@event('msg')
+@event('msg', matches=r'^who (is|the).*best\??$')
 def the_best(self, channel, nick, host, msg):
     if (msg.startswith('who is') or msg.startswith('who the')) and (msg.endswith('best?') or msg.endswith('best')):
         if self.config['owner'] in '!'.join((nick, host)):
@@ -21,27 +20,23 @@ def the_best(self, channel, nick, host, msg):
         else:
             self.msg(channel, response)
 
-@event('msg')
+@event('msg', equals='ya')
 def ya(self, channel, nick, host, msg):
-    if msg.strip() == 'ya':
-        self.msg(channel, 'ya')
+    self.msg(channel, 'ya')
 
-@event('msg')
+@event('msg', contains='xaimus')
 def xaimus(self, channel, nick, host, msg):
-    if 'xaimus' in msg:
-        self.msg(channel, 'huang')
+    self.msg(channel, 'huang')
 
-@event('msg')
+@event('msg', contains='muse')
 def muse(self, channel, nick, host, msg):
-    if 'muse' in msg:
-        self.msg(channel, 'U RANG %s' % nick)
+    self.msg(channel, 'U RANG %s' % nick)
 
-@event('msg')
+@event('msg', equals='cool')
 def cool(self, channel, nick, host, msg):
-    if msg.strip() == 'cool':
-        self.msg(channel, 'cool')
+    self.msg(channel, 'cool')
 
-@event('msg')
+@event('msg', contains='anders', nocase=True)
 def anders(self, channel, nick, host, msg):
     ANDERS_IS_GAY = (
         'haha what a fag',
@@ -50,5 +45,4 @@ def anders(self, channel, nick, host, msg):
         '...eventually culminating in buttfuckery',
         'oh no look anders got penis stuck in his face'
     )
-    if 'anders' in msg.lower():
-        self.msg(channel, random.choice(ANDERS_IS_GAY))
+    self.msg(channel, random.choice(ANDERS_IS_GAY))
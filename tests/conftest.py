@@ -0,0 +1,10 @@
+import os, sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from twisted.python import threadable
+
+# the tests run where the reactor would, chii checks before touching deferreds
+threadable.registerAsIOThread()
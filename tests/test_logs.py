@@ -0,0 +1,105 @@
+import datetime, os, time
+from chii import LogFile, LogIndex, SearchIndex
+
+def write_log(path, lines, day=datetime.date(2024, 1, 1)):
+    """writes lines and dates the log so its last line was logged on day"""
+    with open(path, 'wb') as log:
+        log.write(''.join(x + '\n' for x in lines))
+    when = time.mktime(day.timetuple()) + 23 * 3600
+    os.utime(path, (when, when))
+
+def stamp(day, clock):
+    h, m, s = map(int, clock.split(':'))
+    return time.mktime(datetime.date(2024, 1, day).timetuple()) + h * 3600 + m * 60 + s
+
+def test_index_lines(tmpdir):
+    path = str(tmpdir.join('chan.log'))
+    write_log(path, ['[10:00:00] <a> one', '[10:00:01] <b> two', '[10:00:02] <a> three'])
+    index = LogIndex(path)
+    index.sync()
+    assert len(index) == 3
+    assert index.line(1) == '[10:00:02] <a> three'
+    assert index.tail(2) == ['[10:00:01] <b> two', '[10:00:02] <a> three']
+    assert index.line(4) is None
+
+def test_index_dates_lines_across_midnight(tmpdir):
+    path = str(tmpdir.join('chan.log'))
+    write_log(path, ['[23:59:00] <a> late', '[00:01:00] <b> early', '[12:00:00] <a> noon'],
+              day=datetime.date(2024, 1, 2))
+    index = LogIndex(path)
+    index.sync()
+    times = [when for offset, when in index.records(0, 3)]
+    assert times == [stamp(1, '23:59:00'), stamp(2, '00:01:00'), stamp(2, '12:00:00')]
+    assert index.between(stamp(2, '00:00:00'), stamp(2, '12:00:00')) == ['[00:01:00] <b> early']
+
+def test_index_catches_up_and_rebuilds(tmpdir):
+    path = str(tmpdir.join('chan.log'))
+    write_log(path, ['[10:00:00] <a> one'])
+    index = LogIndex(path)
+    index.sync()
+    with open(path, 'ab') as log:
+        log.write('[10:00:05] <a> two\n[10:00:06] <a> half')
+    index.sync()
+    # the unfinished line is left for later
+    assert index.tail(5) == ['[10:00:00] <a> one', '[10:00:05] <a> two']
+    # a log replaced by a shorter one doesn't match its index anymore
+    write_log(path, ['[11:00:00] <c> new'])
+    index.sync()
+    assert index.tail(5) == ['[11:00:00] <c> new']
+
+def test_log_file_writes_index(tmpdir):
+    path = str(tmpdir.join('chan.log'))
+    log_file = LogFile(path, '2024-01-01')
+    log_file.write('[10:00:00] <a> hi\n', 100.0)
+    log_file.write('[10:00:01] <a> there\n', 101.0)
+    log_file.close()
+    index = LogIndex(path)
+    assert index.records(0, 2) == [(0, 100.0), (len('[10:00:00] <a> hi\n'), 101.0)]
+
+def search_index(tmpdir, logs, **kwargs):
+    for name, lines in logs.iteritems():
+        write_log(str(tmpdir.join(name + '.log')), lines)
+    index = SearchIndex(str(tmpdir.join('.search')), **kwargs)
+    for name in logs:
+        index.touch(str(tmpdir.join(name + '.log')))
+    index.update()
+    return index
+
+LOGS = {
+    'chii': ['[10:00:00] <alice> the cake is a lie',
+             '[10:00:01] <@bob> cake cake cake',
+             '[10:00:02] * alice eats cake',
+             '[10:00:03] <carol> something else'],
+    'other': ['[11:00:00] <bob> cake elsewhere'],
+}
+
+def test_search_ranks_and_filters(tmpdir):
+    index = search_index(tmpdir, LOGS)
+    total, hits = index.search('cake lie')
+    assert total == 4
+    assert hits[0]['line'] == '[10:00:00] <alice> the cake is a lie'
+    assert index.search('cake', nick='alice')[0] == 2
+    assert index.search('cake', nick='BOB', channel='#chii')[1][0]['line'] == '[10:00:01] <@bob> cake cake cake'
+    total, hits = index.search('cake', channel='other')
+    assert (total, hits[0]['channel']) == (1, 'other')
+    assert index.search('nothing') == (0, [])
+    assert index.search('') == (0, [])
+
+def test_search_by_time_and_page(tmpdir):
+    index = search_index(tmpdir, LOGS)
+    total, hits = index.search('cake', since=stamp(1, '10:30:00'))
+    assert [x['line'] for x in hits] == ['[11:00:00] <bob> cake elsewhere']
+    assert index.search('cake', until=stamp(1, '10:00:01'))[0] == 1
+    total, hits = index.search('cake', page=2, per_page=3)
+    assert (total, len(hits)) == (4, 1)
+
+def test_search_segments_merge_and_persist(tmpdir):
+    # every file is written out as a segment, two segments are merged into one
+    index = search_index(tmpdir, LOGS, segment_size=1, max_segments=1)
+    assert len(index.segments) == 1 and not index.memory_docs
+    before = index.search('cake')
+    # a new index over the same directory carries on from what was saved
+    reopened = SearchIndex(str(tmpdir.join('.search')))
+    assert reopened.search('cake') == before
+    reopened.update()
+    assert reopened.search('cake') == before
@@ -0,0 +1,74 @@
+from twisted.internet.task import Clock
+from chii import ChiiOutbound, split_message
+
+def outbound(**config):
+    settings = {'flood_burst': 2, 'flood_rate': 1.0, 'flood_bytes': None, 'flood_max_queue': 100}
+    settings.update(config)
+    sent, clock = [], Clock()
+    return ChiiOutbound(sent.append, settings, clock), sent, clock
+
+def test_burst_goes_out_then_one_line_per_token():
+    out, sent, clock = outbound()
+    for n in xrange(4):
+        out.line('PRIVMSG #a :%d' % n)
+    assert sent == ['PRIVMSG #a :0', 'PRIVMSG #a :1']
+    clock.advance(0.5)
+    assert len(sent) == 2
+    clock.advance(0.5)
+    assert sent[2:] == ['PRIVMSG #a :2']
+    clock.advance(1)
+    assert sent[3:] == ['PRIVMSG #a :3']
+    assert out.stats()['sent'] == 4
+
+def test_tokens_refill_up_to_burst():
+    out, sent, clock = outbound()
+    clock.advance(60)
+    for n in xrange(3):
+        out.line('PRIVMSG #a :%d' % n)
+    assert len(sent) == 2
+
+def test_only_one_drain_is_scheduled():
+    out, sent, clock = outbound(flood_burst=1)
+    for n in xrange(5):
+        out.line('PRIVMSG #a :%d' % n)
+    assert len(clock.getDelayedCalls()) == 1
+
+def test_protocol_lines_go_ahead_of_chatter():
+    out, sent, clock = outbound(flood_burst=1)
+    out.line('PRIVMSG #a :first')
+    out.line('PRIVMSG #a :chatter')
+    out.line('PONG :server')
+    clock.pump([1, 1])
+    assert sent == ['PRIVMSG #a :first', 'PONG :server', 'PRIVMSG #a :chatter']
+
+def test_targets_take_turns():
+    out, sent, clock = outbound(flood_burst=1)
+    out.line('PRIVMSG #a :hi')
+    for n in xrange(3):
+        out.line('PRIVMSG #a :a%d' % n)
+    out.line('PRIVMSG #b :b0')
+    clock.pump([1] * 4)
+    assert sent[1:] == ['PRIVMSG #a :a0', 'PRIVMSG #b :b0', 'PRIVMSG #a :a1', 'PRIVMSG #a :a2']
+
+def test_full_queue_drops_oldest():
+    out, sent, clock = outbound(flood_burst=1, flood_max_queue=2)
+    for n in xrange(4):
+        out.line('PRIVMSG #a :%d' % n)
+    clock.pump([1] * 5)
+    assert sent == ['PRIVMSG #a :0', 'PRIVMSG #a :2', 'PRIVMSG #a :3']
+    assert out.stats()['dropped'] == 1
+
+def test_long_lines_cost_more_with_flood_bytes():
+    out, sent, clock = outbound(flood_burst=3, flood_bytes=100)
+    out.line('PRIVMSG #a :' + 'x' * 188)
+    out.line('PRIVMSG #a :short')
+    # the 200 byte line took 3 tokens
+    assert len(sent) == 1
+    clock.advance(1.2)
+    assert len(sent) == 2
+
+def test_split_message_keeps_utf8_characters_whole():
+    lines = split_message(u'\xe9' * 10, 5)
+    assert all(len(x) <= 5 for x in lines)
+    assert ''.join(lines).decode('utf-8') == u'\xe9' * 10
+    assert split_message('one two three', 7) == ['one two', 'three']
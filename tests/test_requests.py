@@ -0,0 +1,100 @@
+import types
+import pytest
+from twisted.internet.task import Clock
+import chii
+from chii import ChannelMembers, ChiiProto, ChiiRequests, RequestTimeout
+
+CONFIG = {'request_timeout': 30, 'request_cache_ttl': 300, 'request_cache_size': 2}
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(chii, 'reactor', clock)
+    return clock
+
+@pytest.fixture
+def requests(clock):
+    sent = []
+    requests = ChiiRequests(sent.append, ChannelMembers().key, CONFIG)
+    requests.sent = sent
+    return requests
+
+def answers(d):
+    result = []
+    d.addBoth(result.append)
+    return result
+
+def test_replies_are_matched_by_target(requests):
+    alice = answers(requests.request('whois', 'Alice', 'WHOIS Alice', {}))
+    bob = answers(requests.request('whois', 'bob[m]', 'WHOIS bob[m]', {}))
+    # targets are casemapped, [ and { are the same
+    requests.done('whois', 'BOB{m}', value={'nick': 'bob[m]'})
+    assert (alice, bob) == ([], [{'nick': 'bob[m]'}])
+    requests.done('whois', 'alice', value={'nick': 'Alice'})
+    assert alice == [{'nick': 'Alice'}]
+
+def test_replies_nobody_asked_for_are_dropped(requests):
+    d = answers(requests.request('who', '#chan', 'WHO #chan', []))
+    requests.done('who', '#other', value=['stray'])
+    requests.done('names', '#chan', value=['stray'])
+    assert d == []
+    assert requests.outstanding('who') == ['#chan']
+
+def test_same_request_is_sent_once_and_copied(requests):
+    first = answers(requests.request('who', '#chan', 'WHO #chan', []))
+    second = answers(requests.request('who', '#CHAN', 'WHO #CHAN', []))
+    assert requests.sent == ['WHO #chan']
+    requests.result('who', '#chan').append({'nick': 'a'})
+    requests.done('who', '#chan')
+    assert first == second == [[{'nick': 'a'}]]
+    assert first[0] is not second[0]
+
+def test_answers_are_cached(requests):
+    first = answers(requests.request('userhost', 'a', 'USERHOST a'))
+    requests.done('userhost', 'a', value='a@host')
+    first[0] += 'changed'
+    second = answers(requests.request('userhost', 'A', 'USERHOST A'))
+    assert second == ['a@host']
+    assert requests.sent == ['USERHOST a']
+    # who isn't cached, and the cache only keeps request_cache_size answers
+    for nick in ('b', 'c'):
+        requests.request('userhost', nick, 'USERHOST ' + nick)
+        requests.done('userhost', nick, value=nick + '@host')
+    requests.request('userhost', 'a', 'USERHOST a')
+    assert requests.sent[-1] == 'USERHOST a'
+
+def test_unanswered_requests_time_out(requests, clock):
+    d = answers(requests.request('whois', 'a', 'WHOIS a', {}))
+    clock.advance(30)
+    assert d[0].check(RequestTimeout)
+    assert requests.outstanding('whois') == []
+
+def proto(requests):
+    proto = types.InstanceType(ChiiProto)
+    proto.requests = requests
+    proto.who_replies = []
+    return proto
+
+def test_userhost_replies(requests):
+    p = proto(requests)
+    a, b = answers(p.userhost('a')), answers(p.userhost('b'))
+    p.irc_RPL_USERHOST('server', ['me', 'b*=-user@b.host a=+user@a.host'])
+    assert (a, b) == (['user@a.host'], ['user@b.host'])
+
+def test_empty_userhost_reply_only_answers_a_single_request(requests):
+    p = proto(requests)
+    a, b = answers(p.userhost('a')), answers(p.userhost('b'))
+    p.irc_RPL_USERHOST('server', ['me', ''])
+    assert (a, b) == ([], [])
+    p.irc_RPL_USERHOST('server', ['me', 'a=+user@a.host'])
+    p.irc_RPL_USERHOST('server', ['me', ''])
+    assert b == [None]
+
+def test_who_replies_go_to_their_mask(requests):
+    p = proto(requests)
+    chan, other = answers(p.who('#chan')), answers(p.who('#other'))
+    p.irc_RPL_WHOREPLY('server', ['me', '#chan', 'user', 'host', 'server', 'nick', 'H', '0 real name'])
+    p.irc_RPL_ENDOFWHO('server', ['me', '#chan', 'End of WHO'])
+    assert chan == [[{'channel': '#chan', 'user': 'user', 'host': 'host', 'server': 'server',
+                      'nick': 'nick', 'flags': 'H', 'realname': 'real name'}]]
+    assert other == []
@@ -0,0 +1,44 @@
+import imp, os
+import pytest
+import chii
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def retard(tmpdir, monkeypatch):
+    monkeypatch.setitem(chii.config, 'retard_brain', str(tmpdir.join('brain')))
+    return imp.load_source('retard_test', os.path.join(ROOT, 'commands', 'retard.py'))
+
+def counting(chain):
+    """counts the sentences chain comes up with"""
+    calls = []
+    sentence = chain._sentence
+    def counted(msg):
+        calls.append(msg)
+        return sentence(msg)
+    chain._sentence = counted
+    return calls
+
+def test_short_sentences_are_only_retried_a_few_times(retard):
+    chain = retard.MarkovChain()
+    chain.add_to_brain('hi there')
+    calls = counting(chain)
+    # a brain this small never comes up with SENTENCE_MIN characters
+    sentence = chain.generate_sentence('hi there')
+    assert len(calls) == retard.SENTENCE_TRIES
+    assert sentence.strip()
+
+def test_long_enough_sentences_are_not_retried(retard):
+    chain = retard.MarkovChain()
+    chain.add_to_brain('this line is a good deal longer than the shortest sentence we keep')
+    calls = counting(chain)
+    sentence = chain.generate_sentence('this line')
+    assert len(calls) == 1
+    assert len(sentence) >= retard.SENTENCE_MIN
+
+def test_the_longest_try_is_kept(retard, monkeypatch):
+    chain = retard.MarkovChain()
+    chain.add_to_brain('hi there')
+    tries = iter(['a', 'abc', 'ab'] + ['a'] * retard.SENTENCE_TRIES)
+    monkeypatch.setattr(chain, '_sentence', lambda msg: next(tries))
+    assert chain.generate_sentence('hi') == 'abc'
@@ -0,0 +1,88 @@
+import datetime, time
+import pytest
+from twisted.internet.task import Clock
+from chii import ChiiScheduler, CronSpec, IntervalSpec, TimerWheel
+
+def stamp(*args):
+    return time.mktime(datetime.datetime(*args).timetuple())
+
+def test_cron_fields():
+    spec = CronSpec('*/15 9-17 * * 1-5')
+    assert spec.minutes == set([0, 15, 30, 45])
+    assert spec.hours == set(range(9, 18))
+    assert spec.weekdays == set([1, 2, 3, 4, 5])
+    assert CronSpec('5/20 * * * *').minutes == set([5, 25, 45])
+    assert CronSpec('0 0 * * 7').weekdays == set([0])
+
+def test_cron_rejects_bad_expressions():
+    for expression in ('* * * *', '60 * * * *', '* 5-2 * * *', '* * 0 * *'):
+        with pytest.raises(ValueError):
+            CronSpec(expression)
+
+def test_cron_next():
+    # 2024-01-01 was a monday
+    assert CronSpec('30 * * * *').next(stamp(2024, 1, 1, 10, 30)) == stamp(2024, 1, 1, 11, 30)
+    assert CronSpec('@daily').next(stamp(2024, 1, 1, 10, 0)) == stamp(2024, 1, 2, 0, 0)
+    assert CronSpec('0 9 * * 1-5').next(stamp(2024, 1, 5, 12, 0)) == stamp(2024, 1, 8, 9, 0)
+    assert CronSpec('0 0 1 */3 *').next(stamp(2024, 2, 10)) == stamp(2024, 4, 1)
+    assert CronSpec('0 0 29 2 *').next(stamp(2024, 3, 1)) == stamp(2028, 2, 29)
+
+def test_cron_day_or_weekday():
+    # either the 13th or a friday, like vixie cron
+    spec = CronSpec('0 0 13 * 5')
+    assert spec.next(stamp(2024, 1, 1)) == stamp(2024, 1, 5)
+    assert spec.next(stamp(2024, 1, 12, 1)) == stamp(2024, 1, 13)
+
+def test_cron_that_never_matches():
+    with pytest.raises(ValueError):
+        CronSpec('0 0 30 2 *').next(stamp(2024, 1, 1))
+
+def test_wheel_expires_in_order():
+    wheel = TimerWheel(1.0, 0, slots=4, levels=3)
+    for when in (3, 1, 2):
+        wheel.add(when, when)
+    assert wheel.advance(0.5) == []
+    assert wheel.advance(3) == [1, 2, 3]
+
+def test_wheel_cascades_far_timers():
+    wheel = TimerWheel(1.0, 0, slots=4, levels=3)
+    # past what the lower levels cover, and past the top level's turn
+    for when in (5, 17, 63, 100):
+        wheel.add(when, when)
+    expired = []
+    for now in xrange(1, 101):
+        for item in wheel.advance(now):
+            expired.append((now, item))
+    assert expired == [(5, 5), (17, 17), (63, 63), (100, 100)]
+
+def test_wheel_never_expires_in_the_past():
+    wheel = TimerWheel(1.0, 10)
+    wheel.add(5, 'late')
+    assert wheel.advance(10) == []
+    assert wheel.advance(11) == ['late']
+
+def test_scheduler_coalesces_missed_runs():
+    clock = Clock()
+    runs = []
+    scheduler = ChiiScheduler(clock=clock)
+    task = scheduler.add('tick', lambda: runs.append(clock.seconds()), IntervalSpec(10))
+    clock.advance(10)
+    assert runs == [10]
+    # the reactor was busy for a while, of the runs due at 20, 30 and 40 the
+    # late one runs, 30 is skipped and 40 is made up right after
+    clock.advance(35)
+    assert runs == [10, 45]
+    clock.pump([1] * 5)
+    assert runs == [10, 45, 46, 50]
+    assert task.missed == 1
+    scheduler.remove('tick')
+    assert not scheduler.loop.running
+
+def test_scheduler_runs_now():
+    clock = Clock()
+    runs = []
+    scheduler = ChiiScheduler(clock=clock)
+    scheduler.add('tick', lambda: runs.append(clock.seconds()), IntervalSpec(60), now=True)
+    clock.advance(1)
+    assert runs == [1]
+    scheduler.remove('tick')
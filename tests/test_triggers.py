@@ -0,0 +1,51 @@
+from chii import TriggerMatcher, event
+
+def handler(name, **triggers):
+    func = event('msg', **triggers)(lambda self, *args: None)
+    func.__name__ = name
+    return func
+
+def test_handlers_without_triggers_always_match():
+    always = handler('always')
+    matcher = TriggerMatcher([always])
+    assert matcher.match('anything') == set([always])
+    assert matcher.match(None) == set([always])
+
+def test_contains():
+    haha = handler('haha', contains=('haha', 'lol'))
+    matcher = TriggerMatcher([haha])
+    assert matcher.match('hahaha') == set([haha])
+    assert matcher.match('so lol') == set([haha])
+    assert matcher.match('HAHA') == set()
+
+def test_startswith_and_equals():
+    prefix = handler('prefix', startswith='!go')
+    exact = handler('exact', equals='ya')
+    matcher = TriggerMatcher([prefix, exact])
+    assert matcher.match('!go home') == set([prefix])
+    assert matcher.match('so !go') == set()
+    assert matcher.match('  ya ') == set([exact])
+    assert matcher.match('ya know') == set()
+
+def test_nocase():
+    shout = handler('shout', contains='cool', nocase=True)
+    exact = handler('exact', equals='The Best', nocase=True)
+    matcher = TriggerMatcher([shout, exact])
+    assert matcher.match('COOL story') == set([shout])
+    assert matcher.match('the best') == set([exact])
+
+def test_matches_only_returns_handlers_whose_pattern_matches():
+    digits = handler('digits', matches=r'\d{3}')
+    words = handler('words', matches=r'^muse\b', nocase=True)
+    matcher = TriggerMatcher([digits, words])
+    assert matcher.match('call 555') == set([digits])
+    # the combined regex is case-insensitive, digits' own pattern isn't
+    assert matcher.match('MUSE says') == set([words])
+    assert matcher.match('nothing here') == set()
+
+def test_several_triggers_of_one_handler():
+    megachat = handler('megachat', contains='mega', startswith='chat')
+    matcher = TriggerMatcher([megachat])
+    assert matcher.match('chatty') == set([megachat])
+    assert matcher.match('omegalul') == set([megachat])
+    assert matcher.match('neither') == set()